@@ -5,11 +5,10 @@ from typing import List
 from typing import Optional
 
 import yaml
-from fastapi import Depends, FastAPI, File, HTTPException, UploadFile, WebSocket
+from fastapi import Depends, FastAPI, File, HTTPException, UploadFile, WebSocket, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from fastapi.security import OAuth2PasswordBearer
-from ingest import ingest_files
 from models import User
 from passlib.context import CryptContext
 from pydantic import BaseModel
@@ -20,7 +19,13 @@ from chat.chat_with_data import chat_ask_question
 from fastapi import WebSocket, WebSocketDisconnect
 from starlette.websockets import WebSocket
 from chat.chat_utils import limit_chat_history, get_chat_history_redis
-from user_routes import get_db, get_current_user
+import asyncio
+import logging
+from file_service import ORPHAN_SWEEP_INTERVAL_SECONDS, delete_file as delete_uploaded_file, sweep_orphans
+from file_catalog import file_catalog
+from user_routes import get_db, get_current_user, get_current_user_optional
+from ingest_jobs import job_queue
+from upload_service import UPLOAD_DIR, discard_uploads, save_upload, upload_path
 from user_routes import router as user_router
 from redis_config import startup as redis_startup, get_redis
 from chat.websocket_manager import handle_websocket
@@ -49,41 +54,131 @@ def load_config(file_path: str) -> dict:
 
 config = load_config("config.yaml")
 
+logger = logging.getLogger(__name__)
+
+
+async def sweep_orphans_periodically():
+    while True:
+        try:
+            await asyncio.to_thread(sweep_orphans)
+        except Exception as e:
+            logger.exception(f"Orphan sweep failed: {e}")
+        await asyncio.sleep(ORPHAN_SWEEP_INTERVAL_SECONDS)
+
+
 # REDIS
 @app.on_event("startup")
 async def startup_event():
     await redis_startup(app)
-    
+    await asyncio.to_thread(file_catalog.import_filenames_json)
+    app.state.orphan_sweeper = asyncio.create_task(
+        sweep_orphans_periodically())
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    job_queue.shutdown()
+    app.state.orphan_sweeper.cancel()
+
 
 @app.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: str):
-    await handle_websocket(websocket, user_id)
+async def websocket_endpoint(websocket: WebSocket,
+                             user_id: str,
+                             token: Optional[str] = None,
+                             db: Session = Depends(get_db)):
+    """
+    Authenticated like the chat endpoint: a bearer token in the "token" query
+    parameter, or else as the first text frame. The socket is closed with 1008
+    unless the token is valid and belongs to user_id.
+    """
+    if token is None:
+        await websocket.accept()
+        token = await websocket.receive_text()
+    try:
+        current_user = await get_current_user(
+            token, websocket.app.state.token_blacklist, db)
+    except HTTPException:
+        current_user = None
+    if current_user is None or str(current_user.user_id) != user_id:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    # Chat history and answers belong to the token's user, not the path value
+    await handle_websocket(websocket, current_user.user_id)
     
 
 ##### RESOURCE: FILES #####
-@app.post("/files")
-async def upload_files(files: List[UploadFile] = File(...)):
+@app.post("/files", status_code=202)
+async def upload_files(files: List[UploadFile] = File(...),
+                       update: bool = True,
+                       current_user=Depends(get_current_user_optional)):
+    # update: re-uploading an existing filename re-embeds only its changed chunks
     message = None
+    job_id = None
     file_paths = []
+    content_hashes = {}
+    owner_id = current_user.user_id if current_user else None
+    # Names are global, don't let an upload overwrite another user's file
     for uploaded_file in files:
-        filename = uploaded_file.filename
-        file_path = os.path.join("uploads", filename)
-        with open(file_path, "wb") as f:
-            content = await uploaded_file.read()
-            f.write(content)
-        file_paths.append(file_path)
-    if file_paths:
-        ingest_files(file_paths)
-        message = "File uploaded and ingested successfully."
-    return {"message": message}
+        file_path = upload_path(uploaded_file.filename)
+        if not await asyncio.to_thread(file_catalog.can_replace, file_path,
+                                       owner_id):
+            raise HTTPException(
+                status_code=409,
+                detail=f"File {file_path} already exists and belongs to another user.",
+            )
+    staged_paths = {}
+    try:
+        for uploaded_file in files:
+            # Streamed to disk chunk by chunk, never fully held in memory
+            file_path, staged_path, content_hash, size = await save_upload(
+                uploaded_file)
+            if file_path in staged_paths:
+                # Same name twice in one request, the last copy wins
+                discard_uploads([staged_paths[file_path]])
+            else:
+                file_paths.append(file_path)
+            staged_paths[file_path] = staged_path
+            content_hashes[file_path] = content_hash
+        if file_paths:
+            # Ingestion runs on the job queue, poll /files/jobs/{job_id} for progress
+            user_id = current_user.user_id if current_user else "anonymous"
+            job = job_queue.submit(user_id, file_paths, content_hashes,
+                                   update, staged_paths)
+            job_id = job.job_id
+            message = "Files uploaded and queued for ingestion."
+    except BaseException:
+        # Nothing of a rejected request is kept
+        discard_uploads(staged_paths.values())
+        raise
+    return {"message": message, "job_id": job_id}
+
+
+@app.get("/files/jobs/{job_id}")
+async def get_ingestion_job(job_id: str,
+                            current_user=Depends(get_current_user_optional)):
+    job = job_queue.get(job_id)
+    user_id = current_user.user_id if current_user else "anonymous"
+    if job is None or job.user_id != user_id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
 
 
 ##### DELETE FILE #####
-@app.post("/files/delete/{filename}")
-async def delete_file(filename: str):
-    message = "File deletion not implemented yet."
-    # Change status code as per operation result
-    return JSONResponse(content={"message": message}, status_code=200)
+@app.post("/files/delete/{filename:path}")
+async def delete_file(filename: str, current_user=Depends(get_current_user)):
+    # Files are registered under their upload path
+    if not filename.startswith(f"{UPLOAD_DIR}/"):
+        filename = f"{UPLOAD_DIR}/{filename}"
+    # Only the owner may delete a file; other users' files are reported missing
+    if not await asyncio.to_thread(file_catalog.can_replace, filename,
+                                   current_user.user_id):
+        raise HTTPException(status_code=404,
+                            detail=f"File {filename} not found")
+    # Vector deletion and file removal block, keep them off the event loop
+    result = await asyncio.to_thread(delete_uploaded_file, filename)
+    message = f"File {filename} deleted."
+    return JSONResponse(content={"message": message, **result},
+                        status_code=200)
 
 
 # to get string like this run:
@@ -0,0 +1,124 @@
+"""
+Chunking benchmark: text_chunker.split_text vs the TextTiling splitter it replaced.
+
+Usage (from the repository root):
+    python benchmarks/bench_chunking.py [file.txt ...]
+
+Without files a synthetic document is generated. Reports time, chunk count and
+the largest chunk in tokens for several document sizes. The legacy splitter
+needs nltk's "punkt" and "stopwords" data.
+"""
+import os
+import random
+import sys
+import time
+
+import nltk
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from nltk.tokenize import TextTilingTokenizer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from text_chunker import split_text  # noqa: E402
+from tokenizer import count_tokens  # noqa: E402
+
+WORDS = ("data hive vector index embedding student course lecture python "
+         "function tuple sequence memory upload document answer question "
+         "model token chunk page table header").split()
+
+
+# The split_text_data implementation from ingest.py before the token-aware chunker
+# 3200 is aprox 1042 tokens
+def legacy_split_text_data(text: str, max_chars: int = 3200) -> list:
+    # initialize TextTilingTokenizer
+    ttt = TextTilingTokenizer()
+
+    # check if text too short
+    if len(text) < ttt.w * 2:  # w = default block size (usually 50)
+        return [text]
+
+    try:
+        # tokenize the text into pseudo sentences (adjust parameters if necessary)
+        pseudo_sentences = nltk.sent_tokenize(text, language="english")
+
+        # Concatenate pseudo sentences
+        concatenated_pseudo_sentences = " ".join(pseudo_sentences)
+
+        # Apply text tiling on concatenated pseudo sentences
+        chunks = ttt.tokenize(concatenated_pseudo_sentences)
+
+        # remove double new lines from chunks
+        chunks = [chunk.lstrip("\n\n") for chunk in chunks]
+
+        if len(chunks) <= 1:
+            raise ValueError("Too few chunks")
+
+        # Split chunks that exceed the maximum character limit
+        i = 0
+        while i < len(chunks):
+            chunk = chunks[i]
+            if len(chunk) > max_chars:
+                # split the chunk into smaller subchunks
+                num_subchunks = (len(chunk) // max_chars) + 1
+                subchunks = [
+                    chunk[j * max_chars:(j + 1) * max_chars]
+                    for j in range(num_subchunks)
+                ]
+                chunks.pop(i)
+                for subchunk in reversed(subchunks):
+                    chunks.insert(i, subchunk)
+            i += 1
+
+    except ValueError:
+        # Fallback to RecursiveCharacterTextSplitter
+        char_text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000,
+                                                            chunk_overlap=200)
+        chunks = char_text_splitter.split_text(text)
+    return chunks
+
+
+
+def synthetic_document(n_words: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    paragraphs = []
+    words = 0
+    while words < n_words:
+        sentences = []
+        for _ in range(rng.randint(3, 8)):
+            length = rng.randint(6, 25)
+            sentences.append(" ".join(rng.choice(WORDS)
+                                      for _ in range(length)).capitalize() +
+                             ".")
+            words += length
+        paragraphs.append(" ".join(sentences))
+    return "\n\n".join(paragraphs)
+
+
+def measure(split, text: str):
+    start = time.perf_counter()
+    chunks = split(text)
+    elapsed = time.perf_counter() - start
+    largest = max((count_tokens(chunk) for chunk in chunks), default=0)
+    return elapsed, len(chunks), largest
+
+
+def main():
+    if sys.argv[1:]:
+        documents = []
+        for path in sys.argv[1:]:
+            with open(path, "r", errors="replace") as f:
+                documents.append((os.path.basename(path), f.read()))
+    else:
+        documents = [(f"synthetic {n_words} words", synthetic_document(n_words))
+                     for n_words in (5_000, 20_000, 80_000)]
+
+    print(f"{'document':<28}{'splitter':<14}{'seconds':>10}{'chunks':>8}{'max tokens':>12}")
+    for name, text in documents:
+        for label, split in (("legacy", legacy_split_text_data),
+                             ("text_chunker", split_text)):
+            elapsed, n_chunks, largest = measure(split, text)
+            print(f"{name:<28}{label:<14}{elapsed:>10.3f}{n_chunks:>8}{largest:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import asyncio
+import json
+import logging
+
+from fastapi import HTTPException
+
+from chat.chat_utils import get_chat_messages
+from chat.chat_utils import save_bot_response
+from chat.chat_with_data import acache_answer
+from chat.chat_with_data import alookup_answer
+from chat.chat_with_data import aretrieve_documents
+from chat.chat_with_data import astream_chat_answer
+from retrieve import aget_embedding
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def iter_chat_answer(user_id,
+                           user_input: str,
+                           file_name=None,
+                           conversation_id=None):
+    """
+    Stream the answer to a chat message token by token. Once the answer is
+    complete it is saved to the Redis chat history, in one write. An answer
+    found in the semantic cache is yielded whole.
+    """
+    query_embeds, chat_history = await asyncio.gather(
+        aget_embedding(user_input),
+        get_chat_messages(user_id, conversation_id),
+    )
+    scope, cached_answer = await alookup_answer(query_embeds, file_name,
+                                                chat_history)
+    if cached_answer is not None:
+        yield cached_answer
+        await save_bot_response(user_id, chat_history, cached_answer,
+                                user_input, conversation_id)
+        return
+    documents = await aretrieve_documents(user_input, file_name, query_embeds)
+    tokens = []
+    async for token in astream_chat_answer(user_input,
+                                           chat_history,
+                                           file_name,
+                                           documents=documents):
+        tokens.append(token)
+        yield token
+    response = "".join(tokens)
+    await acache_answer(scope, query_embeds, response)
+    await save_bot_response(user_id, chat_history, response, user_input,
+                            conversation_id)
+
+
+def sse_event(data: dict, event: str = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+async def chat_sse_events(user_id,
+                          user_input: str,
+                          file_name=None,
+                          conversation_id=None):
+    """
+    Server-Sent Events for a streamed chat answer: one "data" event per token,
+    then a "done" event with the full response, or an "error" event.
+    """
+    tokens = []
+    try:
+        async for token in iter_chat_answer(user_id, user_input, file_name,
+                                            conversation_id):
+            tokens.append(token)
+            yield sse_event({"token": token})
+    except HTTPException as e:
+        yield sse_event({
+            "status_code": e.status_code,
+            "detail": e.detail
+        }, "error")
+        return
+    except Exception as e:
+        logger.error(f"Error while streaming response: {e}")
+        yield sse_event(
+            {
+                "status_code": 500,
+                "detail": "Unable to process the request."
+            }, "error")
+        return
+    yield sse_event({"response": "".join(tokens)}, "done")
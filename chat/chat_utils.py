@@ -1,11 +1,11 @@
 import json
 import logging
-
-from langchain.callbacks import get_openai_callback
-from langchain.llms import OpenAI
+import struct
+import zlib
 
 from config import load_config
 from redis_config import get_redis
+from tokenizer import count_tokens
 
 # === CONFIG ===#
 config = load_config("config.yaml")
@@ -14,34 +14,169 @@ config = load_config("config.yaml")
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-llm = OpenAI(temperature=0, openai_api_key=config["OPENAI_API_KEY"])
+# Tokens of chat history kept per conversation, counted locally with the chat model's tokenizer
+CHAT_HISTORY_TOKEN_LIMIT = config.get("CHAT_HISTORY_TOKEN_LIMIT", 2500)
+# Most messages kept per conversation, whatever their size
+CHAT_HISTORY_MAX_MESSAGES = config.get("CHAT_HISTORY_MAX_MESSAGES", 50)
+# Conversations expire once idle for this long
+CHAT_HISTORY_TTL_SECONDS = config.get("CHAT_HISTORY_TTL_SECONDS",
+                                      7 * 24 * 3600)
+CHAT_TOKENIZER_MODEL = "gpt-3.5-turbo"
+DEFAULT_CONVERSATION = "default"
 
+# Stored message: flags (role index, compressed bit), token count, then the
+# utf-8 text, zlib-compressed when longer than COMPRESS_MIN_BYTES
+MESSAGE_HEADER = struct.Struct("<BI")
+ROLES = ("Human", "bot")
+COMPRESSED = 0x80
+COMPRESS_MIN_BYTES = 512
 
-async def limit_chat_history(chat_history, new_response, token_limit=2500):
-    # Calculate total tokens in chat history + response
-    with get_openai_callback() as cb:
-        llm("\n".join(f'{msg["user"]}: {msg["message"]}'
-                      for msg in chat_history) + f"\nbot: {new_response}")
-    total_tokens = cb.total_tokens
 
-    logger.info(f"TOTAL TOKENS REDIS HISTORY: {total_tokens}")
+def message_tokens(msg: dict) -> int:
+    # Stored with each message, counted here for new ones
+    tokens = msg.get("tokens")
+    if tokens is None:
+        tokens = count_tokens(f'{msg["user"]}: {msg["message"]}',
+                              CHAT_TOKENIZER_MODEL)
+    return tokens
+
 
-    # If total exceed limit remove messages until under limit
-    while total_tokens > token_limit:
-        removed_message = chat_history.pop(0)
-        with get_openai_callback() as cb:
-            llm("\n".join(f'{msg["user"]}: {msg["message"]}'
-                          for msg in chat_history) + f"\nbot: {new_response}")
-        total_tokens = cb.total_tokens
+def limit_chat_history(chat_history,
+                       total_tokens: int,
+                       token_limit=CHAT_HISTORY_TOKEN_LIMIT):
+    """
+    Work out how many of the oldest messages to drop to get under token_limit.
 
-    return chat_history
+    :param total_tokens: Tokens of chat_history plus the message being added.
+    :return: (number of messages to drop, tokens they hold)
+    """
+    removed = removed_tokens = 0
+    while total_tokens - removed_tokens > token_limit and removed < len(
+            chat_history):
+        removed_tokens += message_tokens(chat_history[removed])
+        removed += 1
+    return removed, removed_tokens
 
 
 # REDIS CHAT HISTORY
-async def get_chat_history_redis(user_id: str):
+def chat_key(user_id, conversation_id=None) -> str:
+    return f"chat:{user_id}:conversation:{conversation_id or DEFAULT_CONVERSATION}"
+
+
+def encode_message(msg: dict) -> bytes:
+    flags = ROLES.index(msg["user"])
+    data = msg["message"].encode("utf-8")
+    if len(data) > COMPRESS_MIN_BYTES:
+        data = zlib.compress(data)
+        flags |= COMPRESSED
+    return MESSAGE_HEADER.pack(flags, message_tokens(msg)) + data
+
+
+def decode_message(record: bytes) -> dict:
+    flags, tokens = MESSAGE_HEADER.unpack_from(record)
+    data = record[MESSAGE_HEADER.size:]
+    if flags & COMPRESSED:
+        data = zlib.decompress(data)
+    return {
+        "user": ROLES[flags & ~COMPRESSED],
+        "message": data.decode("utf-8"),
+        "tokens": tokens,
+    }
+
+
+async def save_bot_response(user_id,
+                            chat_history,
+                            response: str,
+                            user_input: str = None,
+                            conversation_id=None):
+    """
+    Append the user's message and the bot's response to the conversation,
+    trimming the oldest messages so it stays under CHAT_HISTORY_TOKEN_LIMIT
+    tokens and CHAT_HISTORY_MAX_MESSAGES messages.
+
+    Each message carries its token count, so the total comes from chat_history
+    (as returned by get_chat_messages) without re-tokenizing. Append, trim and
+    TTL refresh go to Redis in one pipelined transaction.
+    """
+    new_messages = [{"user": "bot", "message": response}]
+    if user_input:
+        new_messages.insert(0, {"user": "Human", "message": user_input})
+    for msg in new_messages:
+        msg["tokens"] = message_tokens(msg)
+    messages = list(chat_history) + new_messages
+    total_tokens = sum(message_tokens(msg) for msg in messages)
+    logger.info(f"TOTAL TOKENS REDIS HISTORY: {total_tokens}")
+
+    removed = max(0, len(messages) - CHAT_HISTORY_MAX_MESSAGES)
+    removed_tokens = sum(message_tokens(msg) for msg in messages[:removed])
+    if total_tokens - removed_tokens > CHAT_HISTORY_TOKEN_LIMIT:
+        more, _ = limit_chat_history(
+            messages[removed:-1], total_tokens - removed_tokens,
+            CHAT_HISTORY_TOKEN_LIMIT)
+        removed += more
+
+    r = await get_redis()
+    key = chat_key(user_id, conversation_id)
+    pipe = r.pipeline(transaction=True)
+    pipe.rpush(key, *[encode_message(msg) for msg in new_messages])
+    # Keep the newest messages rather than cutting at a start index, so
+    # messages appended by a concurrent turn are not cut instead
+    pipe.ltrim(key, -(len(messages) - removed), -1)
+    pipe.expire(key, CHAT_HISTORY_TTL_SECONDS)
+    await pipe.execute()
+
+
+async def import_legacy_history(r, user_id) -> int:
+    """
+    Move the per-user history kept before conversations (JSON messages under
+    chat:{user_id}) into the user's default conversation, ahead of anything
+    already there. The old key is read and removed in one transaction, so only
+    one caller imports it.
+
+    :return: the number of messages imported.
+    """
+    legacy_key = f"chat:{user_id}"
+    pipe = r.pipeline(transaction=True)
+    pipe.lrange(legacy_key, -CHAT_HISTORY_MAX_MESSAGES, -1)
+    pipe.unlink(legacy_key, f"{legacy_key}:tokens")
+    records, _ = await pipe.execute()
+    if not records:
+        return 0
+    messages = []
+    for record in records:
+        try:
+            msg = json.loads(record)
+            if msg["user"] in ROLES:
+                messages.append(encode_message(msg))
+        except (ValueError, KeyError, TypeError):
+            logger.warning(f"Skipping unreadable legacy message of {user_id}")
+    if messages:
+        key = chat_key(user_id)
+        pipe = r.pipeline(transaction=True)
+        pipe.lpush(key, *reversed(messages))
+        pipe.ltrim(key, -CHAT_HISTORY_MAX_MESSAGES, -1)
+        pipe.expire(key, CHAT_HISTORY_TTL_SECONDS)
+        await pipe.execute()
+    logger.info(f"Imported {len(messages)} legacy messages of {user_id}")
+    return len(messages)
+
+
+async def get_chat_messages(user_id, conversation_id=None):
+    """
+    :return: the conversation's messages, oldest first, as
+        {"user", "message", "tokens"} dicts.
+    """
     r = await get_redis()
-    history = await r.lrange(f"chat:{user_id}", 0, -1)
-    if history is None:
-        return []
-    print(history)
-    return [message.decode("utf-8") for message in history]
+    key = chat_key(user_id, conversation_id)
+    history = await r.lrange(key, -CHAT_HISTORY_MAX_MESSAGES, -1)
+    if not history and key == chat_key(user_id) and await import_legacy_history(
+            r, user_id):
+        history = await r.lrange(key, -CHAT_HISTORY_MAX_MESSAGES, -1)
+    return [decode_message(record) for record in history]
+
+
+async def get_chat_history_redis(user_id: str, conversation_id=None):
+    return [
+        f'{msg["user"]}: {msg["message"]}'
+        for msg in await get_chat_messages(user_id, conversation_id)
+    ]
@@ -1,22 +1,33 @@
 # from dotenv import dotenv_values
+import asyncio
 import logging
 from typing import Dict
 from typing import List
 
 import openai
-import pinecone
 import yaml
 from fastapi import HTTPException
+from langchain.callbacks import AsyncIteratorCallbackHandler
 from langchain.chains.question_answering import load_qa_chain
 from langchain.chat_models import ChatOpenAI
 from langchain.llms import OpenAI
 from langchain.memory import ConversationBufferMemory
 from langchain.prompts import PromptTemplate
-
-from doc_utils import fetchTopK
+from langchain.schema import Document
+
+from chat.chat_utils import CHAT_TOKENIZER_MODEL
+from chat.chat_utils import message_tokens
+from chat.context_packer import fit_history
+from chat.context_packer import fits_budget
+from chat.context_packer import pack_context
+from doc_utils import get_match_file_names
+from doc_utils import get_match_texts
 from doc_utils import search_documents_by_file_name
-from retrieve import get_embedding
-from retrieve import query_pinecone
+from retrieve import aget_embedding
+from semantic_cache import SEMANTIC_CACHE_ENABLED
+from semantic_cache import semantic_cache
+from tokenizer import count_tokens
+from vector_store import get_vector_index
 
 # config = dotenv_values(".env")
 # from flask import jsonify, make_response
@@ -34,33 +45,24 @@ config = load_config("config.yaml")
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialize Pinecone
-pinecone.init(api_key=config["PINECONE_API_KEY"],
-              environment=config["PINECONE_ENVIRONMENT"])
-index = pinecone.Index(config["PINECONE_INDEX_NAME"])
+# Vector index (Pinecone or local, see VECTOR_BACKEND)
+index = get_vector_index()
 
 tone = config["tone"]
 persona = config["persona"]
 
-# Initialize the QA chain
-logger.info("Initializing QA chain......")
-chain = load_qa_chain(
-    ChatOpenAI(openai_api_key=config["OPENAI_API_KEY"]),
-    chain_type="stuff",
-    memory=ConversationBufferMemory(memory_key="chat_history_redis",
-                                    input_key="human_input"),
-    prompt=PromptTemplate(
-        input_variables=[
-            "chat_history",
-            "human_input",
-            "context",
-            "tone",
-            "persona",
-            "filenames",
-            "text_list",
-        ],
-        template=
-        """You are a chatbot who acts like {persona}, having a conversation with a student.
+qa_prompt = PromptTemplate(
+    input_variables=[
+        "chat_history",
+        "human_input",
+        "context",
+        "tone",
+        "persona",
+        "filenames",
+        "text_list",
+    ],
+    template=
+    """You are a chatbot who acts like {persona}, having a conversation with a student.
 
 Given the following extracted parts of a long document answer the question in the tone {tone}.
 If you don't know the answer, just say that you don't know. Don't try to make up an answer.
@@ -75,114 +77,211 @@ APPLY NLP TECHNIQUES FOR A WELL FORMATTED ANSWER
 {chat_history}
 Human: {human_input}
 Chatbot:""",
-    ),
+)
+
+# Initialize the QA chain
+logger.info("Initializing QA chain......")
+chain = load_qa_chain(
+    ChatOpenAI(openai_api_key=config["OPENAI_API_KEY"]),
+    chain_type="stuff",
+    memory=ConversationBufferMemory(memory_key="chat_history_redis",
+                                    input_key="human_input"),
+    prompt=qa_prompt,
+    verbose=False,
+)
+# Same chain with a streaming LLM, tokens are delivered to per-call callbacks
+streaming_chain = load_qa_chain(
+    ChatOpenAI(openai_api_key=config["OPENAI_API_KEY"], streaming=True),
+    chain_type="stuff",
+    prompt=qa_prompt,
     verbose=False,
 )
 
 
-def chat_ask_question(
+async def alookup_answer(query_embeds, file_name=None, chat_history=None):
+    """
+    Look for the answer to a similar question in the semantic cache.
+
+    Entries are shared by all users, so only questions asked without chat
+    history are looked up (and later stored): an answer built with one user's
+    conversation in the prompt must not reach another user.
+
+    :return: (cache scope, cached answer). The scope is None when the cache is
+        disabled, unavailable or not applicable, the answer None on a miss.
+    """
+    if not SEMANTIC_CACHE_ENABLED or chat_history:
+        return None, None
+    try:
+        scope = await semantic_cache.get_scope(file_name)
+        if scope is None:
+            return None, None
+        return scope, await semantic_cache.get(scope, query_embeds)
+    except Exception as e:
+        # Answer without the cache rather than fail the request
+        logger.error(f"Semantic cache lookup failed: {e}")
+        return None, None
+
+
+async def acache_answer(scope, query_embeds, answer: str):
+    """
+    Store an answer under the scope returned by alookup_answer before it was
+    generated, so an answer computed from replaced content is never cached
+    under the new version.
+    """
+    if scope is None:
+        return
+    try:
+        await semantic_cache.put(scope, query_embeds, answer)
+    except Exception as e:
+        logger.error(f"Could not cache answer: {e}")
+
+
+async def aretrieve_documents(question: str, file_name=None, query_embeds=None):
+    """
+    Embed the question (unless query_embeds is given) and query the vector index
+    for matching chunks.
+    """
+    if query_embeds is None:
+        query_embeds = await aget_embedding(question)
+    # The index clients are synchronous, keep them off the event loop
+    return await asyncio.to_thread(search_documents_by_file_name,
+                                   index,
+                                   tuple(query_embeds),
+                                   file_name,
+                                   include_metadata=True)
+
+
+async def prepare_chain_inputs(
+    question: str,
+    chat_history_redis: List[Dict[str, str]],
+    file_name=None,
+    documents=None,
+):
+    """
+    Retrieve (unless documents are given) and assemble the QA chain inputs.
+
+    The prompt is measured with the local tokenizer before the call: the oldest
+    chat messages are dropped if the prompt alone is over budget, then the
+    best non-redundant chunks that fit are packed in (see context_packer.py).
+
+    :return: the chain inputs.
+    """
+    if documents is None:
+        documents = await aretrieve_documents(question, file_name)
+
+    # Log number of matching documents
+    logger.debug(f"Number of matching documents: {len(documents['matches'])}")
+
+    # Extract the unique filenames from the matching documents
+    filenames = await asyncio.to_thread(get_unique_filenames,
+                                        documents["matches"])
+    logger.info(f"Unique source filenames: {filenames}")
+
+    # Extract the relevant text from the matching documents
+    texts = await asyncio.to_thread(get_match_texts, documents["matches"])
+
+    def prompt_inputs(history, chosen_texts) -> dict:
+        return {
+            "human_input": question,
+            # Convert chat history from list of dicts to string
+            "chat_history": "\n".join(f'{msg["user"]}: {msg["message"]}'
+                                      for msg in history),
+            "tone": tone,
+            "persona": persona,
+            "filenames": filenames,
+            "text_list": [{
+                "text": text
+            } for text in chosen_texts],
+        }
+
+    def prompt_tokens(history) -> int:
+        return count_tokens(
+            qa_prompt.format(context="", **prompt_inputs(history, [])),
+            CHAT_TOKENIZER_MODEL)
+
+    def chunk_tokens(text: str) -> int:
+        # Each chunk appears twice: in {context} and in {text_list}
+        return (count_tokens(text, CHAT_TOKENIZER_MODEL) +
+                count_tokens(repr({"text": text}), CHAT_TOKENIZER_MODEL) + 2)
+
+    history, fixed_tokens = fit_history(chat_history_redis,
+                                        prompt_tokens(chat_history_redis),
+                                        message_tokens)
+    if len(history) < len(chat_history_redis):
+        fixed_tokens = prompt_tokens(history)
+        logger.info(
+            f"Dropped {len(chat_history_redis) - len(history)} chat messages to fit the prompt"
+        )
+    if not fits_budget(fixed_tokens):
+        # The question alone is too long
+        raise context_too_long_error()
+
+    chosen = pack_context(
+        [(match.get("score", 0.0), text)
+         for match, text in zip(documents["matches"], texts)], fixed_tokens,
+        chunk_tokens)
+    inputs = prompt_inputs(history, [texts[i] for i in chosen])
+    inputs["input_documents"] = [
+        Document(page_content=texts[i],
+                 metadata={"id": documents["matches"][i]["id"]})
+        for i in chosen
+    ]
+    return inputs
+
+
+# Raised when the model rejects a request despite the pre-flight budgeting
+def invalid_request_error(e: Exception) -> HTTPException:
+    if "maximum context length" in str(e):
+        return context_too_long_error()
+    logger.error(f"Invalid request error: {e}")
+    return HTTPException(
+        status_code=400,
+        detail=
+        f"Unable to process the request due to an invalid request error: {e}",
+    )
+
+
+def context_too_long_error() -> HTTPException:
+    logger.error("Context too long for the model")
+    return HTTPException(
+        status_code=422,
+        detail=
+        "The input is too long. Please reduce the length of the messages.",
+    )
+
+
+async def achat_ask_question(
     user_input: str,
     chat_history_redis: List[Dict[str, str]],
     file_name=None,
-    truncated_question=None,
-    truncation_step=0,
+    documents=None,
 ):
     """
     Handles the chat request, retrieves relevant documents, and generates the chatbot's response.
 
-    :param truncated_question: The original question with a reduced length, if any (default: None).
-    :param truncation_step: The number of times the incput question has been truncated (default: 0).
-    :return: A JSON serialized response containing the chatbot's response or an error message.
+    Nothing here blocks the event loop: the embedding and LLM calls are awaited
+    and the vector query runs in a worker thread.
+
+    :param documents: Matches already retrieved with aretrieve_documents, so callers
+        can run retrieval concurrently with fetching the chat history (default: None).
+    :return: The chatbot's response text.
     """
     try:
-        # Get the question from the request
-        question = user_input
-        file_name = file_name
-        query_embeds = get_embedding(question)
-
-        documents = search_documents_by_file_name(index,
-                                                  tuple(query_embeds),
-                                                  file_name,
-                                                  include_metadata=True)
-        """ print(chat_history_redis)
-        print(type(chat_history_redis)) """
-        # Convert chat history from list of dicts to string
-        chat_history_str = "\n".join(f'{msg["user"]}: {msg["message"]}'
-                                     for msg in chat_history_redis)
-
-        # print(query_pinecone.cache_info())
-
-        # Log number of matching documents
-        logger.debug(
-            f"Number of matching documents: {len(documents['matches'])}")
-
-        # Extract the unique filenames from the matching documents
-        filenames = get_unique_filenames(documents["matches"])
-        logger.info(f"Unique source filenames: {filenames}")
-
-        # Extract the relevant text from the matching documents (if truncated, remove truncation_step number of elements)
-        text_list = [{
-            "text": match["metadata"]["text"]
-        } for match in documents["matches"]]
-
-        if truncation_step == 0:
-            truncated_question = user_input
-
-        if truncation_step > 0:
-            original_length = len(text_list)
-            text_list = text_list[:-truncation_step]
-            logger.info(
-                f"Truncating text_list from {original_length} to {len(text_list)} elements."
-            )
-
-        # Get the bot's response
-        response = chain(
-            {
-                "input_documents": documents["matches"],
-                "human_input": question,
-                "chat_history": chat_history_str,
-                "tone": tone,
-                "persona": persona,
-                "filenames": filenames,
-                "text_list": text_list,
-            },
-            return_only_outputs=True,
-        )
-        # Print chat history
-        # chat_history = chain.memory.buffer
-        chat_history = chat_history_redis
-        print(f"Chat history redis {chat_history}")
-        # print(f"Chat history: {chat_history}")
+        chain_inputs = await prepare_chain_inputs(user_input,
+                                                  chat_history_redis,
+                                                  file_name, documents)
+        try:
+            # Get the bot's response
+            response = await chain.acall(chain_inputs,
+                                         return_only_outputs=True)
+        except openai.InvalidRequestError as e:
+            raise invalid_request_error(e)
         # Extract the response text
         response_text = response["output_text"]
         logger.info(f"RESPONSE: {response_text} ")
-        # Return the JSON serialized response
         return response_text
-    except openai.InvalidRequestError as e:
-        error_message = str(e)
-        if "maximum context length" in error_message:
-            if truncation_step < 4:
-                return chat_ask_question(
-                    user_input=user_input,
-                    file_name=file_name,
-                    truncated_question=truncated_question,
-                    truncation_step=truncation_step + 1,
-                )
-            elif truncation_step >= 4:
-                logger.error(f"Error while processing request: {e}")
-                raise HTTPException(
-                    status_code=422,
-                    detail=
-                    "The input is too long. Please reduce the length of the messages.",
-                )
-        else:
-            logger.error(f"Invalid request error: {e}")
-            raise HTTPException(
-                status_code=400,
-                detail=
-                f"Unable to process the request due to an invalid request error: {error_message}",
-            )
-
+    except HTTPException:
+        raise
     except Exception as e:
         # Log the error and return an error response
         logger.error(f"Error while processing request: {e}")
@@ -190,18 +289,68 @@ def chat_ask_question(
                             detail="Unable to process the request.")
 
 
+async def astream_chat_answer(
+    user_input: str,
+    chat_history_redis: List[Dict[str, str]],
+    file_name=None,
+    documents=None,
+):
+    """
+    Like achat_ask_question, but yields the answer token by token as the LLM
+    produces it. Errors are raised as HTTPException, as in achat_ask_question.
+    """
+    try:
+        chain_inputs = await prepare_chain_inputs(user_input,
+                                                  chat_history_redis,
+                                                  file_name, documents)
+        handler = AsyncIteratorCallbackHandler()
+        task = asyncio.create_task(
+            streaming_chain.acall(chain_inputs,
+                                  callbacks=[handler],
+                                  return_only_outputs=True))
+        # Stop iterating even if the chain fails before the LLM starts
+        task.add_done_callback(lambda _: handler.done.set())
+        try:
+            async for token in handler.aiter():
+                yield token
+            await task
+        except openai.InvalidRequestError as e:
+            raise invalid_request_error(e)
+        finally:
+            # The client went away mid-answer
+            if not task.done():
+                task.cancel()
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error while streaming response: {e}")
+        raise HTTPException(status_code=500,
+                            detail="Unable to process the request.")
+
+
+def chat_ask_question(
+    user_input: str,
+    chat_history_redis: List[Dict[str, str]],
+    file_name=None,
+):
+    """
+    Synchronous wrapper around achat_ask_question, for callers outside an event loop.
+    """
+    return asyncio.run(
+        achat_ask_question(user_input, chat_history_redis, file_name))
+
+
 def get_unique_filenames(matches):
     seen_filenames = set()
     filenames = []
 
-    for doc in matches:
-        file_name = doc["metadata"]["file_name"]
-
-        # Remove 'uploads/' part from the filename if present
-        file_name = file_name.replace("uploads/", "")
+    for file_names in get_match_file_names(matches):
+        for file_name in file_names:
+            # Remove 'uploads/' part from the filename if present
+            file_name = file_name.replace("uploads/", "")
 
-        if file_name not in seen_filenames:
-            filenames.append(file_name)
-            seen_filenames.add(file_name)
+            if file_name not in seen_filenames:
+                filenames.append(file_name)
+                seen_filenames.add(file_name)
 
     return filenames
@@ -0,0 +1,89 @@
+import logging
+
+from config import load_config
+from near_duplicates import shingles
+
+config = load_config("config.yaml")
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Context window of the chat model, and the part of it left for the answer
+CHAT_CONTEXT_TOKENS = config.get("CHAT_CONTEXT_TOKENS", 4096)
+CHAT_ANSWER_TOKENS = config.get("CHAT_ANSWER_TOKENS", 512)
+# Chat message framing the tokenizer doesn't see
+PROMPT_OVERHEAD_TOKENS = 16
+# A chunk sharing this fraction of its word shingles with one already packed is skipped
+REDUNDANCY_THRESHOLD = config.get("CONTEXT_REDUNDANCY_THRESHOLD", 0.8)
+SHINGLE_SIZE = 3
+PROMPT_BUDGET = CHAT_CONTEXT_TOKENS - CHAT_ANSWER_TOKENS
+
+
+def fits_budget(prompt_tokens: int, budget: int = PROMPT_BUDGET) -> bool:
+    return prompt_tokens + PROMPT_OVERHEAD_TOKENS <= budget
+
+
+def is_redundant(candidate: set, packed: list) -> bool:
+    for other in packed:
+        overlap = len(candidate & other)
+        if overlap and overlap / min(len(candidate),
+                                     len(other)) >= REDUNDANCY_THRESHOLD:
+            return True
+    return False
+
+
+def pack_context(chunks: list,
+                 fixed_tokens: int,
+                 chunk_tokens,
+                 budget: int = PROMPT_BUDGET):
+    """
+    Choose the chunks that go into the prompt, before calling the model.
+
+    Chunks are taken by descending score, skipping the ones mostly repeating a
+    chunk already taken and the ones that don't fit in what is left of the budget.
+
+    :param chunks: [(score, text)]
+    :param fixed_tokens: Tokens of the prompt without any chunk.
+    :param chunk_tokens: callable(text) -> tokens the chunk adds to the prompt.
+    :return: indices of the chosen chunks, best first.
+    """
+    remaining = budget - fixed_tokens - PROMPT_OVERHEAD_TOKENS
+    chosen = []
+    packed_shingles = []
+    for position in sorted(range(len(chunks)),
+                           key=lambda i: chunks[i][0],
+                           reverse=True):
+        text = chunks[position][1]
+        candidate = shingles(text, SHINGLE_SIZE)
+        if is_redundant(candidate, packed_shingles):
+            logger.info(f"Skipping chunk {position}, redundant")
+            continue
+        tokens = chunk_tokens(text)
+        if tokens > remaining:
+            continue
+        remaining -= tokens
+        chosen.append(position)
+        packed_shingles.append(candidate)
+    logger.info(
+        f"Packed {len(chosen)} of {len(chunks)} chunks, {remaining} tokens to spare"
+    )
+    return chosen
+
+
+def fit_history(chat_history: list,
+                fixed_tokens: int,
+                message_tokens,
+                budget: int = PROMPT_BUDGET):
+    """
+    Drop the oldest messages until the prompt without chunks fits the budget.
+
+    :param fixed_tokens: Tokens of the prompt with the whole chat_history.
+    :return: (kept messages, tokens of the prompt with them)
+    """
+    dropped = 0
+    while not fits_budget(fixed_tokens,
+                          budget) and dropped < len(chat_history):
+        fixed_tokens -= message_tokens(chat_history[dropped]) + 1
+        dropped += 1
+    return chat_history[dropped:], fixed_tokens
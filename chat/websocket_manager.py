@@ -1,14 +1,25 @@
+import json
+import logging
 from typing import Dict
+from fastapi import HTTPException
 from fastapi import WebSocket
 from fastapi import WebSocket, WebSocketDisconnect
-from redis_config import get_redis
+from starlette.websockets import WebSocketState
+
+from chat.chat_streaming import iter_chat_answer
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 class ConnectionManager:
     def __init__(self):
         self.active_connections: Dict[str, WebSocket] = {}
 
     async def connect(self, websocket: WebSocket, user_id: str):
-        await websocket.accept()
+        # Already accepted when the token came as the first frame
+        if websocket.client_state == WebSocketState.CONNECTING:
+            await websocket.accept()
         self.active_connections[user_id] = websocket
 
     def disconnect(self, user_id: str):
@@ -21,15 +32,56 @@ class ConnectionManager:
 
 manager = ConnectionManager()
 
-async def handle_websocket(websocket: WebSocket, user_id: str):
+async def handle_websocket(websocket: WebSocket, user_id):
+    """
+    user_id must be the authenticated user (see websocket_endpoint in app.py).
+
+    Each text frame received is a chat message, either plain text or JSON
+    {"user_input": ..., "file_name": ..., "conversation_id": ...}. The answer is streamed back as JSON
+    frames: {"type": "token", "token": ...} per token, then
+    {"type": "done", "response": ...}, or {"type": "error", ...}.
+    """
     await manager.connect(websocket, user_id)
     try:
         while True:
             data = await websocket.receive_text()
-            # Get the global Redis connection and use it
-            async with get_redis() as r:
-                # Store message in Redis
-                await r.lpush(f"chat:{user_id}", data)
-            await manager.send_message(f"Message text was: {data}", user_id)
+            try:
+                message = json.loads(data)
+            except ValueError:
+                message = None
+            if not isinstance(message, dict):
+                message = {"user_input": data}
+            tokens = []
+            try:
+                async for token in iter_chat_answer(user_id,
+                                                    message.get("user_input", ""),
+                                                    message.get("file_name"),
+                                                    message.get("conversation_id")):
+                    tokens.append(token)
+                    await websocket.send_json({"type": "token", "token": token})
+            except HTTPException as e:
+                await websocket.send_json({
+                    "type": "error",
+                    "status_code": e.status_code,
+                    "detail": e.detail
+                })
+                continue
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                # e.g. Redis errors reading or saving the chat history
+                logger.error(f"Error while streaming response: {e}")
+                await websocket.send_json({
+                    "type": "error",
+                    "status_code": 500,
+                    "detail": "Unable to process the request."
+                })
+                continue
+            await websocket.send_json({
+                "type": "done",
+                "response": "".join(tokens)
+            })
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(user_id)
@@ -0,0 +1,223 @@
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+
+from config import load_config
+
+config = load_config("config.yaml")
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Files are <path>.dat (chunk texts) and <path>.idx (offset index)
+CHUNK_STORE_PATH = config.get("CHUNK_STORE_PATH", "chunk_store")
+
+# Index entry: id length, data offset, data length, then the id itself
+INDEX_ENTRY = struct.Struct("<HQI")
+# Data length marking a deleted chunk
+TOMBSTONE = 0xFFFFFFFF
+
+
+class ChunkStore:
+    """
+    Append-only store of chunk texts keyed by chunk (vector) id.
+
+    Texts are appended to one data file and located through an append-only
+    offset index; deletes append tombstones. Reads go through a memory map of
+    the data file. Writers from every process serialize on an exclusive file
+    lock and readers hold a shared one; entries appended by other processes are
+    picked up by reading the new tail of the index. compact() rewrites both
+    files without the deleted chunks.
+    """
+
+    def __init__(self, path: str = CHUNK_STORE_PATH):
+        self.data_path = f"{path}.dat"
+        self.index_path = f"{path}.idx"
+        self.lock_path = f"{path}.lock"
+        self._lock = threading.Lock()
+        self._offsets = {}  # chunk id -> (offset, length)
+        self._index_position = 0
+        self._index_inode = None
+        self._dead_bytes = 0
+        self._data_file = None
+        self._data_map = None
+        for file_path in (self.data_path, self.index_path):
+            open(file_path, "ab").close()
+
+    @contextmanager
+    def _file_lock(self, shared: bool = False):
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # Must be called with self._lock held
+    def _refresh(self):
+        stat = os.stat(self.index_path)
+        if stat.st_ino != self._index_inode:
+            # First load, or the files were replaced by compact()
+            self._offsets.clear()
+            self._index_position = 0
+            self._index_inode = stat.st_ino
+            self._dead_bytes = 0
+            self._close_data()
+        if stat.st_size <= self._index_position:
+            return
+        with open(self.index_path, "rb") as f:
+            f.seek(self._index_position)
+            tail = f.read(stat.st_size - self._index_position)
+        position = 0
+        # An entry being written by another process may be incomplete, stop before it
+        while position + INDEX_ENTRY.size <= len(tail):
+            id_length, offset, length = INDEX_ENTRY.unpack_from(tail, position)
+            end = position + INDEX_ENTRY.size + id_length
+            if end > len(tail):
+                break
+            chunk_id = tail[position + INDEX_ENTRY.size:end].decode("utf-8")
+            previous = self._offsets.pop(chunk_id, None)
+            if previous:
+                self._dead_bytes += previous[1]
+            if length != TOMBSTONE:
+                self._offsets[chunk_id] = (offset, length)
+            position = end
+        self._index_position += position
+
+    # Must be called with self._lock held
+    def _data_view(self, end: int):
+        if not end:
+            return b""
+        if self._data_map is None or len(self._data_map) < end:
+            self._close_data()
+            self._data_file = open(self.data_path, "rb")
+            self._data_map = mmap.mmap(self._data_file.fileno(),
+                                       0,
+                                       access=mmap.ACCESS_READ)
+        return self._data_map
+
+    def _close_data(self):
+        if self._data_map is not None:
+            self._data_map.close()
+            self._data_file.close()
+        self._data_map = None
+        self._data_file = None
+
+    def get_many(self, chunk_ids: list) -> dict:
+        """
+        :return: {chunk_id: text} for every id found in the store.
+        """
+        # Shared lock: compact() can't swap the files in the middle of a read
+        with self._file_lock(shared=True), self._lock:
+            self._refresh()
+            located = [(chunk_id, self._offsets[chunk_id])
+                       for chunk_id in chunk_ids if chunk_id in self._offsets]
+            if not located:
+                return {}
+            view = self._data_view(
+                max(offset + length for _, (offset, length) in located))
+            return {
+                chunk_id: view[offset:offset + length].decode("utf-8")
+                for chunk_id, (offset, length) in located
+            }
+
+    def get(self, chunk_id: str):
+        return self.get_many([chunk_id]).get(chunk_id)
+
+    def put_many(self, chunks: dict):
+        """
+        Append {chunk_id: text}. A chunk id already in the store is overwritten.
+        """
+        if not chunks:
+            return
+        with self._file_lock(), self._lock:
+            self._refresh()
+            entries = []
+            with open(self.data_path, "ab") as data_file:
+                offset = data_file.seek(0, os.SEEK_END)
+                payload = []
+                for chunk_id, text in chunks.items():
+                    data = text.encode("utf-8")
+                    payload.append(data)
+                    entries.append((chunk_id, offset, len(data)))
+                    offset += len(data)
+                data_file.write(b"".join(payload))
+            # Data is written before the index entries that point to it
+            self._append_index(entries)
+
+    def put(self, chunk_id: str, text: str):
+        self.put_many({chunk_id: text})
+
+    def delete(self, chunk_ids: list):
+        with self._file_lock(), self._lock:
+            self._refresh()
+            self._append_index([(chunk_id, 0, TOMBSTONE)
+                                for chunk_id in chunk_ids
+                                if chunk_id in self._offsets])
+
+    # Must be called with both locks held
+    def _append_index(self, entries: list):
+        if not entries:
+            return
+        records = []
+        for chunk_id, offset, length in entries:
+            encoded_id = chunk_id.encode("utf-8")
+            records.append(
+                INDEX_ENTRY.pack(len(encoded_id), offset, length) +
+                encoded_id)
+        with open(self.index_path, "ab") as index_file:
+            index_file.write(b"".join(records))
+        self._refresh()
+
+    def stats(self) -> dict:
+        with self._file_lock(shared=True), self._lock:
+            self._refresh()
+            return {
+                "chunks": len(self._offsets),
+                "live_bytes": sum(length
+                                  for _, length in self._offsets.values()),
+                "dead_bytes": self._dead_bytes,
+            }
+
+    def compact(self):
+        """
+        Rewrite the store without deleted or overwritten chunks.
+        """
+        with self._file_lock(), self._lock:
+            self._refresh()
+            if not self._dead_bytes:
+                return
+            live = sorted(self._offsets.items(), key=lambda item: item[1][0])
+            view = self._data_view(
+                max((offset + length for _, (offset, length) in live),
+                    default=0))
+            entries = []
+            offset = 0
+            with open(f"{self.data_path}.compact", "wb") as data_file:
+                for chunk_id, (old_offset, length) in live:
+                    data_file.write(view[old_offset:old_offset + length])
+                    entries.append((chunk_id, offset, length))
+                    offset += length
+            with open(f"{self.index_path}.compact", "wb") as index_file:
+                for chunk_id, chunk_offset, length in entries:
+                    encoded_id = chunk_id.encode("utf-8")
+                    index_file.write(
+                        INDEX_ENTRY.pack(len(encoded_id), chunk_offset,
+                                         length) + encoded_id)
+            dead_bytes = self._dead_bytes
+            self._close_data()
+            # Data first: a reader that sees the new index must find the new data
+            os.replace(f"{self.data_path}.compact", self.data_path)
+            os.replace(f"{self.index_path}.compact", self.index_path)
+            self._refresh()
+        logger.info(
+            f"Compacted chunk store, {len(entries)} chunks kept, {dead_bytes} bytes freed"
+        )
+
+
+chunk_store = ChunkStore()
@@ -0,0 +1,360 @@
+import hashlib
+import sqlite3
+import time
+from contextlib import closing
+
+from config import load_config
+
+config = load_config("config.yaml")
+
+CONTENT_REGISTRY_PATH = config.get("CONTENT_REGISTRY_PATH",
+                                   "content_registry.db")
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def hash_file(file_path: str, block_size: int = 1024 * 1024) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class ContentRegistry:
+    """
+    Content-addressed index of what has already been ingested.
+
+    files:       sha256 of the uploaded bytes -> file_unique_id
+    chunks:      sha256 of a chunk's text     -> id of a vector holding its embedding
+    file_chunks: the vectors (and their chunk hashes) that make up each file, in order
+    pending_files / pending_vectors: ingestions in progress and the vectors they
+        wrote so far, so a failed or interrupted ingestion can be rolled back
+    chunk_sketches / chunk_bands: MinHash signature and LSH band keys of stored
+        chunks, to find near-duplicates (see near_duplicates.py)
+    chunk_links: chunks of a file that repeat another stored chunk -> that chunk's vector
+
+    Backed by SQLite so every worker process sees the same registry.
+    """
+
+    def __init__(self, path: str = CONTENT_REGISTRY_PATH):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS files (
+                    content_hash TEXT PRIMARY KEY,
+                    file_id TEXT NOT NULL,
+                    file_name TEXT,
+                    created_at REAL)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS chunks (
+                    chunk_hash TEXT PRIMARY KEY,
+                    vector_id TEXT NOT NULL)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS file_chunks (
+                    file_id TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    vector_id TEXT NOT NULL,
+                    chunk_hash TEXT NOT NULL,
+                    PRIMARY KEY (file_id, position))""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS pending_files (
+                    file_id TEXT PRIMARY KEY,
+                    file_name TEXT NOT NULL,
+                    is_new INTEGER NOT NULL,
+                    started_at REAL NOT NULL)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS pending_vectors (
+                    file_id TEXT NOT NULL,
+                    vector_id TEXT NOT NULL)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS chunk_sketches (
+                    vector_id TEXT PRIMARY KEY,
+                    signature BLOB NOT NULL)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS chunk_bands (
+                    band_key INTEGER NOT NULL,
+                    vector_id TEXT NOT NULL)""")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS chunk_bands_key ON chunk_bands (band_key)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS chunk_bands_vector ON chunk_bands (vector_id)"
+            )
+            conn.execute("""CREATE TABLE IF NOT EXISTS chunk_links (
+                    file_id TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    canonical_id TEXT NOT NULL,
+                    PRIMARY KEY (file_id, position))""")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS chunk_links_canonical ON chunk_links (canonical_id)"
+            )
+
+    def _connect(self):
+        return closing(sqlite3.connect(self.path, timeout=30))
+
+    def get_file_id(self, content_hash: str):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT file_id FROM files WHERE content_hash = ?",
+                (content_hash, )).fetchone()
+        return row[0] if row else None
+
+    # A file id holds one version of the content, a new version replaces the old hash
+    def add_file(self, content_hash: str, file_id: str, file_name: str):
+        with self._connect() as conn, conn:
+            conn.execute("DELETE FROM files WHERE file_id = ?", (file_id, ))
+            conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                (content_hash, file_id, file_name, time.time()),
+            )
+
+    def remove_file(self, file_id: str):
+        with self._connect() as conn, conn:
+            conn.execute("DELETE FROM files WHERE file_id = ?", (file_id, ))
+            conn.execute("DELETE FROM file_chunks WHERE file_id = ?",
+                         (file_id, ))
+            conn.execute("DELETE FROM chunk_links WHERE file_id = ?",
+                         (file_id, ))
+
+    def get_file_ids(self, created_before: float = None) -> set:
+        """
+        :param created_before: Leave out files registered at or after this time.
+        :return: ids of the files in the registry, without the ones still being
+            ingested.
+        """
+        if created_before is None:
+            created_before = float("inf")
+        with self._connect() as conn:
+            return {
+                row[0]
+                for row in conn.execute(
+                    """SELECT file_id FROM files WHERE created_at < ?
+                    UNION SELECT file_id FROM file_chunks WHERE file_id NOT IN (
+                        SELECT file_id FROM files WHERE created_at >= ?)
+                    EXCEPT SELECT file_id FROM pending_files""",
+                    (created_before, created_before))
+            }
+
+    def get_chunk_vector_ids(self, chunk_hashes: list) -> dict:
+        found = {}
+        unique_hashes = list(set(chunk_hashes))
+        with self._connect() as conn:
+            # Stay under SQLite's bound-parameter limit
+            for start in range(0, len(unique_hashes), 500):
+                batch = unique_hashes[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                found.update(
+                    conn.execute(
+                        f"SELECT chunk_hash, vector_id FROM chunks WHERE chunk_hash IN ({placeholders})",
+                        batch,
+                    ).fetchall())
+        return found
+
+    def add_chunks(self, chunk_vector_ids: dict):
+        with self._connect() as conn, conn:
+            conn.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?)",
+                             chunk_vector_ids.items())
+
+    # Forget chunk -> vector entries, sketches and links to vectors that were deleted
+    def remove_vectors(self, vector_ids: list):
+        rows = [(vector_id, ) for vector_id in vector_ids]
+        with self._connect() as conn, conn:
+            conn.executemany("DELETE FROM chunks WHERE vector_id = ?", rows)
+            conn.executemany("DELETE FROM chunk_sketches WHERE vector_id = ?",
+                             rows)
+            conn.executemany("DELETE FROM chunk_bands WHERE vector_id = ?",
+                             rows)
+            conn.executemany(
+                "DELETE FROM chunk_links WHERE canonical_id = ?", rows)
+
+    def add_sketches(self, sketches: dict):
+        """
+        :param sketches: {vector_id: (MinHash signature, LSH band keys)}
+        """
+        with self._connect() as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO chunk_sketches VALUES (?, ?)",
+                [(vector_id, signature.tobytes())
+                 for vector_id, (signature, _) in sketches.items()])
+            conn.executemany("INSERT INTO chunk_bands VALUES (?, ?)",
+                             [(key, vector_id)
+                              for vector_id, (_, keys) in sketches.items()
+                              for key in keys])
+
+    def get_band_matches(self, band_keys: list) -> dict:
+        """
+        :return: {band_key: [vector ids of the chunks in that bucket]}
+        """
+        matches = {}
+        unique_keys = list(set(band_keys))
+        with self._connect() as conn:
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                for key, vector_id in conn.execute(
+                        f"SELECT band_key, vector_id FROM chunk_bands WHERE band_key IN ({placeholders})",
+                        batch,
+                ):
+                    matches.setdefault(key, []).append(vector_id)
+        return matches
+
+    def get_sketches(self, vector_ids) -> dict:
+        found = {}
+        vector_ids = list(vector_ids)
+        with self._connect() as conn:
+            for start in range(0, len(vector_ids), 500):
+                batch = vector_ids[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                found.update(
+                    conn.execute(
+                        f"SELECT vector_id, signature FROM chunk_sketches WHERE vector_id IN ({placeholders})",
+                        batch,
+                    ).fetchall())
+        return found
+
+    def set_chunk_links(self, file_id: str, links: list):
+        """
+        :param links: [(position, canonical vector id)] of the file's near-duplicate chunks
+        """
+        with self._connect() as conn, conn:
+            conn.execute("DELETE FROM chunk_links WHERE file_id = ?",
+                         (file_id, ))
+            conn.executemany("INSERT INTO chunk_links VALUES (?, ?, ?)",
+                             [(file_id, position, canonical_id)
+                              for position, canonical_id in links])
+
+    def get_linked_file_ids(self, vector_ids) -> dict:
+        """
+        :return: {vector_id: [ids of files with a chunk linked to it]}
+        """
+        linked = {}
+        vector_ids = list(set(vector_ids))
+        with self._connect() as conn:
+            for start in range(0, len(vector_ids), 500):
+                batch = vector_ids[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                for canonical_id, file_id in conn.execute(
+                        f"SELECT DISTINCT canonical_id, file_id FROM chunk_links WHERE canonical_id IN ({placeholders})",
+                        batch,
+                ):
+                    linked.setdefault(canonical_id, []).append(file_id)
+        return linked
+
+    def get_file_links(self, file_id: str) -> list:
+        """
+        :return: [(position, canonical vector id)] of the file's near-duplicate chunks.
+        """
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT position, canonical_id FROM chunk_links WHERE file_id = ? ORDER BY position",
+                (file_id, ),
+            ).fetchall()
+
+    def get_unreferenced_vectors(self, vector_ids) -> list:
+        """
+        :return: the vector_ids no file's chunks are stored in or linked to.
+        """
+        unreferenced = []
+        vector_ids = list(set(vector_ids))
+        with self._connect() as conn:
+            for start in range(0, len(vector_ids), 500):
+                batch = vector_ids[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                referenced = {
+                    row[0]
+                    for row in conn.execute(
+                        f"""SELECT vector_id FROM file_chunks WHERE vector_id IN ({placeholders})
+                        UNION SELECT canonical_id FROM chunk_links WHERE canonical_id IN ({placeholders})""",
+                        batch + batch,
+                    )
+                }
+                unreferenced += [
+                    vector_id for vector_id in batch
+                    if vector_id not in referenced
+                ]
+        return unreferenced
+
+    def get_file_chunks(self, file_id: str) -> list:
+        """
+        :return: [(vector_id, chunk_hash)] in chunk order.
+        """
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT vector_id, chunk_hash FROM file_chunks WHERE file_id = ? ORDER BY position",
+                (file_id, ),
+            ).fetchall()
+
+    def get_chunk_page(self,
+                       after: tuple = None,
+                       limit: int = 1000,
+                       file_id: str = None) -> list:
+        """
+        One page of every file's vectors, ordered by (file_id, position).
+
+        :param after: (file_id, position) of the last row of the previous page.
+        :param file_id: Only page through this file.
+        :return: [(file_id, position, vector_id)]
+        """
+        conditions = []
+        params = []
+        if file_id is not None:
+            conditions.append("file_id = ?")
+            params.append(file_id)
+        if after is not None:
+            conditions.append("(file_id, position) > (?, ?)")
+            params.extend(after)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._connect() as conn:
+            return conn.execute(
+                f"SELECT file_id, position, vector_id FROM file_chunks {where} "
+                "ORDER BY file_id, position LIMIT ?",
+                (*params, limit),
+            ).fetchall()
+
+    def set_file_chunks(self, file_id: str, chunks: list):
+        with self._connect() as conn, conn:
+            conn.execute("DELETE FROM file_chunks WHERE file_id = ?",
+                         (file_id, ))
+            conn.executemany(
+                "INSERT INTO file_chunks VALUES (?, ?, ?, ?)",
+                [(file_id, position, vector_id, chunk_hash)
+                 for position, (vector_id, chunk_hash) in enumerate(chunks)],
+            )
+
+    def start_pending(self, file_id: str, file_name: str, is_new: bool):
+        with self._connect() as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO pending_files VALUES (?, ?, ?, ?)",
+                (file_id, file_name, int(is_new), time.time()),
+            )
+
+    def add_pending_vectors(self, file_id: str, vector_ids: list):
+        with self._connect() as conn, conn:
+            conn.executemany("INSERT INTO pending_vectors VALUES (?, ?)",
+                             [(file_id, vector_id)
+                              for vector_id in vector_ids])
+
+    def get_pending_vectors(self, file_id: str) -> list:
+        with self._connect() as conn:
+            return [
+                row[0] for row in conn.execute(
+                    "SELECT vector_id FROM pending_vectors WHERE file_id = ?",
+                    (file_id, ))
+            ]
+
+    def finish_pending(self, file_id: str):
+        with self._connect() as conn, conn:
+            conn.execute("DELETE FROM pending_files WHERE file_id = ?",
+                         (file_id, ))
+            conn.execute("DELETE FROM pending_vectors WHERE file_id = ?",
+                         (file_id, ))
+
+    def get_stale_pending(self, started_before: float) -> list:
+        """
+        :return: [(file_id, file_name, is_new)] of ingestions started before the given time.
+        """
+        with self._connect() as conn:
+            return [(file_id, file_name, bool(is_new))
+                    for file_id, file_name, is_new in conn.execute(
+                        "SELECT file_id, file_name, is_new FROM pending_files WHERE started_at < ?",
+                        (started_before, ))]
+
+
+content_registry = ContentRegistry()
@@ -4,6 +4,7 @@ from fastapi import status
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
+from models import File
 from models import UserFile
 from models import UserIn
 from models import UserOut
@@ -34,7 +35,7 @@ def get_user(db: Session, username: str):
 
 def add_file_to_user(db: Session, user_id: str, file_id: str):
     # Check if the file with the provided file_id exists in the database
-    file = db.query(UserFile).filter(UserFile.file_id == file_id).first()
+    file = db.query(File).filter(File.file_id == file_id).first()
     if not file:
         raise HTTPException(status_code=404, detail="File not found")
 
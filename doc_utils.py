@@ -3,6 +3,16 @@ import logging
 import os
 from functools import lru_cache
 
+import numpy as np
+
+from chunk_store import chunk_store
+from content_registry import content_registry
+from file_catalog import file_catalog
+from near_duplicates import NEAR_DUPLICATE_MODE
+from near_duplicates import collapse_duplicates
+from retrieval_cache import retrieval_cache
+from retrieval_cache import to_plain_response
+
 # UTILS
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -16,15 +26,43 @@ def search_documents_by_file_name(index,
                                   top_k=5,
                                   include_metadata=True):
     file_name_filter = None
+    linked_ids = []
     if file_name:
-        file_name_filter = {"file_name": {"$eq": file_name}}
+        # Duplicate uploads share the vectors of the first copy, so filter on
+        # the file id the name points to rather than the stored file_name
+        file_id = file_catalog.get_file_id(file_name)
+        if file_id:
+            file_name_filter = {"file_id": {"$eq": file_id}}
+            # Near-duplicate chunks of the file may only exist as another
+            # file's vector (see near_duplicates.py), the filter misses those
+            linked_ids = [
+                canonical_id for _, canonical_id in
+                content_registry.get_file_links(file_id)
+            ]
+        else:
+            file_name_filter = {"file_name": {"$eq": file_name}}
+    # Flagged near-duplicates are collapsed into one match, fetch extra to fill top_k
+    fetch_k = top_k * 2 if NEAR_DUPLICATE_MODE == "flag" else top_k
     response = query_pinecone(
         index,
         query_embedding_tuple,
-        top_k=top_k,
+        top_k=fetch_k,
         filter_dict=file_name_filter,
         include_metadata=include_metadata,
     )
+    matches = response["matches"]
+    if linked_ids:
+        found = {match["id"] for match in matches}
+        matches = sorted(
+            matches + [
+                match for match in query_linked_chunks(
+                    index, query_embedding_tuple, linked_ids, fetch_k,
+                    include_metadata) if match["id"] not in found
+            ],
+            key=lambda match: match["score"],
+            reverse=True,
+        )
+    response = {"matches": collapse_duplicates(matches, top_k)}
     logger.info(f"search_documents_by_file_name response ready: {response}")
     return response
 
@@ -34,43 +72,100 @@ def query_pinecone(index,
                    top_k=5,
                    filter_dict=None,
                    include_metadata=True):
+    """
+    Query the vector index, through the shared retrieval cache (see retrieval_cache.py).
+
+    :return: {"matches": [{"id", "score", "metadata"}]}
+    """
     logger.info(f"Query pinecone filter_dict: {filter_dict}")
+    cache_key = retrieval_cache.key(query_embedding_tuple, top_k, filter_dict,
+                                    include_metadata)
+    response = retrieval_cache.get(cache_key)
+    if response is not None:
+        return response
     # Convert the tuple back to a list
     query_embedding = list(query_embedding_tuple)
-    response = index.query(
-        query_embedding,
-        top_k=top_k,
-        filter=filter_dict,
-        include_metadata=include_metadata,
-    )
+    response = to_plain_response(
+        index.query(
+            query_embedding,
+            top_k=top_k,
+            filter=filter_dict,
+            include_metadata=include_metadata,
+        ))
+    retrieval_cache.put(cache_key, response)
     return response
 
 
-def update_filenames_json(file_name: str, file_unique_id: str):
-    file_path = "filenames.json"
+def query_linked_chunks(index,
+                        query_embedding_tuple,
+                        vector_ids: list,
+                        top_k=5,
+                        include_metadata=True,
+                        batch_size: int = 1000):
+    """
+    Score the given vectors against the query by fetching them, for chunks
+    that can't be reached through a metadata filter.
 
-    # Check if the file exists and is not empty
-    if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
-        # Read the existing content
-        with open(file_path, "r") as f:
-            try:
-                filenames = json.load(f)
-            except json.JSONDecodeError:
-                # If there is a decoding error, initialize an empty dictionary
-                filenames = {}
-    else:
-        # If the file doesn't exist or is empty, initialize an empty dictionary
-        filenames = {}
+    :return: [{"id", "score", "metadata"}] of the top_k best, best first.
+    """
+    query = np.asarray(query_embedding_tuple, dtype=np.float32)
+    query /= np.linalg.norm(query) or 1.0
+    matches = []
+    unique_ids = list(dict.fromkeys(vector_ids))
+    for start in range(0, len(unique_ids), batch_size):
+        fetched = index.fetch(ids=unique_ids[start:start +
+                                             batch_size])["vectors"]
+        for vector_id, vector in fetched.items():
+            values = np.asarray(vector["values"], dtype=np.float32)
+            # Cosine similarity, the metric of the index
+            score = float(values @ query) / (np.linalg.norm(values) or 1.0)
+            match = {"id": vector_id, "score": score}
+            if include_metadata:
+                match["metadata"] = dict(vector.get("metadata") or {})
+            matches.append(match)
+    matches.sort(key=lambda match: match["score"], reverse=True)
+    return matches[:top_k]
 
-    # Update the dictionary with the new file name and unique ID
-    filenames[file_name] = file_unique_id
 
-    # Save the updated dictionary back to the file
-    with open(file_path, "w") as f:
-        json.dump(filenames, f)
+def get_match_texts(matches) -> list:
+    """
+    Chunk texts of query matches, read in one go from the chunk store.
+    Vectors upserted before the chunk store still carry their text in metadata.
+    """
+    texts = chunk_store.get_many([match["id"] for match in matches])
+    return [
+        texts.get(match["id"]) or match.get("metadata", {}).get("text", "")
+        for match in matches
+    ]
 
 
-# Fetch 10k
-def fetchTopK(index):
-    response = index.query(vector=[0] * 1536, top_k=10000, include_values=True)
-    return response
+def get_match_file_names(matches) -> list:
+    """
+    :return: the file name(s) of each match, in match order. Files with a
+        near-duplicate of the match's chunk are included (see near_duplicates.py).
+    """
+    groups = [
+        match.get("metadata", {}).get("duplicate_of") or match["id"]
+        for match in matches
+    ]
+    linked = content_registry.get_linked_file_ids(groups)
+    file_ids = {
+        match["metadata"]["file_id"]
+        for match in matches if "file_id" in match.get("metadata", {})
+    }
+    file_ids.update(file_id for linked_ids in linked.values()
+                    for file_id in linked_ids)
+    names = file_catalog.get_names(file_ids)
+    file_names = []
+    for match, group in zip(matches, groups):
+        metadata = match.get("metadata", {})
+        if "file_name" in metadata:
+            match_names = [metadata["file_name"]]
+        else:
+            match_names = list(names.get(metadata.get("file_id"), []))
+        for file_id in linked.get(group, []):
+            match_names.extend(name for name in names.get(file_id, [])
+                               if name not in match_names)
+        file_names.append(match_names)
+    return file_names
+
@@ -0,0 +1,143 @@
+import hashlib
+import logging
+import sqlite3
+import time
+from array import array
+from contextlib import closing
+
+from config import load_config
+
+config = load_config("config.yaml")
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_PATH = config.get("EMBEDDING_CACHE_PATH",
+                                  "embedding_cache.db")
+# ada-002 vectors take ~6KB each, 100k entries is roughly 600MB on disk
+EMBEDDING_CACHE_MAX_ENTRIES = config.get("EMBEDDING_CACHE_MAX_ENTRIES",
+                                         100_000)
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split())
+
+
+def cache_key(text: str, model: str) -> str:
+    return hashlib.sha256(
+        f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache shared by every worker process.
+
+    Keyed by model name plus whitespace-normalized text and stored in SQLite as
+    float32 blobs. When the cache grows past max_entries the least recently
+    used entries are evicted. Hit/miss counters live in the same database so
+    they cover all workers.
+    """
+
+    def __init__(self,
+                 path: str = EMBEDDING_CACHE_PATH,
+                 max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        with self._connect() as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    last_used REAL NOT NULL)""")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+            )
+            conn.execute("""CREATE TABLE IF NOT EXISTS stats (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL)""")
+            conn.executemany("INSERT OR IGNORE INTO stats VALUES (?, 0)",
+                             [("hits", ), ("misses", )])
+
+    def _connect(self):
+        return closing(sqlite3.connect(self.path, timeout=30))
+
+    def get_many(self, texts: list, model: str) -> dict:
+        """
+        :return: {position in texts: embedding} for every text found in the cache.
+        """
+        keys = [cache_key(text, model) for text in texts]
+        unique_keys = list(set(keys))
+        found = {}
+        with self._connect() as conn, conn:
+            # Stay under SQLite's bound-parameter limit
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                for key, blob in conn.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                        batch,
+                ):
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+            now = time.time()
+            conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                             [(now, key) for key in found])
+            hits = sum(1 for key in keys if key in found)
+            conn.execute(
+                "UPDATE stats SET value = value + ? WHERE name = 'hits'",
+                (hits, ))
+            conn.execute(
+                "UPDATE stats SET value = value + ? WHERE name = 'misses'",
+                (len(keys) - hits, ))
+        return {
+            idx: found[key]
+            for idx, key in enumerate(keys) if key in found
+        }
+
+    def get(self, text: str, model: str):
+        return self.get_many([text], model).get(0)
+
+    def put_many(self, texts: list, embeddings: list, model: str):
+        now = time.time()
+        rows = [(cache_key(text, model), model,
+                 array("f", embedding).tobytes(), now)
+                for text, embedding in zip(texts, embeddings)]
+        with self._connect() as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            self._evict(conn)
+
+    def put(self, text: str, embedding: list, model: str):
+        self.put_many([text], [embedding], model)
+
+    def _evict(self, conn):
+        count = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        # Evict 10% below the limit so we don't evict on every insert
+        excess = count - int(self.max_entries * 0.9)
+        conn.execute(
+            "DELETE FROM embeddings WHERE key IN "
+            "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+            (excess, ),
+        )
+        logger.info(f"Evicted {excess} entries from the embedding cache")
+
+    def stats(self) -> dict:
+        with self._connect() as conn:
+            counters = dict(conn.execute("SELECT name, value FROM stats"))
+            entries = conn.execute(
+                "SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        lookups = counters["hits"] + counters["misses"]
+        return {
+            "hits": counters["hits"],
+            "misses": counters["misses"],
+            "hit_rate": counters["hits"] / lookups if lookups else 0.0,
+            "entries": entries,
+        }
+
+
+embedding_cache = EmbeddingCache()
@@ -0,0 +1,221 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from config import load_config
+from database import SessionLocal
+from models import File
+from models import UserFile
+
+config = load_config("config.yaml")
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Other worker processes write to the catalog too, so cached lookups expire
+# even though this process invalidates them on its own writes
+FILE_CATALOG_CACHE_TTL_SECONDS = config.get("FILE_CATALOG_CACHE_TTL_SECONDS",
+                                            30)
+FILE_LIST_MAX_PAGE_SIZE = 500
+
+
+class FileCatalog:
+    """
+    Catalog of uploaded files: file name -> file_unique_id, content hash and owner.
+
+    Stored in the files/user_files tables. Several names can point to the same
+    file id when their content is identical (see deduplication in ingest_files).
+    Name lookups go through an in-process cache that is cleared on every write.
+    """
+
+    def __init__(self,
+                 session_factory=SessionLocal,
+                 cache_ttl: float = FILE_CATALOG_CACHE_TTL_SECONDS):
+        self.session_factory = session_factory
+        self.cache_ttl = cache_ttl
+        self._cache = {}  # file_name -> (file_id or None, cached_at)
+        self._lock = threading.Lock()
+
+    def _invalidate(self):
+        with self._lock:
+            self._cache.clear()
+
+    def get_file_id(self, file_name: str):
+        with self._lock:
+            cached = self._cache.get(file_name)
+        if cached and time.monotonic() - cached[1] < self.cache_ttl:
+            return cached[0]
+        with self.session_factory() as db:
+            file_id = db.query(File.file_id).filter(
+                File.file_name == file_name).scalar()
+        with self._lock:
+            self._cache[file_name] = (file_id, time.monotonic())
+        return file_id
+
+    def can_replace(self, file_name: str, owner_id: int = None) -> bool:
+        """
+        Whether an upload by owner_id may take file_name: the name is new, or
+        belongs to the same owner. Anonymous uploads only replace anonymous ones.
+        """
+        with self.session_factory() as db:
+            row = db.query(
+                File.owner_id).filter(File.file_name == file_name).first()
+        return row is None or row[0] == owner_id
+
+    def register(self,
+                 file_name: str,
+                 file_id: str,
+                 content_hash: str = None,
+                 owner_id: int = None):
+        """
+        Point file_name at file_id, replacing what it pointed to before, and give
+        the owner access to the file. Runs in a single transaction. When the name
+        pointed at another file id no other name points to, that id's
+        user_files rows go too.
+
+        :return: (file_id the name pointed to before or None, whether other
+            names still point to it)
+        """
+        for attempt in range(2):
+            with self.session_factory() as db:
+                try:
+                    file = (db.query(File).filter(
+                        File.file_name == file_name).with_for_update().first())
+                    if file is None:
+                        file = File(file_name=file_name)
+                        db.add(file)
+                    previous_file_id = file.file_id
+                    file.file_id = file_id
+                    file.content_hash = content_hash or file.content_hash
+                    file.owner_id = owner_id or file.owner_id
+                    if owner_id and not db.query(UserFile.id).filter(
+                            UserFile.user_id == owner_id,
+                            UserFile.file_id == file_id).first():
+                        db.add(UserFile(user_id=owner_id, file_id=file_id))
+                    db.flush()
+                    still_referenced = False
+                    if previous_file_id and previous_file_id != file_id:
+                        still_referenced = db.query(File.id).filter(
+                            File.file_id == previous_file_id).first() is not None
+                        if not still_referenced:
+                            db.query(UserFile).filter(
+                                UserFile.file_id == previous_file_id).delete(
+                                    synchronize_session=False)
+                    else:
+                        previous_file_id = None
+                    db.commit()
+                    break
+                except IntegrityError:
+                    # Another writer inserted the same name first, update its row
+                    db.rollback()
+                    if attempt:
+                        raise
+        self._invalidate()
+        logger.info(f"Registered {file_name} -> {file_id}")
+        return previous_file_id, still_referenced
+
+    def remove(self, file_name: str):
+        """
+        Remove a name from the catalog. The file's user_files rows go too once no
+        other name points to it.
+
+        :return: (file_id the name pointed to or None, whether other names still point to it)
+        """
+        with self.session_factory() as db:
+            file = (db.query(File).filter(
+                File.file_name == file_name).with_for_update().first())
+            if file is None:
+                return None, False
+            file_id = file.file_id
+            db.delete(file)
+            db.flush()
+            still_referenced = db.query(
+                File.id).filter(File.file_id == file_id).first() is not None
+            if not still_referenced:
+                db.query(UserFile).filter(UserFile.file_id == file_id).delete(
+                    synchronize_session=False)
+            db.commit()
+        self._invalidate()
+        return file_id, still_referenced
+
+    def count_names(self, file_id: str) -> int:
+        with self.session_factory() as db:
+            return db.query(func.count(
+                File.id)).filter(File.file_id == file_id).scalar()
+
+    def get_names(self, file_ids) -> dict:
+        """
+        :return: {file_id: [file names pointing to it]}
+        """
+        names = {}
+        if not file_ids:
+            return names
+        with self.session_factory() as db:
+            for file_name, file_id in db.query(
+                    File.file_name,
+                    File.file_id).filter(File.file_id.in_(list(file_ids))):
+                names.setdefault(file_id, []).append(file_name)
+        return names
+
+    def file_ids(self) -> set:
+        with self.session_factory() as db:
+            return {row[0] for row in db.query(File.file_id).distinct()}
+
+    def file_names(self) -> set:
+        with self.session_factory() as db:
+            return {row[0] for row in db.query(File.file_name)}
+
+    def list_files(self,
+                   after: str = None,
+                   limit: int = 100,
+                   owner_id: int = None) -> dict:
+        """
+        One page of file names in name order. Pages are read by seeking the name
+        index past the cursor, so each costs the same whatever the catalog size.
+
+        :param after: Cursor returned with the previous page.
+        :param owner_id: Only list files this user has access to.
+        :return: {"files": [names], "next_cursor": cursor of the next page or None}
+        """
+        limit = max(1, min(limit, FILE_LIST_MAX_PAGE_SIZE))
+        with self.session_factory() as db:
+            query = db.query(File.file_name)
+            if owner_id is not None:
+                query = query.join(UserFile,
+                                   UserFile.file_id == File.file_id).filter(
+                                       UserFile.user_id == owner_id)
+            if after:
+                query = query.filter(File.file_name > after)
+            names = [
+                row[0]
+                for row in query.order_by(File.file_name).limit(limit + 1)
+            ]
+        next_cursor = names[limit - 1] if len(names) > limit else None
+        return {"files": names[:limit], "next_cursor": next_cursor}
+
+    def import_filenames_json(self, file_path: str = "filenames.json"):
+        """
+        One-off migration of the catalog previously kept in filenames.json.
+        The file is renamed once imported.
+        """
+        if not os.path.exists(file_path):
+            return
+        with open(file_path, "r") as f:
+            try:
+                filenames = json.load(f)
+            except json.JSONDecodeError:
+                filenames = {}
+        for file_name, file_id in filenames.items():
+            if self.get_file_id(file_name) is None:
+                self.register(file_name, file_id)
+        os.replace(file_path, f"{file_path}.imported")
+        logger.info(f"Imported {len(filenames)} files from {file_path}")
+
+
+file_catalog = FileCatalog()
@@ -0,0 +1,102 @@
+import logging
+import os
+import re
+import time
+
+from fastapi import HTTPException
+
+from config import load_config
+from chunk_store import chunk_store
+from content_registry import content_registry
+from file_catalog import file_catalog
+from ingest import delete_file_vectors
+from ingest import rollback_ingestion
+from upload_service import UPLOAD_DIR
+from vector_store import get_vector_index
+
+config = load_config("config.yaml")
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# How often the background sweeper looks for orphans
+ORPHAN_SWEEP_INTERVAL_SECONDS = config.get("ORPHAN_SWEEP_INTERVAL_SECONDS",
+                                           3600)
+# Pending ingests and unreferenced uploads younger than this are left alone,
+# they may belong to a job that is still queued or running
+ORPHAN_GRACE_SECONDS = config.get("ORPHAN_GRACE_SECONDS", 24 * 3600)
+
+# Mapping files are named after the file id: <uuid>.json
+MAPPING_FILE_PATTERN = re.compile(
+    r"^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})\.json$")
+
+
+def delete_file(file_name: str) -> dict:
+    """
+    Delete an uploaded file: its catalog entry, upload and, once no other name
+    points to its content, its user_files rows, vectors and mapping file.
+    """
+    # Duplicate uploads share one file id (see deduplication in ingest_files)
+    file_id, still_referenced = file_catalog.remove(file_name)
+    if file_id is None:
+        raise HTTPException(status_code=404,
+                            detail=f"File {file_name} not found")
+
+    deleted_vectors = 0
+    if not still_referenced:
+        deleted_vectors = delete_file_vectors(get_vector_index(), file_id)
+
+    if os.path.exists(file_name):
+        os.remove(file_name)
+
+    logger.info(
+        f"Deleted {file_name} ({file_id}), {deleted_vectors} vectors removed")
+    return {"file_name": file_name, "deleted_vectors": deleted_vectors}
+
+
+def sweep_orphans(grace_seconds: int = ORPHAN_GRACE_SECONDS) -> dict:
+    """
+    Remove what failed or interrupted ingests left behind: vectors of pending
+    ingests that never finished, vectors and mapping files of file ids no name
+    points to anymore, and uploads that were never registered. Compacts the
+    chunk store when most of it is deleted chunks.
+    """
+    pinecone_store = get_vector_index()
+    cutoff = time.time() - grace_seconds
+    removed = {"pending": 0, "files": 0, "uploads": 0}
+
+    for file_id, file_name, is_new in content_registry.get_stale_pending(
+            cutoff):
+        rollback_ingestion(pinecone_store, file_id, file_name, is_new)
+        removed["pending"] += 1
+
+    # Registry first, then the catalog: ingestion names a file in the catalog
+    # before registering it, so every id read here that a name points to is
+    # seen as referenced. Ingests in progress and files newer than the grace
+    # period are left alone.
+    file_ids = content_registry.get_file_ids(cutoff)
+    file_ids.update(
+        match.group(1) for match in map(MAPPING_FILE_PATTERN.match,
+                                        os.listdir("."))
+        if match and os.path.getmtime(match.group(0)) < cutoff)
+    referenced = file_catalog.file_ids()
+    for file_id in file_ids - referenced:
+        delete_file_vectors(pinecone_store, file_id)
+        removed["files"] += 1
+
+    filenames = file_catalog.file_names()
+    if os.path.isdir(UPLOAD_DIR):
+        for entry in os.scandir(UPLOAD_DIR):
+            if (entry.is_file() and entry.path not in filenames
+                    and entry.stat().st_mtime < cutoff):
+                os.remove(entry.path)
+                removed["uploads"] += 1
+
+    # Deleted chunks only leave tombstones, reclaim the space once they dominate
+    store_stats = chunk_store.stats()
+    if store_stats["dead_bytes"] > store_stats["live_bytes"]:
+        chunk_store.compact()
+
+    logger.info(f"Orphan sweep done: {removed}")
+    return removed
@@ -0,0 +1,52 @@
+import logging
+
+from redis_config import get_redis
+from redis_config import get_sync_redis
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Per-file counters, bumped whenever a file's vectors change, plus one global
+# counter bumped on any change. Caches put them in their keys, so a bump makes
+# every entry computed from the old content unreachable.
+FILE_VERSION_KEY = "file_version:{}"
+GLOBAL_VERSION_KEY = "file_version:*"
+
+
+def bump_file_versions(file_ids: list):
+    """
+    Called after a file is ingested, updated, rolled back or deleted.
+    """
+    try:
+        pipe = get_sync_redis().pipeline()
+        for file_id in file_ids:
+            pipe.incr(FILE_VERSION_KEY.format(file_id))
+        pipe.incr(GLOBAL_VERSION_KEY)
+        pipe.execute()
+    except Exception as e:
+        # Caches may serve stale results until their TTL runs out
+        logger.error(f"Could not bump file versions of {file_ids}: {e}")
+
+
+def scope_name(file_id: str, version) -> str:
+    if file_id is None:
+        return f"all:{int(version or 0)}"
+    return f"file:{file_id}:{int(version or 0)}"
+
+
+def get_scope_version(file_id: str = None) -> str:
+    """
+    :param file_id: The file a query is restricted to, None for all files.
+    :return: a key part naming the scope and its current version.
+    """
+    key = GLOBAL_VERSION_KEY if file_id is None else FILE_VERSION_KEY.format(
+        file_id)
+    return scope_name(file_id, get_sync_redis().get(key))
+
+
+async def aget_scope_version(file_id: str = None) -> str:
+    r = await get_redis()
+    key = GLOBAL_VERSION_KEY if file_id is None else FILE_VERSION_KEY.format(
+        file_id)
+    return scope_name(file_id, await r.get(key))
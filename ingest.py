@@ -1,26 +1,49 @@
+import codecs
 import json
 import logging
+import mmap
+import multiprocessing
+import os
 import re
+import threading
+import time
 import uuid
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from io import StringIO
 from typing import List
 from xml.etree import ElementTree as ET
 
-import docx
-import nltk
 import openai
-import pinecone
 import yaml
 from langchain.llms import OpenAI
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from nltk.tokenize import TextTilingTokenizer
-from pdfminer.high_level import extract_text
+from pdfminer.converter import TextConverter
+from pdfminer.layout import LAParams
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfinterp import PDFPageInterpreter
+from pdfminer.pdfinterp import PDFResourceManager
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdftypes import resolve1
 
-from doc_utils import update_filenames_json
+from chunk_store import chunk_store
+from content_registry import content_registry
+from content_registry import hash_file
+from content_registry import hash_text
+from embedding_cache import embedding_cache
+from file_catalog import file_catalog
+from file_versions import bump_file_versions
+from near_duplicates import NEAR_DUPLICATE_MODE
+from near_duplicates import find_near_duplicates
+from text_chunker import iter_chunks
+from tokenizer import count_tokens
+from vector_store import get_vector_index
 
 # from dotenv import dotenv_values
-# nltk.download("stopwords")
-# nltk.download("punkt")
 
 
 # config = dotenv_values(".env")
@@ -35,172 +58,1051 @@ config = load_config("config.yaml")
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# 3200 is aprox 1042 tokens
-# Text Tiling
+# Embeddings
+EMBEDDING_MODEL = "text-embedding-ada-002"
+# Max tokens packed into a single embeddings request
+EMBEDDING_BATCH_MAX_TOKENS = config.get("EMBEDDING_BATCH_MAX_TOKENS", 40000)
+# Max inputs per request (the API accepts up to 2048)
+EMBEDDING_BATCH_MAX_SIZE = config.get("EMBEDDING_BATCH_MAX_SIZE", 512)
+# Number of embedding requests kept in flight at once
+EMBEDDING_CONCURRENCY = config.get("EMBEDDING_CONCURRENCY", 4)
+EMBEDDING_MAX_RETRIES = config.get("EMBEDDING_MAX_RETRIES", 5)
 
+# Vector upserts
+# Pinecone rejects requests over 2MB, stay below it
+UPSERT_BATCH_MAX_BYTES = config.get("UPSERT_BATCH_MAX_BYTES", 1_500_000)
+UPSERT_BATCH_MAX_SIZE = config.get("UPSERT_BATCH_MAX_SIZE", 100)
+UPSERT_CONCURRENCY = config.get("UPSERT_CONCURRENCY", 4)
 
-def split_text_data(text: str, max_chars: int = 3200) -> list:
-    # initialize TextTilingTokenizer
-    ttt = TextTilingTokenizer()
+# Extraction + chunking is CPU bound, it runs in a process pool shared by all ingestion jobs
+EXTRACTION_WORKERS = config.get("EXTRACTION_WORKERS", os.cpu_count() or 1)
+# Times files caught in a crashed worker pool are retried on a fresh pool
+EXTRACTION_MAX_RETRIES = config.get("EXTRACTION_MAX_RETRIES", 1)
+# PDFs longer than this are split into page ranges extracted by different workers.
+# A worker hands back a range's chunks only once the whole range is parsed, so
+# this also bounds the chunks held per worker and how soon embedding can start.
+# Chunks don't span ranges, each range boundary may split a passage.
+PDF_PAGES_PER_TASK = config.get("PDF_PAGES_PER_TASK", 10)
 
-    # check if text too short
-    if len(text) < ttt.w * 2:  # w = default block size (usually 50)
-        return [text]
+# Errors worth retrying: the batch itself is fine, the API was not
+RETRYABLE_OPENAI_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.Timeout,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+)
 
+# Chunk size measured in tokens of the embedding model
+CHUNK_MAX_TOKENS = config.get("CHUNK_MAX_TOKENS", 1000)
+CHUNK_OVERLAP_TOKENS = config.get("CHUNK_OVERLAP_TOKENS", 100)
+
+
+def batch_chunks(chunks: list,
+                 max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS,
+                 max_size: int = EMBEDDING_BATCH_MAX_SIZE) -> list:
+    """
+    Group chunk indexes into batches that stay under max_tokens and max_size.
+    A single chunk larger than max_tokens gets a batch of its own.
+    """
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for idx, chunk in enumerate(chunks):
+        tokens = count_tokens(chunk)
+        if batch and (batch_tokens + tokens > max_tokens
+                      or len(batch) >= max_size):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(idx)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def embed_batch(texts: list, model: str = EMBEDDING_MODEL) -> list:
+    response = openai.Embedding.create(input=texts, model=model)
+    # "index" is the position of the input inside this request
+    data = sorted(response["data"], key=lambda item: item["index"])
+    return [item["embedding"] for item in data]
+
+
+def generate_embeddings(chunks: list,
+                        model: str = EMBEDDING_MODEL,
+                        max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS,
+                        max_size: int = EMBEDDING_BATCH_MAX_SIZE,
+                        max_workers: int = EMBEDDING_CONCURRENCY,
+                        max_retries: int = EMBEDDING_MAX_RETRIES,
+                        progress_callback=None,
+                        use_cache: bool = True) -> list:
+    """
+    Embed chunks in batched requests, several batches in flight at once.
+
+    Embeddings are returned in the same order as chunks. Chunks found in the
+    embedding cache are not sent to the API. Batches that fail with a retryable
+    error are resubmitted (with backoff); batches that already succeeded are
+    never sent again.
+
+    :param progress_callback: Optional callable(done, total) called as batches complete.
+    """
+    embeddings = [None] * len(chunks)
+    if use_cache:
+        for idx, embedding in embedding_cache.get_many(chunks, model).items():
+            embeddings[idx] = embedding
+    to_embed = [
+        idx for idx, embedding in enumerate(embeddings) if embedding is None
+    ]
+    done = len(chunks) - len(to_embed)
+    # batch_chunks works on positions in to_embed, map them back to chunk indexes
+    pending = [[to_embed[i] for i in batch]
+               for batch in batch_chunks([chunks[idx] for idx in to_embed],
+                                         max_tokens, max_size)]
+    logger.info(
+        f"Embedding {len(to_embed)} chunks in {len(pending)} batches "
+        f"({done} found in cache)")
+
+    attempt = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending:
+            futures = {
+                executor.submit(embed_batch, [chunks[i] for i in batch],
+                                model): batch
+                for batch in pending
+            }
+            failed = []
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    batch_embeddings = future.result()
+                except RETRYABLE_OPENAI_ERRORS as e:
+                    logger.warning(
+                        f"Embedding batch of {len(batch)} chunks failed: {e}")
+                    failed.append(batch)
+                    continue
+                for idx, embedding in zip(batch, batch_embeddings):
+                    embeddings[idx] = embedding
+                if use_cache:
+                    embedding_cache.put_many([chunks[idx] for idx in batch],
+                                             batch_embeddings, model)
+                done += len(batch)
+                if progress_callback:
+                    progress_callback(done, len(chunks))
+
+            if failed:
+                attempt += 1
+                if attempt > max_retries:
+                    raise RuntimeError(
+                        f"{len(failed)} embedding batches still failing after {max_retries} retries"
+                    )
+                delay = min(2**attempt, 30)
+                logger.info(
+                    f"Retrying {len(failed)} embedding batches in {delay}s (attempt {attempt})"
+                )
+                time.sleep(delay)
+            pending = failed
+    return embeddings
+
+
+def batch_vectors(vectors: list,
+                  max_bytes: int = UPSERT_BATCH_MAX_BYTES,
+                  max_size: int = UPSERT_BATCH_MAX_SIZE) -> list:
+    """
+    Group (id, values, metadata) tuples into batches by approximate JSON payload size.
+    """
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for vector in vectors:
+        vector_bytes = len(json.dumps(vector))
+        if batch and (batch_bytes + vector_bytes > max_bytes
+                      or len(batch) >= max_size):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(vector)
+        batch_bytes += vector_bytes
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def is_payload_too_large(error: Exception) -> bool:
+    status = getattr(error, "status", None)
+    message = f"{getattr(error, 'body', '')} {error}".lower()
+    return status == 413 or (status == 400 and
+                             ("too large" in message
+                              or "message length" in message
+                              or "exceeds" in message))
+
+
+def upsert_batch(pinecone_store, batch: list) -> list:
+    """
+    Upsert a batch, splitting it in half whenever the backend rejects it as too large.
+    Returns a list of (vector count, seconds) for every request that was sent.
+    """
+    start = time.perf_counter()
     try:
-        # tokenize the text into pseudo sentences (adjust parameters if necessary)
-        pseudo_sentences = nltk.sent_tokenize(text, language="english")
-
-        # Concatenate pseudo sentences
-        concatenated_pseudo_sentences = " ".join(pseudo_sentences)
-
-        # Apply text tiling on concatenated pseudo sentences
-        chunks = ttt.tokenize(concatenated_pseudo_sentences)
-
-        # remove double new lines from chunks
-        chunks = [chunk.lstrip("\n\n") for chunk in chunks]
-
-        if len(chunks) <= 1:
-            raise ValueError("Too few chunks")
-
-        # Split chunks that exceed the maximum character limit
-        i = 0
-        while i < len(chunks):
-            chunk = chunks[i]
-            if len(chunk) > max_chars:
-                # split the chunk into smaller subchunks
-                num_subchunks = (len(chunk) // max_chars) + 1
-                subchunks = [
-                    chunk[j * max_chars:(j + 1) * max_chars]
-                    for j in range(num_subchunks)
-                ]
-                chunks.pop(i)
-                for subchunk in reversed(subchunks):
-                    chunks.insert(i, subchunk)
-            i += 1
-
-    except ValueError as e:
-        print(f"TextTiling exception: {e}")
-
-        # Fallback to RecursiveCharacterTextSplitter
-        char_text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000,
-                                                            chunk_overlap=200)
-        chunks = char_text_splitter.split_text(text)
-        print("RecursiveCharacterTextSplitter")
-        print(chunks)
-    return chunks
-
-
-def generate_embeddings(chunks: list) -> list:
-    embeddings = []
-    for chunk in chunks:
-        response = openai.Embedding.create(input=chunk,
-                                           model="text-embedding-ada-002")
-        embeddings.append(response["data"][0]["embedding"])
+        pinecone_store.upsert(vectors=batch)
+    except Exception as e:
+        if len(batch) <= 1 or not is_payload_too_large(e):
+            raise
+        logger.info(
+            f"Upsert of {len(batch)} vectors rejected as too large, splitting")
+        middle = len(batch) // 2
+        return (upsert_batch(pinecone_store, batch[:middle]) +
+                upsert_batch(pinecone_store, batch[middle:]))
+    elapsed = time.perf_counter() - start
+    logger.info(f"Upserted {len(batch)} vectors in {elapsed:.3f}s")
+    return [(len(batch), elapsed)]
+
+
+def store_embeddings(chunks: list,
+                     embeddings: list,
+                     file_unique_id: str,
+                     pinecone_store,
+                     file_name,
+                     max_workers: int = UPSERT_CONCURRENCY,
+                     chunk_indexes: list = None,
+                     chunk_ids: list = None,
+                     duplicate_of: dict = None):
+    """
+    Write the chunk texts to the chunk store and upsert their vectors. Vector
+    metadata only carries ids, the text is read back from the chunk store.
+
+    :param chunk_indexes: Position of each chunk in the file (default 0..n-1).
+    :param chunk_ids: Vector id of each chunk (default "{file_unique_id}_{position}").
+    :param duplicate_of: {chunk id: id of the chunk it nearly repeats}, stored in
+        the metadata of near-duplicates so retrieval can collapse them.
+    """
+    if chunk_indexes is None:
+        chunk_indexes = list(range(len(chunks)))
+    if chunk_ids is None:
+        chunk_ids = [f"{file_unique_id}_{idx}" for idx in chunk_indexes]
+    # Texts first, so every vector a query can return has its text
+    chunk_store.put_many(dict(zip(chunk_ids, chunks)))
+    duplicate_of = duplicate_of or {}
+    vectors = []
+    for idx, chunk_unique_id, embedding in zip(chunk_indexes, chunk_ids,
+                                               embeddings):
+        metadata = {"chunk": idx, "file_id": file_unique_id}
+        if chunk_unique_id in duplicate_of:
+            metadata["duplicate_of"] = duplicate_of[chunk_unique_id]
+        vectors.append((chunk_unique_id, embedding, metadata))
+
+    batches = batch_vectors(vectors)
+    start = time.perf_counter()
+    timings = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for batch_timings in executor.map(
+                lambda batch: upsert_batch(pinecone_store, batch), batches):
+            timings.extend(batch_timings)
+    logger.info(
+        f"Stored {len(vectors)} vectors for {file_name} in {len(timings)} requests, "
+        f"{time.perf_counter() - start:.3f}s total, "
+        f"slowest request {max((t for _, t in timings), default=0):.3f}s")
+
+
+def fetch_embeddings(pinecone_store, vector_ids: list,
+                     batch_size: int = 1000) -> dict:
+    embeddings = {}
+    for start in range(0, len(vector_ids), batch_size):
+        response = pinecone_store.fetch(ids=vector_ids[start:start +
+                                                       batch_size])
+        for vector_id, vector in response["vectors"].items():
+            embeddings[vector_id] = vector["values"]
     return embeddings
 
 
-def store_embeddings(chunks: list, embeddings: list, file_unique_id: str,
-                     pinecone_store, file_name) -> dict:
-    id_to_text_mapping = {}
-    for idx, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
-        chunk_unique_id = f"{file_unique_id}_{idx}"
-        metadata = {
-            "chunk": idx,
-            "text": chunk,
-            "file_id": file_unique_id,
-            "file_name": file_name,
-        }
-        id_to_text_mapping[chunk_unique_id] = metadata
-        pinecone_store.upsert(
-            vectors=zip([chunk_unique_id], [embedding], [metadata]))
-    return id_to_text_mapping
+def delete_vectors(pinecone_store, vector_ids: list, batch_size: int = 1000):
+    for start in range(0, len(vector_ids), batch_size):
+        pinecone_store.delete(ids=vector_ids[start:start + batch_size])
+
+
+def release_vectors(pinecone_store, vector_ids: list, file_id: str) -> list:
+    """
+    Delete vectors of file_id and forget them in the registry, except the ones
+    near-duplicate chunks of other files are linked to (see near_duplicates.py):
+    those files have no vector of their own for the chunk, so it is kept until
+    the last of them goes.
 
+    :return: the ids deleted.
+    """
+    linked = content_registry.get_linked_file_ids(vector_ids)
+    kept = {
+        vector_id
+        for vector_id, file_ids in linked.items()
+        if any(linked_file_id != file_id for linked_file_id in file_ids)
+    }
+    released = [vector_id for vector_id in vector_ids if vector_id not in kept]
+    delete_vectors(pinecone_store, released)
+    chunk_store.delete(released)
+    content_registry.remove_vectors(released)
+    if kept:
+        logger.info(
+            f"Keeping {len(kept)} vectors of {file_id} other files are linked to"
+        )
+    return released
+
+
+def release_unlinked_vectors(pinecone_store, canonical_ids: list,
+                             file_id: str) -> list:
+    """
+    Delete the vectors among canonical_ids that were only kept for links that
+    are gone now, e.g. after file_id's links were removed or replaced.
+
+    :return: the ids deleted.
+    """
+    return release_vectors(
+        pinecone_store,
+        content_registry.get_unreferenced_vectors(canonical_ids), file_id)
+
+
+def delete_file_vectors(pinecone_store, file_id: str) -> int:
+    """
+    Delete every vector of a file by id, in batches, and forget them in the registry.
+
+    Ids come from the registry, or from the mapping file for files ingested
+    before chunks were tracked. Vectors other files' chunks are linked to are
+    kept (see release_vectors), and vectors only this file's links kept are
+    deleted.
+
+    :return: the number of vectors deleted.
+    """
+    vector_ids = [
+        vector_id
+        for vector_id, _ in content_registry.get_file_chunks(file_id)
+    ]
+    if not vector_ids:
+        vector_ids = list(load_mapping_from_file(f"{file_id}.json"))
+    linked_to = [
+        canonical_id
+        for _, canonical_id in content_registry.get_file_links(file_id)
+    ]
+    released = release_vectors(pinecone_store, vector_ids, file_id)
+    content_registry.remove_file(file_id)
+    released += release_unlinked_vectors(pinecone_store, linked_to, file_id)
+    bump_file_versions([file_id])
+    mapping_file = f"{file_id}.json"
+    if os.path.exists(mapping_file):
+        os.remove(mapping_file)
+    logger.info(f"Deleted {len(released)} vectors of file {file_id}")
+    return len(released)
+
+
+def rollback_ingestion(pinecone_store, file_id: str, file_name: str,
+                       is_new: bool):
+    """
+    Undo an ingestion that did not finish: delete the vectors it wrote and, for a
+    new file, unregister its name. An update leaves the previous version in place.
+    """
+    vector_ids = content_registry.get_pending_vectors(file_id)
+    logger.info(
+        f"Rolling back ingestion of {file_name} ({file_id}), {len(vector_ids)} vectors"
+    )
+    release_vectors(pinecone_store, vector_ids, file_id)
+    if is_new:
+        if file_catalog.get_file_id(file_name) == file_id:
+            file_catalog.remove(file_name)
+        content_registry.remove_file(file_id)
+    content_registry.finish_pending(file_id)
+    bump_file_versions([file_id])
+
+
+def embed_chunks_with_reuse(chunks: list,
+                            pinecone_store,
+                            progress_callback=None):
+    """
+    Embed chunks, reusing any embedding computed before.
 
-def save_mapping_to_file(mapping: dict, file_name: str):
-    with open(file_name, "w") as outfile:
-        json.dump(mapping, outfile)
+    Lookup order is the local embedding cache, then the vectors already stored
+    for identical chunk text, then the embeddings API.
+
+    :return: (embeddings in chunk order, sha256 of each chunk, indexes of the chunks that were not already stored)
+    """
+    chunk_hashes = [hash_text(chunk) for chunk in chunks]
+    embeddings = [None] * len(chunks)
+    for idx, embedding in embedding_cache.get_many(chunks,
+                                                   EMBEDDING_MODEL).items():
+        embeddings[idx] = embedding
+
+    known_vector_ids = content_registry.get_chunk_vector_ids(chunk_hashes)
+    cache_misses = [
+        idx for idx in range(len(chunks)) if embeddings[idx] is None
+    ]
+    stored = fetch_embeddings(
+        pinecone_store,
+        list({
+            known_vector_ids[chunk_hashes[idx]]
+            for idx in cache_misses if chunk_hashes[idx] in known_vector_ids
+        }))
+
+    missing = []
+    for idx in cache_misses:
+        vector_id = known_vector_ids.get(chunk_hashes[idx])
+        if vector_id in stored:
+            embeddings[idx] = stored[vector_id]
+        else:
+            missing.append(idx)
+    if len(missing) < len(cache_misses):
+        # Warm the cache with what we fetched from the index
+        reused = [idx for idx in cache_misses if embeddings[idx] is not None]
+        embedding_cache.put_many([chunks[idx] for idx in reused],
+                                 [embeddings[idx] for idx in reused],
+                                 EMBEDDING_MODEL)
+    logger.info(
+        f"{len(chunks) - len(cache_misses)} embeddings from cache, "
+        f"{len(cache_misses) - len(missing)} from stored vectors, "
+        f"embedding {len(missing)} chunks")
+
+    if missing:
+        new_embeddings = generate_embeddings(
+            [chunks[idx] for idx in missing],
+            progress_callback=progress_callback,
+            use_cache=False)
+        for idx, embedding in zip(missing, new_embeddings):
+            embeddings[idx] = embedding
+        embedding_cache.put_many([chunks[idx] for idx in missing],
+                                 new_embeddings, EMBEDDING_MODEL)
+
+    missing_set = set(missing)
+    new_chunks = [
+        idx for idx, chunk_hash in enumerate(chunk_hashes)
+        if chunk_hash not in known_vector_ids or idx in missing_set
+    ]
+    return embeddings, chunk_hashes, new_chunks
+
+
+# Files ingested before the chunk store kept their texts in a {file_unique_id}.json mapping
+def load_mapping_from_file(file_name: str) -> dict:
+    if not os.path.exists(file_name):
+        return {}
+    with open(file_name, "r") as infile:
+        return json.load(infile)
+
+
+# Read-only memory-mapped view of a file. Extractors read from it directly,
+# so the file is never copied into memory as a whole. memory_map=False yields
+# the file object itself, for readers that need a full file API.
+@contextmanager
+def open_file_view(file_path: str, memory_map: bool = True):
+    with open(file_path, "rb") as f:
+        if not memory_map or os.fstat(f.fileno()).st_size == 0:
+            # Empty files can't be memory-mapped
+            yield f
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            yield view
 
 
 # Extract text using pdfminer six
+# pdf_file is a seekable binary stream
+
+
+# Yield the text of each page as soon as it is parsed, instead of building the
+# whole document's text first. page_numbers (0-based) limits the pages parsed.
+def iter_pdf_pages(pdf_file, page_numbers=None):
+    page_numbers = set(page_numbers) if page_numbers is not None else None
+    # get_pages stops reading the page tree after maxpages
+    maxpages = max(page_numbers) + 1 if page_numbers else 0
+    resource_manager = PDFResourceManager(caching=True)
+    laparams = LAParams()
+    for page in PDFPage.get_pages(pdf_file,
+                                  pagenos=page_numbers,
+                                  maxpages=maxpages):
+        output = StringIO()
+        device = TextConverter(resource_manager, output, laparams=laparams)
+        PDFPageInterpreter(resource_manager, device).process_page(page)
+        device.close()
+        yield output.getvalue()
+
+
+def count_pdf_pages(pdf_file) -> int:
+    document = PDFDocument(PDFParser(pdf_file))
+    return resolve1(document.catalog["Pages"])["Count"]
 
 
-def extract_text_from_pdf(file_path: str) -> str:
-    text = extract_text(file_path)
-    return text
+WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+DOCX_PARAGRAPH = f"{WORD_NAMESPACE}p"
+DOCX_TEXT = f"{WORD_NAMESPACE}t"
+DOCX_TAB = f"{WORD_NAMESPACE}tab"
+DOCX_BREAK = f"{WORD_NAMESPACE}br"
+DOCX_TABLE = f"{WORD_NAMESPACE}tbl"
+DOCX_TABLE_ROW = f"{WORD_NAMESPACE}tr"
+DOCX_TABLE_CELL = f"{WORD_NAMESPACE}tc"
+DOCX_HEADER_FOOTER_PART = re.compile(r"word/(header|footer)\d*\.xml")
 
 
-# .docx file is a ZIP archive containing multiple files. Opening it as a ZIP allows us to access the xml file that contains the  text
-def extract_text_from_docx(file_path: str) -> str:
-    # Open the .docx file as a ZIP archive
-    with zipfile.ZipFile(file_path, "r") as z:
-        # Extract the 'word/document.xml' file
-        xml_content = z.read("word/document.xml").decode()
+def iter_docx_part(xml_stream):
+    """
+    Incrementally parse one WordprocessingML part and yield its paragraphs.
 
-        # Parse the XML content
-        tree = ET.fromstring(xml_content)
+    Each table row is yielded as one line with its cells joined by " | ".
+    Elements are removed from the tree as soon as they have been yielded, so
+    memory stays flat no matter how large the part is.
+    """
+    elements = []  # open elements, innermost last
+    paragraphs = []  # text runs of each open paragraph (text boxes nest them)
+    rows = []  # cells of each open table row
+    cells = []  # paragraphs of each open table cell
+    for event, elem in ET.iterparse(xml_stream, events=("start", "end")):
+        if event == "start":
+            elements.append(elem)
+            if elem.tag == DOCX_PARAGRAPH:
+                paragraphs.append([])
+            elif elem.tag == DOCX_TABLE_ROW:
+                rows.append([])
+            elif elem.tag == DOCX_TABLE_CELL:
+                cells.append([])
+            continue
 
-        # Find all paragraph elements
-        paragraphs = tree.findall(
-            ".//w:p",
-            namespaces={
-                "w":
-                "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
-            },
+        elements.pop()
+        line = None
+        if elem.tag == DOCX_TEXT and paragraphs:
+            paragraphs[-1].append(elem.text or "")
+        elif elem.tag == DOCX_TAB and paragraphs:
+            paragraphs[-1].append("\t")
+        elif elem.tag == DOCX_BREAK and paragraphs:
+            paragraphs[-1].append("\n")
+        elif elem.tag == DOCX_PARAGRAPH:
+            line = "".join(paragraphs.pop())
+        elif elem.tag == DOCX_TABLE_CELL:
+            rows[-1].append("\n".join(text for text in cells.pop() if text))
+        elif elem.tag == DOCX_TABLE_ROW:
+            line = " | ".join(rows.pop())
+
+        if line is None:
+            continue
+        if cells:
+            # Inside a table cell, collected until the row closes
+            cells[-1].append(line)
+        else:
+            # Replace carriage returns and line feeds with newline characters
+            yield re.sub(r"\r|\f", "\n", line)
+        # Done with this element, drop it from its parent to free memory
+        if elements:
+            elements[-1].remove(elem)
+
+
+def iter_docx_paragraphs(docx_file):
+    """
+    Yield the paragraphs of a .docx file: main document first, then headers and footers.
+    """
+    # .docx file is a ZIP archive containing multiple files. Opening it as a ZIP allows us to access the xml files that contain the text
+    with zipfile.ZipFile(docx_file, "r") as z:
+        part_names = ["word/document.xml"] + sorted(
+            name for name in z.namelist()
+            if DOCX_HEADER_FOOTER_PART.fullmatch(name))
+        for part_name in part_names:
+            # Stream the member, it is never read into memory as a whole
+            with z.open(part_name) as xml_stream:
+                yield from iter_docx_part(xml_stream)
+
+
+# Decode a text stream block by block
+def iter_txt_blocks(txt_file, block_size: int = 1024 * 1024):
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    while True:
+        block = txt_file.read(block_size)
+        if not block:
+            break
+        yield decoder.decode(block)
+    yield decoder.decode(b"", final=True)
+
+
+def iter_docx_text(docx_file):
+    for paragraph in iter_docx_paragraphs(docx_file):
+        yield paragraph + "\n\n"
+
+
+# Each function yields a file's text piece by piece for the streaming chunker
+TEXT_STREAM_FUNCTIONS = {
+    "pdf": iter_pdf_pages,
+    "docx": iter_docx_text,
+    # 'doc': extract_text_from_doc,
+    "txt": iter_txt_blocks,
+}
+# zipfile calls seekable(), which mmap objects only have from Python 3.13.
+# It reads members from the file on demand, the file object is enough.
+ZIP_FORMATS = {"docx"}
+
+
+# Runs inside an extraction worker process. Text is chunked as it is extracted,
+# the file's full text is never built.
+def extract_and_chunk(file_path: str, page_numbers=None) -> list:
+    file_extension = file_path.lower().split(".")[-1]
+    iter_text = TEXT_STREAM_FUNCTIONS.get(file_extension)
+    if iter_text is None:
+        raise ValueError(f"Unsupported file type: {file_extension}")
+    with open_file_view(file_path, memory_map=file_extension
+                        not in ZIP_FORMATS) as file_view:
+        if page_numbers is None:
+            pieces = iter_text(file_view)
+        else:
+            pieces = iter_text(file_view, page_numbers)
+        return list(
+            iter_chunks(pieces, CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS,
+                        EMBEDDING_MODEL))
+
+
+def plan_page_ranges(file_path: str,
+                     pages_per_task: int = PDF_PAGES_PER_TASK) -> list:
+    """
+    Split a large PDF into page ranges that can be extracted in parallel.
+    Returns [None] (the whole file as one task) for anything else.
+    """
+    if not file_path.lower().endswith(".pdf"):
+        return [None]
+    try:
+        with open_file_view(file_path) as file_view:
+            page_count = count_pdf_pages(file_view)
+    except Exception as e:
+        logger.warning(f"Could not count pages of {file_path}: {e}")
+        return [None]
+    if page_count <= pages_per_task:
+        return [None]
+    return [
+        list(range(start, min(start + pages_per_task, page_count)))
+        for start in range(0, page_count, pages_per_task)
+    ]
+
+
+_extraction_pool = None
+_extraction_pool_lock = threading.Lock()
+
+
+def get_extraction_pool() -> ProcessPoolExecutor:
+    global _extraction_pool
+    with _extraction_pool_lock:
+        if _extraction_pool is None:
+            # spawn: forking a process that already runs threads is unsafe
+            _extraction_pool = ProcessPoolExecutor(
+                max_workers=EXTRACTION_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _extraction_pool
+
+
+def discard_extraction_pool(pool: ProcessPoolExecutor):
+    global _extraction_pool
+    with _extraction_pool_lock:
+        if _extraction_pool is pool:
+            _extraction_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _run_extraction(tasks: list):
+    """
+    Yield (task, chunks, error) for each task as it finishes and return
+    the tasks that were lost to a crashed worker process.
+    """
+    pool = get_extraction_pool()
+    futures = {}
+    crashed = []
+    try:
+        for task in tasks:
+            file_path, _, page_numbers = task
+            futures[pool.submit(extract_and_chunk, file_path,
+                                page_numbers)] = task
+    except BrokenProcessPool:
+        crashed = [task for task in tasks if task not in futures.values()]
+
+    for future in as_completed(futures):
+        task = futures[future]
+        try:
+            chunks = future.result()
+        except BrokenProcessPool:
+            crashed.append(task)
+            continue
+        except Exception as e:
+            yield task, None, e
+            continue
+        yield task, chunks, None
+
+    if crashed:
+        discard_extraction_pool(pool)
+    return crashed
+
+
+def iter_extracted_files(tasks: list,
+                         max_retries: int = EXTRACTION_MAX_RETRIES):
+    """
+    Extract and chunk files in parallel on the extraction pool.
+
+    Each task is (file_path, segment index, page numbers or None). Yields
+    (task, chunks, error) as soon as each task is done, so the caller can embed
+    one segment while the others are still being parsed. A task that raises is
+    yielded with its error. If a worker process dies, the pool is replaced and
+    the tasks that were in flight are retried one at a time, so a task that
+    keeps crashing its worker fails alone.
+    """
+    crashed = yield from _run_extraction(tasks)
+    for attempt in range(max_retries):
+        if not crashed:
+            break
+        logger.warning(
+            f"Extraction worker crashed, retrying {len(crashed)} tasks")
+        retry, crashed = crashed, []
+        for task in retry:
+            crashed += yield from _run_extraction([task])
+    for task in crashed:
+        yield task, None, RuntimeError("Extraction worker crashed")
+
+
+class FileIngestion:
+    """
+    Embeds and stores one file's chunks segment by segment.
+
+    Segments may finish extraction in any order; they are stored in page order
+    so chunk positions stay sequential across the whole file.
+
+    In update mode, a file whose name was ingested before keeps its file id and
+    is diffed against the previous version by chunk hash: unchanged chunks keep
+    their vectors, only new or changed chunks are embedded and upserted, and the
+    vectors of chunks that disappeared are deleted once the new version is stored.
+    """
+
+    def __init__(self,
+                 file_path: str,
+                 content_hash: str,
+                 segment_count: int,
+                 pinecone_store,
+                 report,
+                 update: bool = True,
+                 owner_id: int = None):
+        self.file_path = file_path
+        self.file_name = file_path
+        self.content_hash = content_hash
+        self.segment_count = segment_count
+        self.pinecone_store = pinecone_store
+        self.report = report
+        self.next_segment = 0
+        self.ready = {}
+        self.chunk_count = 0
+        self.chunk_records = []  # (vector_id, chunk_hash) for every chunk, in order
+        # Texts of reused vectors whose text is only in a legacy mapping file
+        self.legacy_texts = {}
+        # chunk_hash -> vector ids of the previous version not reused (yet)
+        self.previous_chunks = {}
+        self.previous_mapping = {}
+        self.previous_vector_ids = set()
+        # (position, canonical vector id) of chunks nearly repeating a stored one
+        self.chunk_links = []
+
+        previous_file_id = file_catalog.get_file_id(
+            self.file_name) if update else None
+        # Don't rewrite content other filenames point to (see deduplication)
+        if previous_file_id and file_catalog.count_names(
+                previous_file_id) == 1:
+            self.file_unique_id = previous_file_id
+            self._load_previous_version()
+        else:
+            self.file_unique_id = str(uuid.uuid4())
+        self.is_new = not self.previous_chunks and not self.previous_mapping
+        content_registry.start_pending(self.file_unique_id, self.file_name,
+                                       self.is_new)
+
+        # Register the file name and its unique ID in the file catalog
+        replaced_file_id, still_referenced = file_catalog.register(
+            self.file_name, self.file_unique_id, content_hash, owner_id)
+        if replaced_file_id and not still_referenced:
+            # The name was the last one pointing at its old content, e.g. with
+            # update=False, so that content is no longer reachable
+            delete_file_vectors(pinecone_store, replaced_file_id)
+
+    def _load_previous_version(self):
+        self.previous_mapping = load_mapping_from_file(
+            f"{self.file_unique_id}.json")
+        previous = content_registry.get_file_chunks(self.file_unique_id)
+        if not previous:
+            # Ingested before chunks were tracked, hash the mapping's texts instead
+            previous = [(vector_id, hash_text(metadata["text"]))
+                        for vector_id, metadata in self.previous_mapping.items()]
+        for vector_id, chunk_hash in previous:
+            self.previous_chunks.setdefault(chunk_hash, []).append(vector_id)
+            self.previous_vector_ids.add(vector_id)
+        logger.info(
+            f"Updating {self.file_name} ({self.file_unique_id}), previous version has {len(previous)} chunks"
         )
 
-        # Extract the text from the 'w:t' elements within each paragraph and join them with newline characters
-        text = "\n\n".join("".join(node.text for node in para.findall(
-            ".//w:t",
-            namespaces={
-                "w":
-                "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
-            },
-        )) for para in paragraphs)
+    @property
+    def done(self) -> bool:
+        return self.next_segment == self.segment_count
+
+    def add_segment(self, segment: int, chunks: list):
+        self.ready[segment] = chunks
+        while self.next_segment in self.ready:
+            self._store_segment(self.ready.pop(self.next_segment))
+            self.next_segment += 1
+        if self.done:
+            self._finish()
+
+    def _progress(self, fraction: float) -> float:
+        return 0.1 + 0.9 * (self.next_segment + fraction) / self.segment_count
+
+    def _new_vector_id(self, position: int) -> str:
+        if self.previous_mapping or self.previous_chunks:
+            # Positional ids of the previous version may still be in use
+            return f"{self.file_unique_id}_{self.content_hash[:8]}_{position}"
+        return f"{self.file_unique_id}_{position}"
 
-        # Replace carriage returns and line feeds with newline characters
-        text = re.sub(r"\r|\f", "\n", text)
+    def _store_segment(self, chunks: list):
+        records = []  # (vector_id, chunk_hash) of each chunk, None once skipped
+        changed = []
+        for idx, chunk in enumerate(chunks):
+            chunk_hash = hash_text(chunk)
+            reusable = self.previous_chunks.get(chunk_hash)
+            if reusable:
+                vector_id = reusable.pop()
+                if vector_id in self.previous_mapping:
+                    self.legacy_texts[vector_id] = chunk
+            else:
+                vector_id = self._new_vector_id(self.chunk_count + idx)
+                changed.append(idx)
+            records.append((vector_id, chunk_hash))
 
-    return text
+        duplicate_of = {}
+        sketches = {}
+        if changed and NEAR_DUPLICATE_MODE != "off":
+            canonical, sketches = find_near_duplicates(
+                [chunks[idx] for idx in changed],
+                [records[idx][0] for idx in changed],
+                # Vectors of the previous version may be about to vanish
+                exclude=self.previous_vector_ids)
+            for idx, canonical_id in zip(changed, canonical):
+                if canonical_id:
+                    duplicate_of[records[idx][0]] = canonical_id
+                    self.chunk_links.append(
+                        (self.chunk_count + idx, canonical_id))
+                    if NEAR_DUPLICATE_MODE == "skip":
+                        records[idx] = None
+            changed = [idx for idx in changed if records[idx] is not None]
+        self.chunk_records.extend(record for record in records if record)
 
+        if changed:
+            changed_chunks = [chunks[idx] for idx in changed]
+            changed_ids = [records[idx][0] for idx in changed]
+            self.report(self.file_path, "embedding", self._progress(0.0))
+            embeddings, chunk_hashes, embedded = embed_chunks_with_reuse(
+                changed_chunks,
+                self.pinecone_store,
+                progress_callback=lambda done, total: self.report(
+                    self.file_path, "embedding",
+                    self._progress(0.8 * done / total)),
+            )
 
-def ingest_files(file_paths: List[str]):
+            self.report(self.file_path, "storing", self._progress(0.8))
+            content_registry.add_pending_vectors(self.file_unique_id,
+                                                 changed_ids)
+            store_embeddings(
+                changed_chunks,
+                embeddings,
+                self.file_unique_id,
+                self.pinecone_store,
+                self.file_name,
+                chunk_indexes=[self.chunk_count + idx for idx in changed],
+                chunk_ids=changed_ids,
+                duplicate_of=duplicate_of,
+            )
+
+            # Chunks embedded just now become reusable by later uploads
+            content_registry.add_chunks(
+                {chunk_hashes[idx]: changed_ids[idx]
+                 for idx in embedded})
+            # Canonical for near-duplicates in later chunks and uploads, the
+            # sketches go away with the vectors if the ingestion is rolled back
+            content_registry.add_sketches(sketches)
+        skipped = sum(1 for record in records if record is None)
+        logger.info(
+            f"{self.file_name}: {len(chunks) - len(changed) - skipped} unchanged chunks, "
+            f"{len(changed)} new or changed, "
+            f"{len(duplicate_of)} near-duplicates ({NEAR_DUPLICATE_MODE})")
+        self.chunk_count += len(chunks)
+
+    def _finish(self):
+        vanished = [
+            vector_id for vector_ids in self.previous_chunks.values()
+            for vector_id in vector_ids
+        ]
+        if vanished:
+            logger.info(
+                f"Deleting {len(vanished)} vectors no longer in {self.file_name}"
+            )
+            release_vectors(self.pinecone_store, vanished,
+                            self.file_unique_id)
+        previous_links = [
+            canonical_id for _, canonical_id in
+            content_registry.get_file_links(self.file_unique_id)
+        ]
+        content_registry.set_file_chunks(self.file_unique_id,
+                                         self.chunk_records)
+        content_registry.set_chunk_links(self.file_unique_id,
+                                         self.chunk_links)
+        release_unlinked_vectors(self.pinecone_store, previous_links,
+                                 self.file_unique_id)
+        if self.previous_mapping:
+            # Move the file off its legacy mapping file onto the chunk store
+            chunk_store.put_many(self.legacy_texts)
+            os.remove(f"{self.file_unique_id}.json")
+        content_registry.add_file(self.content_hash, self.file_unique_id,
+                                  self.file_name)
+        content_registry.finish_pending(self.file_unique_id)
+        # Cached answers about the previous content are stale now
+        bump_file_versions([self.file_unique_id])
+        self.report(self.file_path, "done", 1.0)
+
+    def abort(self):
+        rollback_ingestion(self.pinecone_store, self.file_unique_id,
+                           self.file_name, self.is_new)
+
+
+def ingest_files(file_paths: List[str],
+                 progress_callback=None,
+                 content_hashes: dict = None,
+                 update: bool = True,
+                 owner_id: int = None,
+                 staged_paths: dict = None):
+    """
+    Extract, chunk, embed and store each file.
+
+    Files (and page ranges of large PDFs) are extracted and chunked in parallel
+    worker processes, and each segment is embedded and stored as soon as its
+    chunks are ready. A file whose bytes were
+    ingested before is only registered under its new name. A file that fails is
+    logged and skipped so the rest of the batch still gets ingested.
+
+    :param progress_callback: Optional callable(file_path, stage, progress) used to report
+        per-file stage ("extracting", "embedding", "storing", "done", "failed")
+        and progress between 0 and 1.
+    :param content_hashes: Optional {file_path: sha256} computed at upload time.
+    :param update: Re-uploading a filename updates the existing file in place,
+        re-embedding only its new or changed chunks (see FileIngestion).
+    :param owner_id: Optional user_id of the uploader, given access to the files.
+    :param staged_paths: Optional {file_path: path the upload was staged at}
+        (see upload_service.save_upload). Files are read from there and moved
+        to file_path once ingested, or removed if they fail.
+    """
+    content_hashes = content_hashes or {}
+    staged_paths = staged_paths or {}
     openai_key = config["OPENAI_API_KEY"]
-    pinecone_api_key = config["PINECONE_API_KEY"]
-    pinecone_environment = config["PINECONE_ENVIRONMENT"]
 
     OpenAI.api_key = openai_key
-    pinecone.init(api_key=pinecone_api_key, environment=pinecone_environment)
-
-    text_extraction_functions = {
-        "pdf": extract_text_from_pdf,
-        "docx": extract_text_from_docx,
-        # 'doc': extract_text_from_doc,
-        "txt": lambda path: open(path, "r").read(),
-    }
-    for file_path in file_paths:
-        file_extension = file_path.lower().split(".")[-1]
-        file_content = text_extraction_functions.get(file_extension)(file_path)
 
-        text = file_content
-        chunks = split_text_data(text)
+    def report(file_path, stage, progress):
+        if progress_callback:
+            progress_callback(file_path, stage, progress)
 
-        file_unique_id = str(uuid.uuid4())
+    def fail(file_path, error):
+        logger.error(f"Failed to ingest {file_path}: {error}",
+                     exc_info=error)
+        failed_files.append(file_path)
+        ingestion = ingestions.get(file_path)
+        if ingestion is not None:
+            try:
+                ingestion.abort()
+            except Exception as e:
+                # Left for the orphan sweeper (file_service.sweep_orphans)
+                logger.error(f"Rollback of {file_path} failed: {e}")
+        staged_path = staged_paths.get(file_path)
+        if staged_path and os.path.exists(staged_path):
+            os.remove(staged_path)
+        report(file_path, "failed", 1.0)
 
-        file_name = file_path
+    def place(file_path):
+        # The upload now holds what the catalog says file_path holds
+        staged_path = staged_paths.get(file_path)
+        if not staged_path:
+            return
+        try:
+            os.replace(staged_path, file_path)
+        except OSError as e:
+            # The file is ingested all the same, only the upload copy is missing
+            logger.error(f"Could not move {staged_path} to {file_path}: {e}")
 
-        # Update the filenames.json file with the new file name and its unique ID
-        update_filenames_json(file_name, file_unique_id)
-        logger.info(f"Update filenames.json: {file_name} { file_unique_id}")
+    file_unique_id = None
+    failed_files = []
+    ingestions = {}
+    to_extract = []
+    for file_path in file_paths:
+        try:
+            file_name = file_path
+            # Checked at upload too, but the name may have been taken since
+            if not file_catalog.can_replace(file_name, owner_id):
+                raise PermissionError(
+                    f"{file_name} belongs to another user")
+            content_hash = content_hashes.get(file_path) or hash_file(
+                staged_paths.get(file_path, file_path))
+            content_hashes[file_path] = content_hash
+            existing_file_id = content_registry.get_file_id(content_hash)
+            if existing_file_id:
+                # Same bytes already ingested, just register the new name
+                file_unique_id = existing_file_id
+                previous_file_id, still_referenced = file_catalog.register(
+                    file_name, file_unique_id, content_hash, owner_id)
+                if previous_file_id and not still_referenced:
+                    # The name was the last one pointing at its old content
+                    delete_file_vectors(get_vector_index(), previous_file_id)
+                bump_file_versions([
+                    file_id for file_id in (file_unique_id, previous_file_id)
+                    if file_id
+                ])
+                logger.info(
+                    f"{file_name} is a duplicate of {file_unique_id}, skipping ingestion"
+                )
+                place(file_path)
+                report(file_path, "done", 1.0)
+                continue
+            report(file_path, "extracting", 0.0)
+            to_extract.append(file_path)
+        except Exception as e:
+            fail(file_path, e)
 
-        pinecone_store = pinecone.Index(config["PINECONE_INDEX_NAME"])
-        embeddings = generate_embeddings(chunks)
+    tasks = []
+    segment_counts = {}
+    # Extraction reads the staged upload, the rest works on the file name
+    source_names = {}
+    for file_path in to_extract:
+        source_path = staged_paths.get(file_path, file_path)
+        source_names[source_path] = file_path
+        page_ranges = plan_page_ranges(source_path)
+        segment_counts[file_path] = len(page_ranges)
+        tasks += [(source_path, segment, page_numbers)
+                  for segment, page_numbers in enumerate(page_ranges)]
 
-        id_to_text_mapping = store_embeddings(chunks, embeddings,
-                                              file_unique_id, pinecone_store,
-                                              file_name)
+    pinecone_store = get_vector_index()
+    for (source_path, segment,
+         _), chunks, error in iter_extracted_files(tasks):
+        file_path = source_names[source_path]
+        if file_path in failed_files:
+            continue
+        if error is not None:
+            fail(file_path, error)
+            continue
+        try:
+            if file_path not in ingestions:
+                ingestions[file_path] = FileIngestion(
+                    file_path,
+                    content_hashes[file_path],
+                    segment_counts[file_path],
+                    pinecone_store,
+                    report,
+                    update=update,
+                    owner_id=owner_id)
+            ingestion = ingestions[file_path]
+            ingestion.add_segment(segment, chunks)
+            file_unique_id = ingestion.file_unique_id
+            if ingestion.done:
+                place(file_path)
+        except Exception as e:
+            fail(file_path, e)
 
-        save_mapping_to_file(id_to_text_mapping, f"{file_unique_id}.json")
+    if failed_files:
+        return {
+            "message": "Some files could not be processed.",
+            "file_unique_id": file_unique_id,
+            "failed_files": failed_files,
+        }
     return {
         "message": "File processed successfully.",
         "file_unique_id": file_unique_id
@@ -0,0 +1,162 @@
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from config import load_config
+from ingest import ingest_files
+
+config = load_config("config.yaml")
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Jobs running at once across all users
+INGEST_MAX_WORKERS = config.get("INGEST_MAX_WORKERS", 4)
+# Jobs running at once for a single user, the rest wait their turn
+INGEST_MAX_JOBS_PER_USER = config.get("INGEST_MAX_JOBS_PER_USER", 1)
+# How long finished jobs stay available on the status endpoint
+INGEST_JOB_RETENTION_SECONDS = config.get("INGEST_JOB_RETENTION_SECONDS",
+                                          3600)
+
+
+class IngestionJob:
+    def __init__(self,
+                 user_id,
+                 file_paths: List[str],
+                 content_hashes: dict = None,
+                 update: bool = True,
+                 staged_paths: dict = None):
+        self.job_id = str(uuid.uuid4())
+        self.user_id = user_id
+        self.file_paths = file_paths
+        self.content_hashes = content_hashes or {}
+        self.update = update
+        self.staged_paths = staged_paths or {}
+        # Anonymous uploads have no owner in the file catalog
+        self.owner_id = user_id if isinstance(user_id, int) else None
+        self.status = "queued"
+        self.files = {
+            path: {
+                "stage": "queued",
+                "progress": 0.0
+            }
+            for path in file_paths
+        }
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    def update_file(self, file_path: str, stage: str, progress: float):
+        self.files[file_path] = {"stage": stage, "progress": round(progress, 3)}
+
+    def to_dict(self):
+        progress = sum(f["progress"]
+                       for f in self.files.values()) / max(len(self.files), 1)
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "progress": round(progress, 3),
+            "files": self.files,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class IngestionJobQueue:
+    """
+    Runs ingestion jobs on a bounded thread pool.
+
+    Each user has at most max_jobs_per_user jobs running; extra jobs wait in a
+    per-user queue so one bulk uploader can't take every worker.
+    """
+
+    def __init__(self,
+                 max_workers: int = INGEST_MAX_WORKERS,
+                 max_jobs_per_user: int = INGEST_MAX_JOBS_PER_USER):
+        self.max_jobs_per_user = max_jobs_per_user
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="ingest")
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._running = defaultdict(int)
+        self._waiting = defaultdict(deque)
+
+    def submit(self,
+               user_id,
+               file_paths: List[str],
+               content_hashes: dict = None,
+               update: bool = True,
+               staged_paths: dict = None) -> IngestionJob:
+        job = IngestionJob(user_id, file_paths, content_hashes, update,
+                           staged_paths)
+        with self._lock:
+            self._prune()
+            self._jobs[job.job_id] = job
+            if self._running[user_id] < self.max_jobs_per_user:
+                self._start(job)
+            else:
+                self._waiting[user_id].append(job)
+        logger.info(
+            f"Queued ingestion job {job.job_id} for user {user_id}: {file_paths}"
+        )
+        return job
+
+    def get(self, job_id: str):
+        return self._jobs.get(job_id)
+
+    def shutdown(self, wait: bool = False):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    # Must be called with self._lock held
+    def _start(self, job: IngestionJob):
+        self._running[job.user_id] += 1
+        job.status = "running"
+        self._executor.submit(self._run, job)
+
+    def _run(self, job: IngestionJob):
+        try:
+            job.result = ingest_files(job.file_paths,
+                                      progress_callback=job.update_file,
+                                      content_hashes=job.content_hashes,
+                                      update=job.update,
+                                      owner_id=job.owner_id,
+                                      staged_paths=job.staged_paths)
+            job.status = "failed" if job.result.get(
+                "failed_files") else "done"
+        except Exception as e:
+            logger.exception(f"Ingestion job {job.job_id} failed: {e}")
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                self._running[job.user_id] -= 1
+                waiting = self._waiting[job.user_id]
+                if waiting:
+                    self._start(waiting.popleft())
+                if not self._running[job.user_id]:
+                    del self._running[job.user_id]
+                if not waiting:
+                    del self._waiting[job.user_id]
+
+    # Must be called with self._lock held
+    def _prune(self):
+        cutoff = time.time() - INGEST_JOB_RETENTION_SECONDS
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished_at and job.finished_at < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+
+job_queue = IngestionJobQueue()
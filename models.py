@@ -2,10 +2,12 @@ import redis
 from pydantic import BaseModel
 from sqlalchemy import Boolean
 from sqlalchemy import Column
+from sqlalchemy import DateTime
 from sqlalchemy import ForeignKey
 from sqlalchemy import Integer
 from sqlalchemy import String
 from sqlalchemy import UniqueConstraint
+from sqlalchemy import func
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -52,19 +54,25 @@ class UserInDB(User):
     hashed_password: str
 
 
+# One row per file name. Names with identical content share a file_id.
 class File(Base):
     __tablename__ = "files"
 
-    file_id = Column(Integer, primary_key=True, index=True)
-    file_name = Column(String, unique=True, index=True)
+    id = Column(Integer, primary_key=True)
+    file_name = Column(String(255), unique=True, index=True, nullable=False)
+    file_id = Column(String(36), index=True, nullable=False)
+    content_hash = Column(String(64), index=True)
+    owner_id = Column(Integer, ForeignKey("users.user_id"), index=True)
+    created_at = Column(DateTime, server_default=func.now())
 
 
 class UserFile(Base):
     __tablename__ = "user_files"
+    __table_args__ = (UniqueConstraint("user_id", "file_id"), )
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.user_id"))
-    file_id = Column(String, ForeignKey("files.file_id"), unique=True)
+    user_id = Column(Integer, ForeignKey("users.user_id"), index=True)
+    file_id = Column(String(36), index=True)
 
 
 # Model for blacklist tokens
@@ -0,0 +1,130 @@
+import hashlib
+import logging
+import re
+import zlib
+
+import numpy as np
+
+from config import load_config
+from content_registry import content_registry
+
+config = load_config("config.yaml")
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# "off", "flag" (store near-duplicates, marked with the chunk they repeat) or
+# "skip" (don't embed or store them, only link them to that chunk)
+NEAR_DUPLICATE_MODE = config.get("NEAR_DUPLICATE_MODE", "flag")
+# Estimated Jaccard similarity of word shingles above which a chunk is a near-duplicate
+NEAR_DUPLICATE_THRESHOLD = config.get("NEAR_DUPLICATE_THRESHOLD", 0.9)
+
+SHINGLE_SIZE = 5
+MINHASH_PERMUTATIONS = 128
+# 16 bands of 8 rows: chunks ~0.7 similar or more share a band most of the time
+LSH_BANDS = 16
+LSH_ROWS = MINHASH_PERMUTATIONS // LSH_BANDS
+
+MERSENNE_PRIME = (1 << 61) - 1
+# Fixed seed, signatures are stored and compared across processes and restarts
+_random = np.random.RandomState(20230901)
+_A = _random.randint(1, 1 << 32, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+_B = _random.randint(0, 1 << 32, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> set:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def minhash(text: str) -> np.ndarray:
+    hashes = np.fromiter((zlib.crc32(" ".join(shingle).encode("utf-8"))
+                          for shingle in shingles(text)),
+                         dtype=np.uint64)
+    # 32-bit hashes times 32-bit coefficients can't overflow 64 bits
+    return ((np.outer(hashes, _A) + _B) % MERSENNE_PRIME).min(axis=0)
+
+
+def band_keys(signature: np.ndarray) -> list:
+    keys = []
+    for band in range(LSH_BANDS):
+        rows = signature[band * LSH_ROWS:(band + 1) * LSH_ROWS]
+        digest = hashlib.blake2b(bytes([band]) + rows.tobytes(),
+                                 digest_size=8).digest()
+        keys.append(int.from_bytes(digest, "little", signed=True))
+    return keys
+
+
+def similarity(signature: np.ndarray, other: np.ndarray) -> float:
+    return float(np.mean(signature == other))
+
+
+def find_near_duplicates(texts: list, vector_ids: list, exclude=()):
+    """
+    Look for chunks repeating a chunk already stored, or an earlier one of texts.
+
+    :param exclude: Stored vector ids not to link to, e.g. ones about to be replaced.
+
+    :return: (id of the canonical chunk each text repeats, or None,
+        {vector_id: (signature, band keys)} of the texts that repeat nothing)
+    """
+    signatures = [minhash(text) for text in texts]
+    keys = [band_keys(signature) for signature in signatures]
+    candidates = content_registry.get_band_matches(
+        [key for chunk_keys in keys for key in chunk_keys])
+    stored = {
+        vector_id: np.frombuffer(blob, dtype=np.uint64)
+        for vector_id, blob in content_registry.get_sketches(
+            {vector_id
+             for vector_ids in candidates.values()
+             for vector_id in vector_ids}).items()
+    }
+
+    canonical = []
+    sketches = {}
+    for vector_id, signature, chunk_keys in zip(vector_ids, signatures,
+                                                keys):
+        best, best_similarity = None, NEAR_DUPLICATE_THRESHOLD
+        compared = set()
+        for key in chunk_keys:
+            for candidate in candidates.get(key, ()):
+                if candidate in compared or candidate in exclude:
+                    continue
+                compared.add(candidate)
+                candidate_signature = stored.get(candidate)
+                if candidate_signature is None and candidate in sketches:
+                    candidate_signature = sketches[candidate][0]
+                if candidate_signature is None:
+                    continue
+                score = similarity(signature, candidate_signature)
+                if score >= best_similarity:
+                    best, best_similarity = candidate, score
+        canonical.append(best)
+        if best is None:
+            # Later texts of the batch are compared with this one too
+            sketches[vector_id] = (signature, chunk_keys)
+            for key in chunk_keys:
+                candidates.setdefault(key, []).append(vector_id)
+    found = sum(1 for vector_id in canonical if vector_id)
+    if found:
+        logger.info(f"{found} of {len(texts)} chunks are near-duplicates")
+    return canonical, sketches
+
+
+def collapse_duplicates(matches: list, top_k: int) -> list:
+    """
+    Keep the best match of each group of near-duplicates (a canonical chunk and
+    the chunks flagged as repeating it), up to top_k matches.
+    """
+    seen = set()
+    kept = []
+    for match in matches:
+        group = (match.get("metadata") or {}).get("duplicate_of") or match["id"]
+        if group in seen:
+            continue
+        seen.add(group)
+        kept.append(match)
+    return kept[:top_k]
@@ -29,3 +29,43 @@ CREATE TABLE user_files (
     FOREIGN KEY (user_id) REFERENCES users (user_id),
     FOREIGN KEY (file_id) REFERENCES files (file_id)
 );
+
+-- File catalog: one row per file name, names with identical content share a file_id.
+-- Migrates the tables above in place, existing rows are kept.
+-- user_files_ibfk_2 is the name InnoDB gave the file_id foreign key above.
+ALTER TABLE user_files
+    DROP FOREIGN KEY user_files_ibfk_2;
+
+DELETE duplicate FROM user_files duplicate
+    JOIN user_files kept
+    ON duplicate.user_id = kept.user_id AND duplicate.file_id = kept.file_id AND duplicate.id > kept.id;
+
+ALTER TABLE user_files
+    ADD UNIQUE (user_id, file_id),
+    ADD INDEX ix_user_files_file_id (file_id);
+
+-- Rows without a name can't be looked up, their names come back from filenames.json
+-- (see FileCatalog.import_filenames_json)
+DELETE FROM files WHERE file_name IS NULL;
+
+DELETE duplicate FROM files duplicate
+    JOIN files kept
+    ON duplicate.file_name = kept.file_name AND duplicate.file_id > kept.file_id;
+
+ALTER TABLE files
+    DROP PRIMARY KEY,
+    ADD COLUMN id int PRIMARY KEY AUTO_INCREMENT FIRST,
+    MODIFY file_name varchar(255) UNIQUE NOT NULL AFTER id,
+    ADD COLUMN content_hash varchar(64),
+    ADD COLUMN owner_id int,
+    ADD COLUMN created_at datetime DEFAULT CURRENT_TIMESTAMP,
+    ADD INDEX ix_files_file_id (file_id),
+    ADD INDEX ix_files_content_hash (content_hash),
+    ADD INDEX ix_files_owner_id (owner_id),
+    ADD FOREIGN KEY (owner_id) REFERENCES users (user_id);
+
+-- The owner of a file is the user it was uploaded by
+UPDATE files
+    JOIN user_files ON user_files.file_id = files.file_id
+    SET files.owner_id = user_files.user_id
+    WHERE files.owner_id IS NULL;
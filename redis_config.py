@@ -1,13 +1,18 @@
+from functools import lru_cache
+
 import aioredis
+import redis
 from fastapi import FastAPI, Request
 from fastapi_limiter import FastAPILimiter
 from models import TokenBlacklist
 
+REDIS_URL = "redis://localhost"
+
 redis_connection = None
 
 async def startup(app: FastAPI):
     global redis_connection
-    redis_connection = await aioredis.from_url("redis://localhost")
+    redis_connection = await aioredis.from_url(REDIS_URL)
     await FastAPILimiter.init(redis_connection)
     token_blacklist = TokenBlacklist(redis_connection)
     app.state.token_blacklist = token_blacklist
@@ -18,6 +23,7 @@ async def get_redis():
 def get_token_blacklist(request: Request):
     return request.app.state.token_blacklist
 
-
-
-
+# Blocking client for code running outside the event loop (ingestion threads)
+@lru_cache(maxsize=None)
+def get_sync_redis():
+    return redis.Redis.from_url(REDIS_URL)
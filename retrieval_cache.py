@@ -0,0 +1,151 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from config import load_config
+from file_versions import get_scope_version
+from redis_config import get_sync_redis
+
+config = load_config("config.yaml")
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+RETRIEVAL_CACHE_ENABLED = config.get("RETRIEVAL_CACHE_ENABLED", True)
+RETRIEVAL_CACHE_TTL_SECONDS = config.get("RETRIEVAL_CACHE_TTL_SECONDS", 3600)
+# In-process entries, on top of the ones shared in Redis
+RETRIEVAL_CACHE_L1_MAX_ENTRIES = config.get("RETRIEVAL_CACHE_L1_MAX_ENTRIES",
+                                            1024)
+
+
+def quantize_embedding(embedding) -> bytes:
+    """
+    int8 codes of the normalized embedding, so re-computed embeddings of the same
+    text that differ in the last float bits share a key.
+    """
+    vector = np.asarray(embedding, dtype=np.float32)
+    scale = float(np.abs(vector).max()) / 127 or 1.0
+    return np.round(vector / scale).astype(np.int8).tobytes()
+
+
+def filter_file_id(filter_dict):
+    """
+    :return: the file id a query filter restricts matches to, None when it may
+        match any file.
+    """
+    condition = (filter_dict or {}).get("file_id")
+    if isinstance(condition, dict) and len(filter_dict) == 1:
+        return condition.get("$eq")
+    return None
+
+
+def to_plain_response(response) -> dict:
+    # Pinecone returns response objects, keep what the callers read as plain data
+    return {
+        "matches": [{
+            "id": match["id"],
+            "score": float(match["score"]),
+            "metadata": dict(match.get("metadata") or {}),
+        } for match in response["matches"]]
+    }
+
+
+class RetrievalCache:
+    """
+    Vector query results shared by every worker: an in-process LRU in front of
+    Redis.
+
+    Keys are the quantized query embedding, top_k and the filter, prefixed with
+    the scope version from file_versions: the version of the filtered file, or
+    the global one for unfiltered queries. Ingesting or deleting a file bumps
+    its version, so results computed before the change are never returned
+    again. Reading the version costs one Redis GET per lookup.
+    """
+
+    def __init__(self,
+                 ttl: int = RETRIEVAL_CACHE_TTL_SECONDS,
+                 l1_max_entries: int = RETRIEVAL_CACHE_L1_MAX_ENTRIES):
+        self.ttl = ttl
+        self.l1_max_entries = l1_max_entries
+        self._l1 = OrderedDict()  # key -> (response, cached_at)
+        self._lock = threading.Lock()
+        self._counters = {"l1_hits": 0, "l2_hits": 0, "misses": 0}
+
+    def key(self, query_embedding, top_k: int, filter_dict,
+            include_metadata: bool):
+        """
+        :return: the cache key of a query, None when the cache is disabled or
+            Redis is unavailable.
+        """
+        if not RETRIEVAL_CACHE_ENABLED:
+            return None
+        try:
+            scope = get_scope_version(filter_file_id(filter_dict))
+        except Exception as e:
+            logger.error(f"Retrieval cache unavailable: {e}")
+            return None
+        digest = hashlib.sha1(
+            quantize_embedding(query_embedding) + json.dumps(
+                [top_k, filter_dict, include_metadata],
+                sort_keys=True).encode("utf-8")).hexdigest()
+        return f"retrieval:{scope}:{digest}"
+
+    def _count(self, counter: str):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def get(self, key: str):
+        if key is None:
+            return None
+        with self._lock:
+            cached = self._l1.get(key)
+            if cached and time.monotonic() - cached[1] < self.ttl:
+                self._l1.move_to_end(key)
+                self._counters["l1_hits"] += 1
+                return cached[0]
+        try:
+            data = get_sync_redis().get(key)
+        except Exception as e:
+            logger.error(f"Retrieval cache read failed: {e}")
+            data = None
+        if data is None:
+            self._count("misses")
+            return None
+        self._count("l2_hits")
+        response = json.loads(data)
+        self._put_l1(key, response)
+        return response
+
+    def put(self, key: str, response: dict):
+        if key is None:
+            return
+        self._put_l1(key, response)
+        try:
+            get_sync_redis().set(key, json.dumps(response), ex=self.ttl)
+        except Exception as e:
+            logger.error(f"Retrieval cache write failed: {e}")
+
+    def _put_l1(self, key: str, response: dict):
+        with self._lock:
+            self._l1[key] = (response, time.monotonic())
+            self._l1.move_to_end(key)
+            while len(self._l1) > self.l1_max_entries:
+                self._l1.popitem(last=False)
+
+    def stats(self) -> dict:
+        # This process only
+        with self._lock:
+            counters = dict(self._counters)
+        lookups = sum(counters.values())
+        hits = counters["l1_hits"] + counters["l2_hits"]
+        counters["hit_rate"] = hits / lookups if lookups else 0.0
+        return counters
+
+
+retrieval_cache = RetrievalCache()
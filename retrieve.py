@@ -1,10 +1,14 @@
-from functools import lru_cache
+import asyncio
 
 import openai
-import pinecone
 import yaml
 from langchain.llms import OpenAI
 
+from doc_utils import get_match_texts
+from doc_utils import query_pinecone
+from embedding_cache import embedding_cache
+from vector_store import get_vector_index
+
 # from dotenv import dotenv_values
 
 # config = dotenv_values(".env")
@@ -20,31 +24,27 @@ config = load_config("config.yaml")
 openai.api_key = config["OPENAI_API_KEY"]
 
 
-@lru_cache(maxsize=128, typed=False)
+# Cached on disk and shared by all workers (see embedding_cache.py)
 def get_embedding(text: str, model: str = "text-embedding-ada-002"):
-    response = openai.Embedding.create(input=text, model=model)
-    return response["data"][0]["embedding"]
-
-
-# TODO: delete this (moved to doc utils)
+    embedding = embedding_cache.get(text, model)
+    if embedding is None:
+        response = openai.Embedding.create(input=text, model=model)
+        embedding = response["data"][0]["embedding"]
+        embedding_cache.put(text, embedding, model)
+    return embedding
 
 
-@lru_cache(maxsize=128, typed=False)
-def query_pinecone(index,
-                   query_embedding_tuple,
-                   top_k=5,
-                   include_metadata=True):
-    # Convert the tuple back to a list
-    query_embedding = list(query_embedding_tuple)
-
-    response = index.query(query_embedding,
-                           top_k=top_k,
-                           include_metadata=include_metadata)
-    return response
+async def aget_embedding(text: str, model: str = "text-embedding-ada-002"):
+    embedding = await asyncio.to_thread(embedding_cache.get, text, model)
+    if embedding is None:
+        response = await openai.Embedding.acreate(input=text, model=model)
+        embedding = response["data"][0]["embedding"]
+        await asyncio.to_thread(embedding_cache.put, text, embedding, model)
+    return embedding
 
 
 def get_response_texts(response):
-    return [match["metadata"]["text"] for match in response["matches"]]
+    return get_match_texts(response["matches"])
 
 
 def generate_summary(prompt: str):
@@ -87,10 +87,7 @@ def format_summary(summary: str) -> str:
 
 def search_and_chat(search_query: str) -> list:
     openai.api_key = config["OPENAI_API_KEY"]
-    pinecone.init(api_key=config["PINECONE_API_KEY"],
-                  environment=config["PINECONE_ENVIRONMENT"])
-
-    index = pinecone.Index(config["PINECONE_INDEX_NAME"])
+    index = get_vector_index()
 
     query_embeds = get_embedding(search_query)
     response = query_pinecone(index, tuple(query_embeds))
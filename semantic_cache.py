@@ -0,0 +1,145 @@
+import asyncio
+import hashlib
+import logging
+import time
+
+import numpy as np
+
+from config import load_config
+from file_catalog import file_catalog
+from file_versions import aget_scope_version
+from redis_config import get_redis
+
+config = load_config("config.yaml")
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SEMANTIC_CACHE_ENABLED = config.get("SEMANTIC_CACHE_ENABLED", True)
+# Cosine similarity above which a new question gets a cached answer
+SEMANTIC_CACHE_THRESHOLD = config.get("SEMANTIC_CACHE_THRESHOLD", 0.95)
+# Entries unused for this long are dropped
+SEMANTIC_CACHE_TTL_SECONDS = config.get("SEMANTIC_CACHE_TTL_SECONDS",
+                                        24 * 3600)
+# Per scope; every lookup compares the question against all entries of its scope
+SEMANTIC_CACHE_MAX_ENTRIES = config.get("SEMANTIC_CACHE_MAX_ENTRIES", 200)
+
+STATS_KEY = "semcache:stats"
+
+
+class SemanticCache:
+    """
+    Answers to earlier questions, returned for new questions whose embedding is
+    close enough to one already answered.
+
+    Entries are grouped by scope: the file a question is restricted to (or all
+    files) and its version from file_versions. Re-ingesting or deleting a file
+    bumps its version, so answers computed from the old content are no longer
+    looked up and expire with their TTL. Each scope is three Redis keys:
+    normalized embeddings (float16), answers, and a last-used sorted set used
+    for TTL and LRU eviction. Hit/miss counters are shared by all workers.
+    """
+
+    def __init__(self,
+                 threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 ttl: int = SEMANTIC_CACHE_TTL_SECONDS,
+                 max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    @staticmethod
+    def _keys(scope: str):
+        return (f"semcache:{scope}:vectors", f"semcache:{scope}:answers",
+                f"semcache:{scope}:lru")
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    async def get_scope(self, file_name: str = None):
+        """
+        :return: the scope of questions about file_name (or all files), None when
+            the file is unknown.
+        """
+        file_id = None
+        if file_name:
+            file_id = await asyncio.to_thread(file_catalog.get_file_id,
+                                              file_name)
+            if file_id is None:
+                return None
+        return await aget_scope_version(file_id)
+
+    async def get(self, scope: str, embedding):
+        """
+        :return: the cached answer of the most similar question in scope, or None
+            when none reaches the threshold.
+        """
+        r = await get_redis()
+        vectors_key, answers_key, lru_key = self._keys(scope)
+        entries = await r.hgetall(vectors_key)
+        answer = None
+        if entries:
+            entry_ids = list(entries)
+            matrix = np.frombuffer(b"".join(entries[entry_id]
+                                            for entry_id in entry_ids),
+                                   dtype=np.float16).reshape(
+                                       len(entry_ids), -1)
+            scores = matrix.astype(np.float32) @ self._normalize(embedding)
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                answer = await r.hget(answers_key, entry_ids[best])
+                if answer is not None:
+                    await r.zadd(lru_key, {entry_ids[best]: time.time()})
+                    answer = answer.decode("utf-8")
+                    logger.info(
+                        f"Semantic cache hit in {scope}, similarity {scores[best]:.3f}"
+                    )
+        await r.hincrby(STATS_KEY, "misses" if answer is None else "hits", 1)
+        return answer
+
+    async def put(self, scope: str, embedding, answer: str):
+        vector = self._normalize(embedding).astype(np.float16).tobytes()
+        entry_id = hashlib.sha1(vector).hexdigest()
+        now = time.time()
+        r = await get_redis()
+        vectors_key, answers_key, lru_key = self._keys(scope)
+        pipe = r.pipeline(transaction=False)
+        pipe.hset(vectors_key, entry_id, vector)
+        pipe.hset(answers_key, entry_id, answer)
+        pipe.zadd(lru_key, {entry_id: now})
+        pipe.zrangebyscore(lru_key, 0, now - self.ttl)
+        pipe.zcard(lru_key)
+        *_, stale, count = await pipe.execute()
+        # Entries unused for the TTL, then the least recently used over the limit
+        overflow = count - len(stale) - self.max_entries
+        if overflow > 0:
+            stale += await r.zrange(lru_key, len(stale),
+                                    len(stale) + overflow - 1)
+        pipe = r.pipeline(transaction=False)
+        if stale:
+            pipe.hdel(vectors_key, *stale)
+            pipe.hdel(answers_key, *stale)
+            pipe.zrem(lru_key, *stale)
+        # Scopes of old file versions are never read again, let them expire
+        for key in (vectors_key, answers_key, lru_key):
+            pipe.expire(key, self.ttl)
+        await pipe.execute()
+
+    async def stats(self) -> dict:
+        r = await get_redis()
+        counters = await r.hgetall(STATS_KEY)
+        hits = int(counters.get(b"hits", 0))
+        misses = int(counters.get(b"misses", 0))
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+
+semantic_cache = SemanticCache()
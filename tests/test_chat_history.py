@@ -0,0 +1,219 @@
+import asyncio
+import json
+import sys
+import types
+
+import pytest
+
+try:
+    import redis_config  # noqa: F401
+except ImportError:
+    # chat_utils only takes get_redis from redis_config, which these tests
+    # replace with FakeRedis, so they run without the Redis client installed
+    redis_config = types.ModuleType("redis_config")
+    redis_config.get_redis = None
+    sys.modules["redis_config"] = redis_config
+
+from chat import chat_utils  # noqa: E402
+from chat.chat_utils import COMPRESS_MIN_BYTES  # noqa: E402
+from chat.chat_utils import MESSAGE_HEADER  # noqa: E402
+from chat.chat_utils import chat_key  # noqa: E402
+from chat.chat_utils import decode_message  # noqa: E402
+from chat.chat_utils import encode_message  # noqa: E402
+from chat.chat_utils import limit_chat_history  # noqa: E402
+
+
+class FakeRedis:
+    """
+    In-memory stand-in for the aioredis list commands the chat history uses.
+    Pipelines queue commands and run them in order on execute.
+    """
+
+    def __init__(self):
+        self.lists = {}
+        self.ttls = {}
+
+    def _lrange(self, key, start, end):
+        values = self.lists.get(key, [])
+        start = max(len(values) + start, 0) if start < 0 else start
+        end = len(values) + end if end < 0 else end
+        return values[start:end + 1]
+
+    def _rpush(self, key, *values):
+        self.lists.setdefault(key, []).extend(values)
+        return len(self.lists[key])
+
+    def _lpush(self, key, *values):
+        for value in values:
+            self.lists.setdefault(key, []).insert(0, value)
+        return len(self.lists[key])
+
+    def _ltrim(self, key, start, end):
+        self.lists[key] = self._lrange(key, start, end)
+        return True
+
+    def _expire(self, key, seconds):
+        self.ttls[key] = seconds
+        return key in self.lists
+
+    def _unlink(self, *keys):
+        return sum(self.lists.pop(key, None) is not None for key in keys)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        command = getattr(self, f"_{name}")
+
+        async def run(*args):
+            return command(*args)
+
+        return run
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self.redis, f"_{name}")
+
+        def queue(*args):
+            self.commands.append((command, args))
+            return self
+
+        return queue
+
+    async def execute(self):
+        return [command(*args) for command, args in self.commands]
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    redis = FakeRedis()
+
+    async def get_redis():
+        return redis
+
+    monkeypatch.setattr(chat_utils, "get_redis", get_redis)
+    # Whitespace tokens keep the counts readable and need no encoding files
+    monkeypatch.setattr(chat_utils, "count_tokens",
+                        lambda text, model: len(text.split()))
+    return redis
+
+
+# Test cases for the stored chat history format
+def test_codec_round_trip():
+    msg = {"user": "Human", "message": "Hello, how are you? ✓", "tokens": 7}
+    record = encode_message(msg)
+    # Short messages are stored as is
+    assert record[MESSAGE_HEADER.size:] == msg["message"].encode("utf-8")
+    assert decode_message(record) == msg
+
+
+def test_codec_compressed():
+    text = "The same answer, over and over. " * 100
+    assert len(text) > COMPRESS_MIN_BYTES
+    msg = {"user": "bot", "message": text, "tokens": 800}
+    record = encode_message(msg)
+    assert len(record) < len(text)
+    assert decode_message(record) == msg
+
+
+def test_chat_key():
+    assert chat_key(7) == "chat:7:conversation:default"
+    assert chat_key(7, "work") == "chat:7:conversation:work"
+
+
+def test_conversations_kept_apart(fake_redis):
+    asyncio.run(
+        chat_utils.save_bot_response(7, [], "Hi there", "Hello",
+                                     conversation_id="work"))
+    assert asyncio.run(chat_utils.get_chat_history_redis(
+        7, "work")) == ["Human: Hello", "bot: Hi there"]
+    assert asyncio.run(chat_utils.get_chat_messages(7)) == []
+    assert fake_redis.ttls[chat_key(
+        7, "work")] == chat_utils.CHAT_HISTORY_TTL_SECONDS
+
+
+def test_import_legacy_history(fake_redis):
+    fake_redis.lists["chat:7"] = [
+        json.dumps({
+            "user": "Human",
+            "message": "old question"
+        }),
+        b"not json",
+        json.dumps({
+            "user": "bot",
+            "message": "old answer"
+        }),
+    ]
+    fake_redis.lists["chat:7:tokens"] = [b"4"]
+    fake_redis.lists[chat_key(7)] = [
+        encode_message({
+            "user": "Human",
+            "message": "new question"
+        })
+    ]
+
+    assert asyncio.run(chat_utils.import_legacy_history(fake_redis, 7)) == 2
+    history = asyncio.run(chat_utils.get_chat_messages(7))
+    # The old messages go ahead of the new one, and the old keys are gone
+    assert [msg["message"] for msg in history
+            ] == ["old question", "old answer", "new question"]
+    assert "chat:7" not in fake_redis.lists
+    assert "chat:7:tokens" not in fake_redis.lists
+    # A second caller finds nothing left to import
+    assert asyncio.run(chat_utils.import_legacy_history(fake_redis, 7)) == 0
+
+
+def test_legacy_history_imported_on_read(fake_redis):
+    fake_redis.lists["chat:7"] = [
+        json.dumps({
+            "user": "bot",
+            "message": "old answer"
+        })
+    ]
+    assert asyncio.run(
+        chat_utils.get_chat_history_redis(7)) == ["bot: old answer"]
+
+
+# Test cases for trimming the chat history by tokens
+def test_limit_chat_history():
+    history = [{
+        "user": "Human" if i % 2 == 0 else "bot",
+        "message": f"message {i}",
+        "tokens": 10
+    } for i in range(6)]
+
+    # 60 tokens of history plus 10 new ones, down to 35
+    assert limit_chat_history(history, 70, token_limit=35) == (4, 40)
+    assert limit_chat_history(history, 70, token_limit=100) == (0, 0)
+    # Can't drop more than the whole history
+    assert limit_chat_history(history, 70, token_limit=0) == (6, 60)
+
+
+def test_save_bot_response_trims_by_tokens(fake_redis, monkeypatch):
+    monkeypatch.setattr(chat_utils, "CHAT_HISTORY_TOKEN_LIMIT", 20)
+
+    async def turn(number):
+        history = await chat_utils.get_chat_messages(7)
+        # "Human: question N" and "bot: answer N" are 3 tokens each
+        await chat_utils.save_bot_response(7, history, f"answer {number}",
+                                           f"question {number}")
+
+    for number in range(5):
+        asyncio.run(turn(number))
+
+    # Three turns fit in 20 tokens; the oldest messages went first
+    history = asyncio.run(chat_utils.get_chat_messages(7))
+    assert [msg["message"] for msg in history] == [
+        "question 2", "answer 2", "question 3", "answer 3", "question 4",
+        "answer 4"
+    ]
+    assert all(msg["tokens"] == 3 for msg in history)
+    assert fake_redis.ttls[chat_key(7)] == chat_utils.CHAT_HISTORY_TTL_SECONDS
@@ -0,0 +1,46 @@
+from chunk_store import ChunkStore
+
+
+# Test cases for the chunk store
+def test_put_get(tmp_path):
+    store = ChunkStore(str(tmp_path / "chunks"))
+    store.put_many({"a": "first chunk", "b": "second chunk, é"})
+    assert store.get("a") == "first chunk"
+    assert store.get_many(["a", "b", "missing"]) == {
+        "a": "first chunk",
+        "b": "second chunk, é",
+    }
+    assert store.get("missing") is None
+
+
+def test_overwrite_and_delete(tmp_path):
+    store = ChunkStore(str(tmp_path / "chunks"))
+    store.put_many({"a": "old", "b": "kept"})
+    store.put("a", "new")
+    assert store.get("a") == "new"
+
+    store.delete(["a", "missing"])
+    assert store.get("a") is None
+    assert store.get("b") == "kept"
+    stats = store.stats()
+    assert stats["chunks"] == 1
+    assert stats["live_bytes"] == len("kept")
+    assert stats["dead_bytes"] == len("old") + len("new")
+
+
+def test_compact(tmp_path):
+    path = str(tmp_path / "chunks")
+    store = ChunkStore(path)
+    store.put_many({str(i): f"chunk {i}" for i in range(10)})
+    store.delete([str(i) for i in range(0, 10, 2)])
+    store.compact()
+
+    stats = store.stats()
+    assert stats["chunks"] == 5
+    assert stats["dead_bytes"] == 0
+    assert store.get_many([str(i) for i in range(10)]) == {
+        str(i): f"chunk {i}"
+        for i in range(1, 10, 2)
+    }
+    # Another process' view picks up the compacted files
+    assert ChunkStore(path).get("9") == "chunk 9"
@@ -0,0 +1,54 @@
+from chat.context_packer import PROMPT_OVERHEAD_TOKENS
+from chat.context_packer import fit_history
+from chat.context_packer import fits_budget
+from chat.context_packer import pack_context
+
+
+def word_count(text):
+    return len(text.split())
+
+
+# Test cases for budgeting the chat prompt
+def test_fits_budget():
+    assert fits_budget(100 - PROMPT_OVERHEAD_TOKENS, budget=100)
+    assert not fits_budget(101 - PROMPT_OVERHEAD_TOKENS, budget=100)
+
+
+def test_pack_context_by_score():
+    chunks = [
+        (0.2, "low scored chunk about apples"),
+        (0.9, "best chunk about the quarterly report"),
+        (0.5, "middle chunk about the office move"),
+    ]
+    budget = 20 + PROMPT_OVERHEAD_TOKENS
+    assert pack_context(chunks, 0, word_count, budget) == [1, 2, 0]
+    # Only room for the best one, then the one that still fits
+    assert pack_context(chunks, 10, word_count, budget) == [1]
+    assert pack_context(chunks, 20, word_count, budget) == []
+
+
+def test_pack_context_skips_redundant_chunks():
+    text = "the quarterly report shows revenue growing in every region this year"
+    chunks = [
+        (0.9, text),
+        (0.8, text + " again"),
+        (0.7, "an unrelated chunk about the office move"),
+    ]
+    assert pack_context(chunks, 0, word_count, 1000) == [0, 2]
+
+
+def test_fit_history():
+    history = [{"user": "Human", "message": f"message {i}"} for i in range(4)]
+    budget = 50 + PROMPT_OVERHEAD_TOKENS
+
+    # Each message costs 10 tokens plus one for its separator
+    kept, tokens = fit_history(history, 72, lambda msg: 10, budget)
+    assert kept == history[2:]
+    assert tokens == 50
+    kept, tokens = fit_history(history, 40, lambda msg: 10, budget)
+    assert kept == history
+    assert tokens == 40
+    # Dropping everything is the most it can do
+    kept, tokens = fit_history(history, 500, lambda msg: 10, budget)
+    assert kept == []
+    assert tokens == 456
@@ -1,4 +1,53 @@
+import os
+import time
+
+
 # Test cases for the /delete endpoint
-def test_delete_file(client):
-    # TODO: Implement test cases once the endpoint is fully implemented
-    pass
\ No newline at end of file
+def test_delete_file(token, client):
+    headers = {"Authorization": f"Bearer {token}"}
+    response = client.post("/files",
+                           headers=headers,
+                           files={"files": ("delete_me.txt", b"test content")})
+    assert response.status_code == 202
+    job_id = response.json()["job_id"]
+    # Wait for ingestion to register the file
+    for _ in range(60):
+        status = client.get(f"/files/jobs/{job_id}",
+                            headers=headers).json()["status"]
+        if status in ("done", "failed"):
+            break
+        time.sleep(1)
+    assert status == "done"
+
+    # Anonymous callers can't delete anything
+    response = client.post("/files/delete/delete_me.txt")
+    assert response.status_code == 401
+    assert os.path.exists("uploads/delete_me.txt")
+
+    response = client.post("/files/delete/delete_me.txt", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["file_name"] == "uploads/delete_me.txt"
+    assert not os.path.exists("uploads/delete_me.txt")
+
+    # Already gone
+    response = client.post("/files/delete/delete_me.txt", headers=headers)
+    assert response.status_code == 404
+
+
+def test_delete_file_of_another_user(token, client):
+    headers = {"Authorization": f"Bearer {token}"}
+    # Uploaded anonymously, so not owned by the logged in user
+    response = client.post("/files",
+                           files={"files": ("not_mine.txt", b"other content")})
+    assert response.status_code == 202
+    job_id = response.json()["job_id"]
+    for _ in range(60):
+        status = client.get(f"/files/jobs/{job_id}").json()["status"]
+        if status in ("done", "failed"):
+            break
+        time.sleep(1)
+    assert status == "done"
+
+    response = client.post("/files/delete/not_mine.txt", headers=headers)
+    assert response.status_code == 404
+    assert os.path.exists("uploads/not_mine.txt")
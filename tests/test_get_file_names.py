@@ -1,5 +1,21 @@
-# Test cases for the /filenames.json endpoint
+# Test cases for the /files endpoint
 def test_get_file_names(client):
     response = client.get("/files")
     assert response.status_code == 200
     assert "application/json" in response.headers["content-type"]
+    assert isinstance(response.json()["files"], list)
+
+
+def test_get_file_names_paginated(client):
+    response = client.get("/files", params={"limit": 1})
+    assert response.status_code == 200
+    page = response.json()
+    assert len(page["files"]) <= 1
+    if page["next_cursor"]:
+        response = client.get("/files",
+                              params={
+                                  "limit": 1,
+                                  "after": page["next_cursor"]
+                              })
+        assert response.status_code == 200
+        assert response.json()["files"] != page["files"]
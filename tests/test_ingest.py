@@ -0,0 +1,121 @@
+import os
+
+import docx
+import numpy as np
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import ingest
+from chunk_store import ChunkStore
+from content_registry import ContentRegistry
+from file_catalog import FileCatalog
+from ingest import FileIngestion
+from ingest import extract_and_chunk
+from models import Base
+from vector_store import LocalVectorIndex
+
+
+# Test cases for extraction and chunking, as run by the extraction workers
+def test_extract_and_chunk_docx(tmp_path):
+    document = docx.Document()
+    document.add_paragraph("Quarterly report")
+    document.add_paragraph("Revenue grew in every region.")
+    table = document.add_table(rows=1, cols=2)
+    table.cell(0, 0).text = "Region"
+    table.cell(0, 1).text = "North"
+    file_path = str(tmp_path / "report.docx")
+    document.save(file_path)
+
+    text = "\n".join(extract_and_chunk(file_path))
+    assert "Quarterly report" in text
+    assert "Revenue grew in every region." in text
+    assert "Region | North" in text
+
+
+def test_extract_and_chunk_txt(tmp_path):
+    file_path = tmp_path / "notes.txt"
+    file_path.write_text("Meeting notes: the office move is planned.")
+    assert extract_and_chunk(str(file_path)) == [
+        "Meeting notes: the office move is planned."
+    ]
+
+
+def test_extract_and_chunk_empty_file(tmp_path):
+    file_path = tmp_path / "empty.txt"
+    file_path.write_bytes(b"")
+    assert extract_and_chunk(str(file_path)) == []
+
+
+@pytest.fixture
+def stores(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'catalog.db'}")
+    Base.metadata.create_all(engine)
+    catalog = FileCatalog(sessionmaker(bind=engine), cache_ttl=0)
+    registry = ContentRegistry(str(tmp_path / "registry.db"))
+    store = ChunkStore(str(tmp_path / "chunks"))
+    index = LocalVectorIndex(str(tmp_path / "index"), recall_sample=0)
+    monkeypatch.setattr(ingest, "file_catalog", catalog)
+    monkeypatch.setattr(ingest, "content_registry", registry)
+    monkeypatch.setattr(ingest, "chunk_store", store)
+    monkeypatch.setattr(ingest, "get_vector_index", lambda: index)
+    return catalog, registry, store, index
+
+
+def test_new_version_releases_replaced_file(stores):
+    catalog, registry, store, index = stores
+    # uploads/report.txt points at old, the only name doing so
+    index.upsert([("old_0", np.ones(4), {"file_id": "old"})])
+    store.put("old_0", "old text")
+    registry.set_file_chunks("old", [("old_0", "h0")])
+    registry.add_file("hash-old", "old", "uploads/report.txt")
+    catalog.register("uploads/report.txt", "old", "hash-old", 1)
+
+    ingestion = FileIngestion("uploads/report.txt",
+                              "hash-new",
+                              1,
+                              index,
+                              lambda *args: None,
+                              update=False,
+                              owner_id=1)
+    assert ingestion.file_unique_id != "old"
+    assert catalog.get_file_id("uploads/report.txt") == ingestion.file_unique_id
+    # The old content is unreachable, its vectors go right away
+    assert index.fetch(ids=["old_0"])["vectors"] == {}
+    assert store.get("old_0") is None
+    assert registry.get_file_chunks("old") == []
+
+
+def test_staged_upload_moved_into_place(stores, tmp_path):
+    catalog, registry, store, index = stores
+    registry.add_file("hash-known", "known", "uploads/first.txt")
+    file_path = str(tmp_path / "copy.txt")
+    staged_path = str(tmp_path / "tmp1.part.txt")
+    with open(staged_path, "wb") as f:
+        f.write(b"same bytes as first.txt")
+
+    result = ingest.ingest_files([file_path],
+                                 content_hashes={file_path: "hash-known"},
+                                 owner_id=1,
+                                 staged_paths={file_path: staged_path})
+    assert "failed_files" not in result
+    assert catalog.get_file_id(file_path) == "known"
+    assert not os.path.exists(staged_path)
+    with open(file_path, "rb") as f:
+        assert f.read() == b"same bytes as first.txt"
+
+
+def test_failed_upload_staging_removed(stores, tmp_path):
+    catalog, registry, store, index = stores
+    file_path = str(tmp_path / "theirs.txt")
+    catalog.register(file_path, "theirs", "hash-theirs", 2)
+    staged_path = str(tmp_path / "tmp2.part.txt")
+    with open(staged_path, "wb") as f:
+        f.write(b"new bytes")
+
+    result = ingest.ingest_files([file_path],
+                                 owner_id=1,
+                                 staged_paths={file_path: staged_path})
+    assert result["failed_files"] == [file_path]
+    assert not os.path.exists(staged_path)
+    assert not os.path.exists(file_path)
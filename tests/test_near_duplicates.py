@@ -0,0 +1,104 @@
+import numpy as np
+
+import doc_utils
+import ingest
+import retrieval_cache
+from chunk_store import ChunkStore
+from content_registry import ContentRegistry
+from near_duplicates import band_keys
+from near_duplicates import collapse_duplicates
+from near_duplicates import minhash
+from near_duplicates import similarity
+from vector_store import LocalVectorIndex
+
+TEXT = (
+    "The quarterly report shows revenue growing in every region, led by "
+    "strong demand for the new product line and lower shipping costs. "
+    "Operating margins improved for the third quarter in a row.")
+
+
+# Test cases for near-duplicate detection
+def test_minhash_similarity():
+    signature = minhash(TEXT)
+    assert similarity(signature, minhash(TEXT)) == 1.0
+    # Whitespace and case don't change the shingles
+    assert similarity(signature, minhash(TEXT.upper().replace(" ",
+                                                              "  "))) == 1.0
+    edited = TEXT.replace("third", "fourth")
+    assert 0.5 < similarity(signature, minhash(edited)) < 1.0
+    unrelated = "Meeting notes: the office move is planned for next spring."
+    assert similarity(signature, minhash(unrelated)) < 0.2
+
+
+def test_band_keys():
+    keys = band_keys(minhash(TEXT))
+    assert keys == band_keys(minhash(TEXT))
+    assert len(set(keys)) == len(keys)
+    # Texts that share most shingles share some bands
+    assert set(keys) & set(band_keys(minhash(TEXT + " Thanks.")))
+
+
+def test_collapse_duplicates():
+    matches = [
+        {"id": "a", "score": 0.9, "metadata": {}},
+        {"id": "b", "score": 0.8, "metadata": {"duplicate_of": "a"}},
+        {"id": "c", "score": 0.7},
+        {"id": "d", "score": 0.6, "metadata": {"duplicate_of": "x"}},
+        {"id": "e", "score": 0.5, "metadata": {"duplicate_of": "x"}},
+    ]
+    assert [match["id"] for match in collapse_duplicates(matches, 10)
+            ] == ["a", "c", "d"]
+    assert [match["id"]
+            for match in collapse_duplicates(matches, 2)] == ["a", "c"]
+
+
+class FakeCatalog:
+    def __init__(self, file_ids):
+        self.file_ids = file_ids
+
+    def get_file_id(self, file_name):
+        return self.file_ids.get(file_name)
+
+
+def test_skipped_chunk_survives_canonical_file(tmp_path, monkeypatch):
+    registry = ContentRegistry(str(tmp_path / "registry.db"))
+    store = ChunkStore(str(tmp_path / "chunks"))
+    index = LocalVectorIndex(str(tmp_path / "index"), recall_sample=0)
+    monkeypatch.setattr(ingest, "content_registry", registry)
+    monkeypatch.setattr(ingest, "chunk_store", store)
+    monkeypatch.setattr(doc_utils, "content_registry", registry)
+    monkeypatch.setattr(doc_utils, "file_catalog",
+                        FakeCatalog({
+                            "a.txt": "a",
+                            "b.txt": "b"
+                        }))
+    monkeypatch.setattr(retrieval_cache, "RETRIEVAL_CACHE_ENABLED", False)
+
+    vectors = np.eye(4, dtype=np.float32)
+    # File a holds two chunks; file b's first chunk repeats a_0 and was skipped
+    index.upsert([("a_0", vectors[0], {"file_id": "a"}),
+                  ("a_1", vectors[1], {"file_id": "a"}),
+                  ("b_1", vectors[2], {"file_id": "b"})])
+    store.put_many({"a_0": "shared", "a_1": "only in a", "b_1": "only in b"})
+    registry.set_file_chunks("a", [("a_0", "h0"), ("a_1", "h1")])
+    registry.set_file_chunks("b", [("b_1", "h2")])
+    registry.set_chunk_links("b", [(0, "a_0")])
+
+    def search(file_name):
+        matches = doc_utils.search_documents_by_file_name(
+            index, tuple(vectors[0]), file_name, top_k=2)["matches"]
+        return [match["id"] for match in matches]
+
+    # The file-scoped search reaches the skipped chunk through its link
+    assert search("b.txt") == ["a_0", "b_1"]
+
+    # Deleting file a keeps the vector file b is linked to
+    assert ingest.delete_file_vectors(index, "a") == 1
+    assert list(index.fetch(ids=["a_0", "a_1"])["vectors"]) == ["a_0"]
+    assert store.get("a_0") == "shared"
+    assert search("b.txt") == ["a_0", "b_1"]
+
+    # Once file b goes too, nothing is left behind
+    assert ingest.delete_file_vectors(index, "b") == 2
+    assert index.fetch(ids=["a_0", "b_1"])["vectors"] == {}
+    assert registry.get_file_ids() == set()
@@ -13,7 +13,22 @@ def test_upload_files():
         temp_file.seek(0)
         response = client.post("/files",
                                files={"files": (temp_file.name, temp_file)})
-        assert response.status_code == 200
-        assert "File uploaded and ingested successfully." in response.json(
+        assert response.status_code == 202
+        assert "Files uploaded and queued for ingestion." in response.json(
         )["message"]
+        job_id = response.json()["job_id"]
+        assert job_id
+
+        # Job status is available right away
+        response = client.get(f"/files/jobs/{job_id}")
+        assert response.status_code == 200
+        assert response.json()["job_id"] == job_id
+        assert response.json()["status"] in ("queued", "running", "done",
+                                             "failed")
     os.unlink(temp_file.name)
+
+
+def test_get_unknown_ingestion_job():
+    client = TestClient(app)
+    response = client.get("/files/jobs/does-not-exist")
+    assert response.status_code == 404
@@ -0,0 +1,57 @@
+import asyncio
+import io
+import os
+
+import pytest
+from fastapi import HTTPException
+
+from upload_service import discard_uploads
+from upload_service import save_upload
+
+
+class FakeUpload:
+    """
+    The part of fastapi.UploadFile save_upload uses.
+    """
+
+    def __init__(self, filename, data):
+        self.filename = filename
+        self.file = io.BytesIO(data)
+
+    async def read(self, size=-1):
+        return self.file.read(size)
+
+    async def close(self):
+        self.file.close()
+
+
+# Test cases for staging uploads
+def test_save_upload_stages_each_upload(tmp_path):
+    upload_dir = str(tmp_path)
+    first = asyncio.run(
+        save_upload(FakeUpload("../report.pdf", b"first"), upload_dir))
+    second = asyncio.run(
+        save_upload(FakeUpload("report.pdf", b"second"), upload_dir))
+
+    file_path, staged_path, content_hash, size = first
+    assert file_path == os.path.join(upload_dir, "report.pdf")
+    assert staged_path != second[1]
+    assert staged_path.endswith(".pdf")
+    assert size == 5
+    assert content_hash != second[2]
+    # Nothing is at the final path until ingestion moves it there
+    assert not os.path.exists(file_path)
+    with open(staged_path, "rb") as f:
+        assert f.read() == b"first"
+
+    discard_uploads([staged_path, second[1]])
+    assert os.listdir(upload_dir) == []
+
+
+def test_save_upload_too_large(tmp_path):
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(
+            save_upload(FakeUpload("big.txt", b"x" * 100), str(tmp_path),
+                        max_bytes=10))
+    assert error.value.status_code == 413
+    assert os.listdir(tmp_path) == []
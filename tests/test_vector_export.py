@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+import vector_export
+from content_registry import ContentRegistry
+from vector_export import export_vectors
+from vector_export import read_export
+
+
+class FlakyIndex:
+    """
+    Holds a vector per id and fails the fetch after fail_after pages.
+    """
+
+    def __init__(self, ids, fail_after=None):
+        self.vectors = {
+            vector_id: [float(i), 1.0, -1.0]
+            for i, vector_id in enumerate(ids)
+        }
+        self.fail_after = fail_after
+        self.fetches = 0
+
+    def fetch(self, ids):
+        self.fetches += 1
+        if self.fail_after is not None and self.fetches > self.fail_after:
+            raise ConnectionError("index unavailable")
+        return {
+            "vectors": {
+                vector_id: {
+                    "values": self.vectors[vector_id],
+                    "metadata": {
+                        "text": vector_id
+                    }
+                }
+                for vector_id in ids
+            }
+        }
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    registry = ContentRegistry(str(tmp_path / "registry.db"))
+    registry.set_file_chunks("a", [(f"a_{i}", f"ha{i}") for i in range(5)])
+    registry.set_file_chunks("b", [(f"b_{i}", f"hb{i}") for i in range(4)])
+    monkeypatch.setattr(vector_export, "content_registry", registry)
+    return registry
+
+
+# Test cases for the resumable vector export
+def test_export_round_trip(tmp_path, registry):
+    path = str(tmp_path / "vectors.bin")
+    ids = [f"a_{i}" for i in range(5)] + [f"b_{i}" for i in range(4)]
+    index = FlakyIndex(ids)
+
+    assert export_vectors(path, index, page_size=4) == 9
+    exported = list(read_export(path))
+    assert [vector_id for vector_id, _, _ in exported] == ids
+    assert np.array_equal(exported[2][1],
+                          np.array([2.0, 1.0, -1.0], dtype=np.float32))
+    assert exported[2][2] == {"text": "a_2"}
+
+
+def test_export_resume(tmp_path, registry):
+    path = str(tmp_path / "vectors.bin")
+    ids = [f"a_{i}" for i in range(5)] + [f"b_{i}" for i in range(4)]
+
+    with pytest.raises(ConnectionError):
+        export_vectors(path, FlakyIndex(ids, fail_after=2), page_size=2)
+    assert len(list(read_export(path))) == 4
+
+    # Picks up after the last saved page, nothing is written twice; the
+    # count covers the whole export, not only this call's pages
+    index = FlakyIndex(ids)
+    assert export_vectors(path, index, page_size=2) == 9
+    assert index.fetches == 3
+    assert [vector_id for vector_id, _, _ in read_export(path)] == ids
+
+    # Already complete: nothing to write, the export's total is reported
+    index = FlakyIndex(ids)
+    assert export_vectors(path, index, page_size=2) == 9
+    assert index.fetches == 0
+
+    # Restarting writes everything again
+    assert export_vectors(path, FlakyIndex(ids), page_size=2,
+                          resume=False) == 9
+    assert len(list(read_export(path))) == 9
+
+
+def test_export_one_file(tmp_path, registry):
+    path = str(tmp_path / "vectors.bin")
+    ids = [f"b_{i}" for i in range(4)]
+
+    assert export_vectors(path, FlakyIndex(ids), file_id="b") == 4
+    assert [vector_id for vector_id, _, _ in read_export(path)] == ids
+
+    # The cursor belongs to file b, it can't resume an export of file a
+    with pytest.raises(ValueError):
+        export_vectors(path, FlakyIndex(ids), file_id="a")
+    with pytest.raises(ValueError):
+        export_vectors(path, FlakyIndex(ids))
+    assert export_vectors(path, FlakyIndex([f"a_{i}" for i in range(5)]),
+                          file_id="a",
+                          resume=False) == 5
@@ -0,0 +1,87 @@
+import numpy as np
+
+from vector_store import LocalVectorIndex
+
+
+def make_index(path, quantization="none"):
+    return LocalVectorIndex(str(path),
+                            quantization=quantization,
+                            recall_sample=0)
+
+
+def random_vectors(count, dimension=16, seed=0):
+    return np.random.RandomState(seed).randn(count,
+                                             dimension).astype(np.float32)
+
+
+# Test cases for the local vector index
+def test_add_query_delete(tmp_path):
+    index = make_index(tmp_path / "index")
+    vectors = random_vectors(20)
+    index.upsert([(f"v{i}", vectors[i], {
+        "file_id": "a" if i < 10 else "b"
+    }) for i in range(20)])
+
+    matches = index.query(vector=vectors[3], top_k=3,
+                          include_metadata=True)["matches"]
+    assert matches[0]["id"] == "v3"
+    assert abs(matches[0]["score"] - 1.0) < 1e-5
+    assert matches[0]["metadata"] == {"file_id": "a"}
+
+    matches = index.query(vector=vectors[3],
+                          top_k=5,
+                          filter={"file_id": {
+                              "$eq": "b"
+                          }})["matches"]
+    assert len(matches) == 5
+    assert all(int(match["id"][1:]) >= 10 for match in matches)
+
+    index.delete(ids=["v3"])
+    assert "v3" not in index.fetch(ids=["v3"])["vectors"]
+    matches = index.query(vector=vectors[3], top_k=1)["matches"]
+    assert matches[0]["id"] != "v3"
+    assert index.describe_index_stats()["total_vector_count"] == 19
+
+
+def test_reload_from_log(tmp_path):
+    index = make_index(tmp_path / "index")
+    vectors = random_vectors(5)
+    index.upsert([(f"v{i}", vectors[i]) for i in range(5)])
+    index.delete(ids=["v0"])
+
+    reloaded = make_index(tmp_path / "index")
+    fetched = reloaded.fetch(ids=["v0", "v1"])["vectors"]
+    assert list(fetched) == ["v1"]
+    assert np.allclose(fetched["v1"]["values"], vectors[1])
+
+
+def test_int8_round_trip(tmp_path):
+    exact = make_index(tmp_path / "exact")
+    index = make_index(tmp_path / "int8", quantization="int8")
+    vectors = random_vectors(200)
+    exact.upsert([(f"v{i}", vectors[i]) for i in range(200)])
+    index.upsert([(f"v{i}", vectors[i]) for i in range(200)])
+
+    # One byte per dimension plus a float32 scale per vector in memory
+    stats = index.describe_index_stats()
+    assert stats["quantization"] == "int8"
+    assert stats["vector_memory_bytes"] == 200 * (16 + 4)
+    # Values are kept exactly, for re-scoring
+    fetched = index.fetch(ids=["v7"])["vectors"]["v7"]["values"]
+    assert np.array_equal(np.asarray(fetched, dtype=np.float32), vectors[7])
+
+    # Re-scored matches carry the exact scores of the unquantized index
+    for query in random_vectors(10, seed=1):
+        matches = index.query(vector=query, top_k=5)["matches"]
+        expected = exact.query(vector=query, top_k=5)["matches"]
+        assert [match["id"] for match in matches
+                ] == [match["id"] for match in expected]
+        assert np.allclose([match["score"] for match in matches],
+                           [match["score"] for match in expected])
+    assert index.query(vector=vectors[7], top_k=1)["matches"][0]["id"] == "v7"
+    assert index.estimate_recall(sample_size=20) > 0.9
+
+    # Reloading rebuilds the codes from the stored values
+    reloaded = make_index(tmp_path / "int8", quantization="int8")
+    matches = reloaded.query(vector=vectors[7], top_k=3)["matches"]
+    assert matches == index.query(vector=vectors[7], top_k=3)["matches"]
@@ -0,0 +1,85 @@
+import re
+from collections import deque
+from typing import Iterable
+from typing import Iterator
+
+from tokenizer import DEFAULT_MODEL
+from tokenizer import get_encoding
+
+# Split points between units: after sentence punctuation, and before blank lines.
+# Whitespace stays at the start of the following unit.
+UNIT_BOUNDARY = re.compile(r"(?<=[.!?])(?=\s)|(?=\n[ \t]*\n)")
+# Text with no boundary for this many characters is cut anyway, so one huge
+# unpunctuated blob can't make the scan quadratic
+MAX_UNIT_CHARS = 20000
+
+
+def iter_units(pieces: Iterable[str]) -> Iterator[str]:
+    """
+    Turn a stream of text pieces (pages, paragraphs, decoded blocks...) into
+    sentence/paragraph units. A unit that spans two pieces is stitched back together.
+    """
+    carry = ""
+    for piece in pieces:
+        units = UNIT_BOUNDARY.split(carry + piece)
+        # The last unit may continue in the next piece
+        carry = units.pop()
+        yield from (unit for unit in units if unit)
+        if len(carry) > MAX_UNIT_CHARS:
+            yield carry
+            carry = ""
+    if carry:
+        yield carry
+
+
+def iter_chunks(pieces: Iterable[str],
+                max_tokens: int = 1000,
+                overlap_tokens: int = 100,
+                model: str = DEFAULT_MODEL) -> Iterator[str]:
+    """
+    Pack a text stream into chunks of at most max_tokens tokens, in one linear pass.
+
+    Sizes are measured with the embedding model's tokenizer. Units are never
+    split unless a single unit is larger than max_tokens, in which case it is
+    cut on token boundaries. Each chunk starts with up to overlap_tokens tokens
+    of whole units from the end of the previous chunk.
+    """
+    encoding = get_encoding(model)
+    window = deque()  # (text, tokens) of the units in the current chunk
+    window_tokens = 0
+    new_units = 0  # units added since the last chunk was emitted
+
+    for unit in iter_units(pieces):
+        tokens = encoding.encode(unit, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            parts = [(unit, len(tokens))]
+        else:
+            parts = [(encoding.decode(tokens[start:start + max_tokens]),
+                      len(tokens[start:start + max_tokens]))
+                     for start in range(0, len(tokens), max_tokens)]
+
+        for text, n_tokens in parts:
+            if window and window_tokens + n_tokens > max_tokens:
+                chunk = "".join(unit_text for unit_text, _ in window).strip()
+                if chunk:
+                    yield chunk
+                new_units = 0
+                # Keep the tail of this chunk as the overlap for the next one
+                while window and (window_tokens > overlap_tokens
+                                  or window_tokens + n_tokens > max_tokens):
+                    window_tokens -= window.popleft()[1]
+            window.append((text, n_tokens))
+            window_tokens += n_tokens
+            new_units += 1
+
+    if new_units:
+        chunk = "".join(unit_text for unit_text, _ in window).strip()
+        if chunk:
+            yield chunk
+
+
+def split_text(text: str,
+               max_tokens: int = 1000,
+               overlap_tokens: int = 100,
+               model: str = DEFAULT_MODEL) -> list:
+    return list(iter_chunks([text], max_tokens, overlap_tokens, model))
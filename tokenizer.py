@@ -0,0 +1,20 @@
+from functools import lru_cache
+
+import tiktoken
+
+DEFAULT_MODEL = "text-embedding-ada-002"
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str = DEFAULT_MODEL):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Unknown model names fall back to the encoding used by ada-002 / gpt-3.5
+        return tiktoken.get_encoding("cl100k_base")
+
+
+# Count tokens locally (no API call). Special tokens found in user documents
+# are treated as plain text instead of raising.
+def count_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    return len(get_encoding(model).encode(text, disallowed_special=()))
@@ -0,0 +1,85 @@
+import hashlib
+import logging
+import os
+import tempfile
+
+from fastapi import HTTPException
+from fastapi import UploadFile
+
+from config import load_config
+
+config = load_config("config.yaml")
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = "uploads"
+# Bytes read from the upload and written to disk per step
+UPLOAD_CHUNK_SIZE = config.get("UPLOAD_CHUNK_SIZE", 1024 * 1024)
+MAX_UPLOAD_BYTES = config.get("MAX_UPLOAD_BYTES", 100 * 1024 * 1024)
+
+
+def upload_path(filename: str, upload_dir: str = UPLOAD_DIR) -> str:
+    # Keep only the base name so uploads can't be written outside upload_dir
+    return os.path.join(upload_dir, os.path.basename(filename))
+
+
+async def save_upload(uploaded_file: UploadFile,
+                      upload_dir: str = UPLOAD_DIR,
+                      max_bytes: int = MAX_UPLOAD_BYTES):
+    """
+    Stream an upload to disk in fixed-size chunks, hashing it on the way.
+
+    Memory use stays at one chunk regardless of the file size. The file is
+    staged in a temporary file of its own, removed if the upload is rejected or
+    interrupted. Ingestion reads the staged file and moves it to file_path once
+    done (see ingest_files), so neither concurrent uploads nor queued jobs for
+    the same name see each other's bytes.
+
+    :return: (file_path, staged path, sha256 hex digest, size in bytes)
+    """
+    filename = os.path.basename(uploaded_file.filename)
+    file_path = upload_path(filename, upload_dir)
+
+    sha256 = hashlib.sha256()
+    size = 0
+    partial_path = None
+    try:
+        # Keeps the extension, extraction picks the parser from it
+        with tempfile.NamedTemporaryFile(
+                dir=upload_dir,
+                delete=False,
+                suffix=f".part{os.path.splitext(filename)[1]}") as f:
+            partial_path = f.name
+            while True:
+                chunk = await uploaded_file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=
+                        f"File {filename} exceeds the {max_bytes} bytes upload limit.",
+                    )
+                sha256.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        if partial_path and os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    finally:
+        await uploaded_file.close()
+
+    content_hash = sha256.hexdigest()
+    logger.info(
+        f"Staged upload {file_path} at {partial_path} ({size} bytes, sha256 {content_hash})"
+    )
+    return file_path, partial_path, content_hash, size
+
+
+def discard_uploads(staged_paths):
+    for staged_path in staged_paths:
+        if os.path.exists(staged_path):
+            os.remove(staged_path)
@@ -6,8 +6,10 @@ import yaml
 from fastapi import APIRouter
 from fastapi import Depends
 from fastapi import HTTPException
+from fastapi import Request
 from fastapi import status
 from fastapi.responses import JSONResponse
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi_limiter.depends import RateLimiter
@@ -25,11 +27,18 @@ from models import User, UserIn, UserInDB, UserOut, UserTable
 from token_service import create_token, verify_token
 from fastapi import APIRouter
 from models import TokenBlacklist
+import asyncio
 import uuid
 import json 
 from redis_config import get_redis, get_token_blacklist
-from chat.chat_utils import limit_chat_history
-from chat.chat_with_data import chat_ask_question
+from chat.chat_streaming import chat_sse_events
+from chat.chat_utils import get_chat_messages, save_bot_response
+from chat.chat_with_data import achat_ask_question, aretrieve_documents
+from chat.chat_with_data import acache_answer, alookup_answer
+from retrieval_cache import retrieval_cache
+from retrieve import aget_embedding
+from semantic_cache import semantic_cache
+from file_catalog import file_catalog
 router = APIRouter()
 
 # Load configuration from YAML file
@@ -47,6 +56,8 @@ config = load_config("config.yaml")
 class ChatInput(BaseModel):
     user_input: str
     file_name: Optional[str] = None
+    # Chat history is kept per conversation, omitted means the user's default one
+    conversation_id: Optional[str] = None
 
 
 class SearchQuery(BaseModel):
@@ -87,6 +98,9 @@ ACCESS_TOKEN_EXPIRE_MINUTES = config["ACCESS_TOKEN_EXPIRE_MINUTES"]
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/users/login")
+# Same scheme but returns None instead of raising 401 when no token is sent
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/users/login",
+                                              auto_error=False)
 
 
 def verify_password(plain_password, hashed_password):
@@ -149,6 +163,17 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], token_
         raise credentials_exception
     return user
 
+
+# Current user when a bearer token is sent, None for anonymous requests
+async def get_current_user_optional(request: Request,
+                                    token: Optional[str] = Depends(
+                                        optional_oauth2_scheme),
+                                    db: Session = Depends(get_db)):
+    if token is None:
+        return None
+    return await get_current_user(token, get_token_blacklist(request), db)
+
+
 # checks if authenticated user is active (checks disabled attribute)
 def get_current_active_user(
         current_user: Annotated[User, Depends(get_current_user)]):
@@ -267,13 +292,14 @@ async def logout(token: str = Depends(oauth2_scheme)):
 
 
 @router.get("/files")
-async def get_file_names():
-    with open("filenames.json", "r") as file:
-        file_data = json.load(file)
-    print("Filenames")
-    file_names = list(file_data.keys())
-    print(file_names)
-    return JSONResponse(content=file_names)
+async def get_file_names(after: Optional[str] = None,
+                         limit: int = 100,
+                         mine: bool = False,
+                         current_user=Depends(get_current_user_optional)):
+    # Paginated: pass the returned next_cursor as `after` to get the next page
+    owner_id = current_user.user_id if mine and current_user else None
+    page = file_catalog.list_files(after=after, limit=limit, owner_id=owner_id)
+    return JSONResponse(content=page)
 
 @router.post("/users/addfile/")
 async def add_file_to_user_endpoint(
@@ -299,6 +325,7 @@ async def get_user_files_endpoint(
 @router.post("/users/me/chat/responses")
 async def chat_ask(
         chat_input: ChatInput,
+        stream: bool = False,
         current_user: User = Depends(get_current_user),
         db: Session = Depends(get_db),
        
@@ -306,25 +333,34 @@ async def chat_ask(
     try:
         user_id = current_user.user_id
         print(user_id)
-        r = await get_redis()
-        # Fetch chat history
-        chat_history_redis = await r.lrange(f"chat:{user_id}", 0, -1)
-
-        chat_history_redis = [
-            json.loads(message.decode("utf-8"))
-            for message in chat_history_redis
-        ]
-        # Generate response from language model
-        response = chat_ask_question(chat_input.user_input, chat_history_redis,
-                                     chat_input.file_name)
-
-        # Limit chat history to a certain number of tokens
-        chat_history_redis = await limit_chat_history(chat_history_redis,
-                                                      response)
-
-        # Store bot's response in Redis
-        response_str = json.dumps({"user": "bot", "message": response})
-        await r.rpush(f"chat:{user_id}", response_str)
+        if stream:
+            # Tokens as Server-Sent Events, the answer is saved once complete
+            return StreamingResponse(chat_sse_events(
+                user_id, chat_input.user_input, chat_input.file_name,
+                chat_input.conversation_id),
+                                     media_type="text/event-stream")
+        # The question embedding and the history fetch run concurrently
+        query_embeds, chat_history_redis = await asyncio.gather(
+            aget_embedding(chat_input.user_input),
+            get_chat_messages(user_id, chat_input.conversation_id),
+        )
+        scope, response = await alookup_answer(query_embeds,
+                                               chat_input.file_name,
+                                               chat_history_redis)
+        if response is None:
+            documents = await aretrieve_documents(chat_input.user_input,
+                                                  chat_input.file_name,
+                                                  query_embeds)
+            # Generate response from language model
+            response = await achat_ask_question(chat_input.user_input,
+                                                chat_history_redis,
+                                                chat_input.file_name,
+                                                documents=documents)
+            await acache_answer(scope, query_embeds, response)
+
+        await save_bot_response(user_id, chat_history_redis, response,
+                                chat_input.user_input,
+                                chat_input.conversation_id)
 
         return {"response": response}
     except HTTPException as e:
@@ -332,3 +368,12 @@ async def chat_ask(
     except Exception as e:
         raise HTTPException(
             status_code=500, detail="Unable to process the request.")
+
+
+@router.get("/chat/cache/stats")
+async def chat_cache_stats(current_user: User = Depends(get_current_user)):
+    # Answer cache counters cover all workers, retrieval cache ones this worker
+    return {
+        "answers": await semantic_cache.stats(),
+        "retrieval": retrieval_cache.stats(),
+    }
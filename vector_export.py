@@ -0,0 +1,202 @@
+import argparse
+import json
+import logging
+import os
+import struct
+
+import numpy as np
+
+from config import load_config
+from content_registry import content_registry
+from vector_store import get_vector_index
+
+config = load_config("config.yaml")
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Vectors fetched per request, and the most held in memory at once
+EXPORT_PAGE_SIZE = config.get("EXPORT_PAGE_SIZE", 500)
+
+# File layout: MAGIC, dimension (uint32), then one record per vector:
+# id length (uint16), metadata length (uint32), id (utf-8),
+# values (dimension x float32), metadata (utf-8 JSON)
+MAGIC = b"DHVEXP1\n"
+DIMENSION = struct.Struct("<I")
+RECORD_HEADER = struct.Struct("<HI")
+
+
+def iter_vector_pages(index=None,
+                      file_id: str = None,
+                      cursor: list = None,
+                      page_size: int = EXPORT_PAGE_SIZE):
+    """
+    Page through every vector of the index, or of one file, in (file_id, chunk
+    position) order. Ids come from the content registry, values and metadata
+    are fetched from the index one page at a time.
+
+    :param cursor: Cursor yielded with a previous page, to resume after it.
+    :return: generator of ([(id, values, metadata)], cursor of the page)
+    """
+    index = index or get_vector_index()
+    after = tuple(cursor) if cursor else None
+    while True:
+        rows = content_registry.get_chunk_page(after, page_size, file_id)
+        if not rows:
+            return
+        vector_ids = [vector_id for _, _, vector_id in rows]
+        fetched = index.fetch(ids=vector_ids)["vectors"]
+        vectors = [(vector_id, fetched[vector_id]["values"],
+                    fetched[vector_id].get("metadata") or {})
+                   for vector_id in vector_ids if vector_id in fetched]
+        if len(vectors) < len(vector_ids):
+            logger.warning(
+                f"{len(vector_ids) - len(vectors)} registered vectors missing from the index"
+            )
+        after = rows[-1][:2]
+        yield vectors, list(after)
+
+
+def export_vectors(path: str,
+                   index=None,
+                   file_id: str = None,
+                   page_size: int = EXPORT_PAGE_SIZE,
+                   resume: bool = True) -> int:
+    """
+    Write vectors to a binary export file, page by page.
+
+    After each page the cursor, file size, file id and vectors written so far
+    are saved next to the export (<path>.cursor), so an interrupted export
+    picks up where it stopped. A finished export is marked complete there,
+    resuming it writes nothing.
+
+    :return: the number of vectors in the export file, including those written
+        by earlier calls that this one resumed.
+    """
+    cursor_path = f"{path}.cursor"
+    cursor = None
+    total = 0
+    if resume and os.path.exists(cursor_path) and os.path.exists(path):
+        with open(cursor_path, "r") as f:
+            state = json.load(f)
+        if state.get("file_id") != file_id:
+            raise ValueError(
+                f"{path} is an export of file {state.get('file_id')}, not "
+                f"{file_id}, restart it to export again")
+        if state.get("complete"):
+            logger.info(
+                f"Export to {path} is already complete ({state['total']} vectors), "
+                "restart it to export again")
+            return state["total"]
+        cursor = state["cursor"]
+        total = state.get("total", 0)
+        # Drop anything written after the last saved page
+        with open(path, "r+b") as f:
+            f.truncate(state["size"])
+        logger.info(f"Resuming export to {path} after {cursor}")
+    elif os.path.exists(path):
+        os.remove(path)
+
+    written = 0
+    with open(path, "ab") as f:
+        dimension = None
+        if f.tell():
+            dimension = read_export_dimension(path)
+        for vectors, cursor in iter_vector_pages(index, file_id, cursor,
+                                                 page_size):
+            if vectors and dimension is None:
+                dimension = len(vectors[0][1])
+                f.write(MAGIC + DIMENSION.pack(dimension))
+            records = []
+            for vector_id, values, metadata in vectors:
+                encoded_id = vector_id.encode("utf-8")
+                encoded_metadata = json.dumps(metadata).encode("utf-8")
+                records.append(
+                    RECORD_HEADER.pack(len(encoded_id), len(encoded_metadata))
+                    + encoded_id +
+                    np.asarray(values, dtype="<f4").tobytes() +
+                    encoded_metadata)
+            f.write(b"".join(records))
+            f.flush()
+            os.fsync(f.fileno())
+            written += len(vectors)
+            save_cursor(
+                cursor_path, {
+                    "cursor": cursor,
+                    "size": f.tell(),
+                    "file_id": file_id,
+                    "total": total + written
+                })
+        save_cursor(
+            cursor_path, {
+                "cursor": cursor,
+                "size": f.tell(),
+                "file_id": file_id,
+                "total": total + written,
+                "complete": True
+            })
+    logger.info(
+        f"Exported {written} vectors to {path}, {total + written} in total")
+    return total + written
+
+
+def save_cursor(cursor_path: str, state: dict):
+    with open(f"{cursor_path}.tmp", "w") as cursor_file:
+        json.dump(state, cursor_file)
+    os.replace(f"{cursor_path}.tmp", cursor_path)
+
+
+def read_export_dimension(path: str) -> int:
+    with open(path, "rb") as f:
+        header = f.read(len(MAGIC) + DIMENSION.size)
+    if header[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a vector export")
+    return DIMENSION.unpack(header[len(MAGIC):])[0]
+
+
+def read_export(path: str):
+    """
+    Read an export file back one vector at a time.
+
+    :return: generator of (id, values as a float32 array, metadata)
+    """
+    with open(path, "rb") as f:
+        header = f.read(len(MAGIC) + DIMENSION.size)
+        if not header:
+            return
+        if header[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a vector export")
+        dimension = DIMENSION.unpack(header[len(MAGIC):])[0]
+        while True:
+            record_header = f.read(RECORD_HEADER.size)
+            if len(record_header) < RECORD_HEADER.size:
+                return
+            id_length, metadata_length = RECORD_HEADER.unpack(record_header)
+            vector_id = f.read(id_length).decode("utf-8")
+            values = np.frombuffer(f.read(dimension * 4), dtype="<f4")
+            metadata = json.loads(f.read(metadata_length))
+            yield vector_id, values, metadata
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export vectors to a binary file, resumable.")
+    parser.add_argument("path")
+    parser.add_argument("--file-id", help="Only export this file's vectors")
+    parser.add_argument("--page-size", type=int, default=EXPORT_PAGE_SIZE)
+    parser.add_argument("--restart",
+                        action="store_true",
+                        help="Ignore a saved cursor and start over")
+    args = parser.parse_args()
+    try:
+        export_vectors(args.path,
+                       file_id=args.file_id,
+                       page_size=args.page_size,
+                       resume=not args.restart)
+    except ValueError as e:
+        parser.error(str(e))
+
+
+if __name__ == "__main__":
+    main()
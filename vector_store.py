@@ -0,0 +1,548 @@
+import logging
+import os
+import pickle
+import threading
+from functools import lru_cache
+
+import numpy as np
+
+from config import load_config
+
+config = load_config("config.yaml")
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# "pinecone" or "local" (LocalVectorIndex)
+VECTOR_BACKEND = config.get("VECTOR_BACKEND", "pinecone")
+LOCAL_VECTOR_INDEX_PATH = config.get("LOCAL_VECTOR_INDEX_PATH",
+                                     "vector_index")
+# Unfiltered queries use an HNSW graph (hnswlib, optional) above this many vectors
+LOCAL_VECTOR_ANN_THRESHOLD = config.get("LOCAL_VECTOR_ANN_THRESHOLD", 100_000)
+# The write log is folded into a new snapshot once it outgrows the snapshot
+# or this many bytes, whichever is larger
+LOCAL_VECTOR_MIN_LOG_BYTES = config.get("LOCAL_VECTOR_MIN_LOG_BYTES",
+                                        64 * 1024 * 1024)
+# "none" keeps float32 vectors in memory. "int8" keeps one byte per dimension
+# in memory (about 4x less) and the float32 vectors in a memory-mapped file,
+# read only to re-score the best candidates exactly
+LOCAL_VECTOR_QUANTIZATION = config.get("LOCAL_VECTOR_QUANTIZATION", "none")
+# int8: candidates re-scored exactly per requested match, higher means better recall
+LOCAL_VECTOR_RESCORE_FACTOR = config.get("LOCAL_VECTOR_RESCORE_FACTOR", 4)
+# int8: sample queries used to estimate and log the recall lost to
+# quantization when the index is loaded, 0 disables
+LOCAL_VECTOR_RECALL_SAMPLE = config.get("LOCAL_VECTOR_RECALL_SAMPLE", 100)
+# Rows scored at once when scanning int8 codes or the memory-mapped vectors,
+# bounds the size of the float32 temporaries
+SCAN_BLOCK_ROWS = 8192
+
+COMPARISONS = {
+    "$eq": lambda values, operand: values == operand,
+    "$ne": lambda values, operand: values != operand,
+    "$gt": lambda values, operand: values > operand,
+    "$gte": lambda values, operand: values >= operand,
+    "$lt": lambda values, operand: values < operand,
+    "$lte": lambda values, operand: values <= operand,
+    "$in": lambda values, operand: np.isin(values, list(operand)),
+    "$nin": lambda values, operand: ~np.isin(values, list(operand)),
+}
+
+
+class LocalVectorIndex:
+    """
+    In-process vector index with the pinecone.Index surface used in this repo:
+    upsert, query, fetch, delete and describe_index_stats, with Pinecone-style
+    metadata filters ($eq, $ne, $gt(e), $lt(e), $in, $nin, $and, $or).
+
+    Vectors live in one contiguous float32 matrix and queries score all of them
+    with a single matrix-vector product (cosine similarity). Large unfiltered
+    collections are searched through an HNSW graph when hnswlib is installed.
+
+    With int8 quantization, each vector is kept in memory as int8 codes plus one
+    scale, queries scan the codes and the top rescore_factor * top_k candidates
+    are re-scored exactly from a memory-mapped float32 copy. The HNSW graph is
+    not used then, it would hold every float32 vector in memory again.
+
+    Persisted as a snapshot plus an append-only write log that is replayed on
+    load, so a write costs one log append instead of rewriting the matrix. The
+    index is held by one process; run a single API worker with this backend.
+    """
+
+    def __init__(self,
+                 path: str = LOCAL_VECTOR_INDEX_PATH,
+                 ann_threshold: int = LOCAL_VECTOR_ANN_THRESHOLD,
+                 quantization: str = LOCAL_VECTOR_QUANTIZATION,
+                 rescore_factor: int = LOCAL_VECTOR_RESCORE_FACTOR,
+                 recall_sample: int = LOCAL_VECTOR_RECALL_SAMPLE):
+        if quantization not in ("none", "int8"):
+            raise ValueError(f"Unknown quantization {quantization}")
+        self.path = path
+        self.ann_threshold = ann_threshold
+        self.quantized = quantization == "int8"
+        self.rescore_factor = rescore_factor
+        self._lock = threading.RLock()
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._codes = np.zeros((0, 0), dtype=np.int8)
+        self._scales = np.zeros(0, dtype=np.float32)
+        self._inv_norms = np.zeros(0, dtype=np.float32)
+        self._count = 0
+        self._ids = []
+        self._metadata = []
+        self._rows = {}  # id -> row in the matrix
+        # Rows move on delete, the ANN graph refers to them by a stable label
+        self._labels = np.zeros(0, dtype=np.int64)
+        self._label_rows = {}
+        self._next_label = 0
+        self._field_cache = {}  # metadata field -> values of every row, for filtering
+        self._ann = None
+        if self.quantized and os.path.exists(self._vectors_file_path):
+            # Scratch copy, rebuilt from the snapshot and log below
+            os.remove(self._vectors_file_path)
+        self._load()
+        if self.quantized and recall_sample and self._count:
+            recall = self.estimate_recall(recall_sample)
+            logger.info(
+                f"int8 quantization recall@10 on {recall_sample} sample queries: {recall:.3f}"
+            )
+
+    @property
+    def _snapshot_vectors_path(self):
+        return f"{self.path}.vectors.npy"
+
+    @property
+    def _snapshot_meta_path(self):
+        return f"{self.path}.meta.pkl"
+
+    @property
+    def _log_path(self):
+        return f"{self.path}.log"
+
+    @property
+    def _vectors_file_path(self):
+        return f"{self.path}.float32"
+
+    def _load(self):
+        if os.path.exists(self._snapshot_meta_path):
+            vectors = np.load(self._snapshot_vectors_path, mmap_mode="r")
+            with open(self._snapshot_meta_path, "rb") as f:
+                ids, metadata = pickle.load(f)
+            # In blocks, so the snapshot is never fully read into memory at once
+            for start in range(0, len(ids), SCAN_BLOCK_ROWS):
+                end = start + SCAN_BLOCK_ROWS
+                self._apply_upsert(ids[start:end],
+                                   np.asarray(vectors[start:end]),
+                                   metadata[start:end])
+        replayed = 0
+        if os.path.exists(self._log_path):
+            with open(self._log_path, "rb") as log:
+                while True:
+                    position = log.tell()
+                    try:
+                        operation, payload = pickle.load(log)
+                    except (EOFError, pickle.UnpicklingError):
+                        # End of the log, or a record cut short by a crash
+                        break
+                    if operation == "upsert":
+                        self._apply_upsert(*payload)
+                    else:
+                        self._apply_delete(payload)
+                    replayed += 1
+            if os.path.getsize(self._log_path) > position:
+                # Drop the partial record so later appends stay readable
+                with open(self._log_path, "r+b") as log:
+                    log.truncate(position)
+        logger.info(
+            f"Loaded local vector index {self.path}: {self._count} vectors, {replayed} log entries replayed"
+        )
+
+    def _append_log(self, operation: str, payload):
+        with open(self._log_path, "ab") as log:
+            pickle.dump((operation, payload),
+                        log,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+            log_size = log.tell()
+        snapshot_size = (os.path.getsize(self._snapshot_vectors_path)
+                         if os.path.exists(self._snapshot_vectors_path) else
+                         0)
+        if log_size > max(snapshot_size, LOCAL_VECTOR_MIN_LOG_BYTES):
+            self.save()
+
+    def save(self):
+        """
+        Write a snapshot of the whole index and empty the write log.
+        """
+        with self._lock:
+            np.save(f"{self._snapshot_vectors_path}.tmp.npy",
+                    self._vectors[:self._count])
+            with open(f"{self._snapshot_meta_path}.tmp", "wb") as f:
+                pickle.dump((self._ids, self._metadata),
+                            f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f"{self._snapshot_vectors_path}.tmp.npy",
+                       self._snapshot_vectors_path)
+            os.replace(f"{self._snapshot_meta_path}.tmp",
+                       self._snapshot_meta_path)
+            # Replaying the log over the new snapshot is harmless, so a crash
+            # before this truncation loses nothing
+            open(self._log_path, "wb").close()
+        logger.info(f"Saved local vector index snapshot: {self._count} vectors")
+
+    def _reserve(self, count: int, dimension: int):
+        if self._vectors.shape[1] != dimension:
+            if self._count:
+                raise ValueError(
+                    f"Vector dimension {dimension} does not match the index dimension {self._vectors.shape[1]}"
+                )
+            self._vectors = np.zeros((0, dimension), dtype=np.float32)
+            self._codes = np.zeros((0, dimension), dtype=np.int8)
+        if count <= len(self._vectors):
+            return
+        # Grow geometrically so appends stay amortized O(1)
+        capacity = max(count, 2 * len(self._vectors), 1024)
+        if self.quantized:
+            # Growing the file keeps its content, remap it at the new size
+            with open(self._vectors_file_path, "ab") as f:
+                f.truncate(capacity * dimension * 4)
+            self._vectors = np.memmap(self._vectors_file_path,
+                                      dtype=np.float32,
+                                      mode="r+",
+                                      shape=(capacity, dimension))
+            codes = np.zeros((capacity, dimension), dtype=np.int8)
+            codes[:self._count] = self._codes[:self._count]
+            self._codes = codes
+            scales = np.zeros(capacity, dtype=np.float32)
+            scales[:self._count] = self._scales[:self._count]
+            self._scales = scales
+        else:
+            vectors = np.zeros((capacity, dimension), dtype=np.float32)
+            vectors[:self._count] = self._vectors[:self._count]
+            self._vectors = vectors
+        inv_norms = np.zeros(capacity, dtype=np.float32)
+        inv_norms[:self._count] = self._inv_norms[:self._count]
+        self._inv_norms = inv_norms
+        labels = np.zeros(capacity, dtype=np.int64)
+        labels[:self._count] = self._labels[:self._count]
+        self._labels = labels
+
+    def _apply_upsert(self, ids: list, vectors: np.ndarray, metadata: list):
+        if not ids:
+            return
+        self._reserve(self._count + len(ids), vectors.shape[1])
+        norms = np.linalg.norm(vectors, axis=1)
+        inv_norms = np.divide(1.0,
+                              norms,
+                              out=np.zeros_like(norms),
+                              where=norms > 0)
+        rows = []
+        for vector_id, meta in zip(ids, metadata):
+            row = self._rows.get(vector_id)
+            if row is None:
+                row = self._count
+                self._count += 1
+                self._rows[vector_id] = row
+                self._ids.append(vector_id)
+                self._metadata.append(meta)
+            else:
+                self._metadata[row] = meta
+                self._forget_label(row)
+            self._labels[row] = self._next_label
+            self._label_rows[self._next_label] = row
+            self._next_label += 1
+            rows.append(row)
+        # A repeated id keeps its last vector, as with assignment in a loop
+        self._vectors[rows] = vectors
+        self._inv_norms[rows] = inv_norms
+        if self.quantized:
+            # Symmetric per-vector scale: the largest component maps to 127
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1
+            self._codes[rows] = np.rint(vectors / scales[:, None]).astype(
+                np.int8)
+            self._scales[rows] = scales
+        self._field_cache.clear()
+        if self._ann is not None:
+            self._ann.resize_index(
+                max(self._ann.get_max_elements(), self._next_label))
+            self._ann.add_items(self._vectors[rows], self._labels[rows])
+
+    def _forget_label(self, row: int):
+        label = int(self._labels[row])
+        del self._label_rows[label]
+        if self._ann is not None:
+            self._ann.mark_deleted(label)
+
+    def _apply_delete(self, ids: list):
+        for vector_id in ids:
+            row = self._rows.pop(vector_id, None)
+            if row is None:
+                continue
+            self._forget_label(row)
+            # Move the last row into the hole so the matrix stays contiguous
+            last = self._count - 1
+            if row != last:
+                moved_id = self._ids[last]
+                self._vectors[row] = self._vectors[last]
+                self._inv_norms[row] = self._inv_norms[last]
+                if self.quantized:
+                    self._codes[row] = self._codes[last]
+                    self._scales[row] = self._scales[last]
+                self._labels[row] = self._labels[last]
+                self._ids[row] = moved_id
+                self._metadata[row] = self._metadata[last]
+                self._rows[moved_id] = row
+                self._label_rows[int(self._labels[row])] = row
+            self._ids.pop()
+            self._metadata.pop()
+            self._count -= 1
+        self._field_cache.clear()
+
+    def upsert(self, vectors: list, **kwargs):
+        """
+        :param vectors: [(id, values, metadata)] or [(id, values)] as for pinecone.Index.upsert.
+        """
+        ids = [vector[0] for vector in vectors]
+        values = np.asarray([vector[1] for vector in vectors],
+                            dtype=np.float32)
+        metadata = [
+            dict(vector[2]) if len(vector) > 2 and vector[2] else {}
+            for vector in vectors
+        ]
+        with self._lock:
+            self._apply_upsert(ids, values, metadata)
+            self._append_log("upsert", (ids, values, metadata))
+        return {"upserted_count": len(ids)}
+
+    def delete(self,
+               ids: list = None,
+               delete_all: bool = False,
+               filter: dict = None,
+               **kwargs):
+        with self._lock:
+            if delete_all:
+                ids = list(self._ids)
+            elif filter is not None:
+                rows = np.flatnonzero(self._filter_mask(filter))
+                ids = [self._ids[row] for row in rows]
+            ids = list(ids or [])
+            self._apply_delete(ids)
+            self._append_log("delete", ids)
+        return {}
+
+    def fetch(self, ids: list, **kwargs):
+        with self._lock:
+            return {
+                "vectors": {
+                    vector_id: {
+                        "id": vector_id,
+                        "values": self._vectors[row].tolist(),
+                        "metadata": self._metadata[row],
+                    }
+                    for vector_id, row in ((vector_id, self._rows.get(vector_id))
+                                           for vector_id in ids)
+                    if row is not None
+                }
+            }
+
+    def _field_values(self, field: str) -> np.ndarray:
+        values = self._field_cache.get(field)
+        if values is None:
+            values = np.empty(self._count, dtype=object)
+            values[:] = [meta.get(field) for meta in self._metadata]
+            self._field_cache[field] = values
+        return values
+
+    def _filter_mask(self, filter: dict) -> np.ndarray:
+        mask = np.ones(self._count, dtype=bool)
+        for key, condition in filter.items():
+            if key == "$and":
+                for sub_filter in condition:
+                    mask &= self._filter_mask(sub_filter)
+            elif key == "$or":
+                any_mask = np.zeros(self._count, dtype=bool)
+                for sub_filter in condition:
+                    any_mask |= self._filter_mask(sub_filter)
+                mask &= any_mask
+            else:
+                values = self._field_values(key)
+                if not isinstance(condition, dict):
+                    condition = {"$eq": condition}
+                for operator, operand in condition.items():
+                    if operator not in COMPARISONS:
+                        raise ValueError(
+                            f"Unsupported filter operator {operator}")
+                    if operator in ("$in", "$nin", "$eq", "$ne"):
+                        result = COMPARISONS[operator](values, operand)
+                    else:
+                        # Range comparisons only apply to rows that have the field
+                        present = values != None  # noqa: E711
+                        result = np.zeros(self._count, dtype=bool)
+                        result[present] = COMPARISONS[operator](
+                            values[present], operand)
+                    mask &= np.asarray(result, dtype=bool)
+        return mask
+
+    def _get_ann(self):
+        if self._ann is None:
+            try:
+                import hnswlib
+            except ImportError:
+                return None
+            dimension = self._vectors.shape[1]
+            ann = hnswlib.Index(space="cosine", dim=dimension)
+            ann.init_index(max_elements=self._next_label,
+                           ef_construction=200,
+                           M=16)
+            ann.add_items(self._vectors[:self._count],
+                          self._labels[:self._count])
+            ann.set_ef(128)
+            # Kept up to date by later upserts and deletes
+            self._ann = ann
+            logger.info(f"Built HNSW graph over {self._count} vectors")
+        return self._ann
+
+    def query(self,
+              vector=None,
+              top_k: int = 10,
+              filter: dict = None,
+              include_values: bool = False,
+              include_metadata: bool = False,
+              **kwargs):
+        with self._lock:
+            if not self._count:
+                return {"matches": []}
+            query = np.asarray(vector, dtype=np.float32)
+            query_norm = np.linalg.norm(query)
+            if query_norm:
+                query = query / query_norm
+            top_k = min(top_k, self._count)
+
+            ann = (self._get_ann() if filter is None and not self.quantized
+                   and self._count >= self.ann_threshold else None)
+            if ann is not None:
+                labels, _ = ann.knn_query(query, k=top_k)
+                rows = np.array(
+                    [self._label_rows[int(label)] for label in labels[0]])
+            else:
+                candidates = (np.flatnonzero(self._filter_mask(filter))
+                              if filter else None)
+                if self.quantized:
+                    # Shortlist on the int8 codes, re-scored exactly below
+                    rows = self._top_rows(
+                        candidates, query, top_k * self.rescore_factor,
+                        self._approximate_scores)
+                else:
+                    rows = self._top_rows(candidates, query, top_k,
+                                          self._exact_scores)
+            # Exact scores for the selected rows, best first
+            scores = self._exact_scores(rows, query)
+            order = np.argsort(-scores)[:top_k]
+
+            matches = []
+            for row, score in zip(rows[order], scores[order]):
+                match = {"id": self._ids[row], "score": float(score)}
+                if include_values:
+                    match["values"] = self._vectors[row].tolist()
+                if include_metadata:
+                    match["metadata"] = self._metadata[row]
+                matches.append(match)
+            return {"matches": matches}
+
+    def _exact_scores(self, rows, query: np.ndarray) -> np.ndarray:
+        """
+        :param rows: Rows to score, None for every row.
+        """
+        if not self.quantized:
+            if rows is None:
+                rows = slice(0, self._count)
+            return (self._vectors[rows] @ query) * self._inv_norms[rows]
+        return self._scan(rows, query,
+                          lambda block: np.asarray(self._vectors[block]))
+
+    def _approximate_scores(self, rows, query: np.ndarray) -> np.ndarray:
+        return self._scan(
+            rows, query,
+            lambda block: self._codes[block].astype(np.float32),
+            lambda block: self._scales[block])
+
+    def _scan(self, rows, query: np.ndarray, values, scales=None):
+        count = self._count if rows is None else len(rows)
+        scores = np.empty(count, dtype=np.float32)
+        for start in range(0, count, SCAN_BLOCK_ROWS):
+            end = min(start + SCAN_BLOCK_ROWS, count)
+            block = slice(start, end) if rows is None else rows[start:end]
+            block_scores = (values(block) @ query) * self._inv_norms[block]
+            if scales is not None:
+                block_scores *= scales(block)
+            scores[start:end] = block_scores
+        return scores
+
+    def _top_rows(self, candidates, query: np.ndarray, k: int,
+                  score) -> np.ndarray:
+        """
+        :param candidates: Rows that pass the filter, None for every row.
+        :return: the k best rows by score, unordered.
+        """
+        if candidates is not None and not len(candidates):
+            return np.zeros(0, dtype=np.int64)
+        scores = score(candidates, query)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top if candidates is None else candidates[top]
+
+    def estimate_recall(self, sample_size: int = 100, top_k: int = 10) -> float:
+        """
+        Share of the exact top_k matches the quantized search also returns, for
+        sample_size stored vectors used as queries.
+        """
+        with self._lock:
+            if not self._count:
+                return 1.0
+            rng = np.random.default_rng(0)
+            sample = rng.choice(self._count,
+                                size=min(sample_size, self._count),
+                                replace=False)
+            k = min(top_k, self._count)
+            found = 0
+            for row in sample:
+                query = np.array(self._vectors[row])
+                query_norm = np.linalg.norm(query)
+                if query_norm:
+                    query /= query_norm
+                exact = self._top_rows(None, query, k, self._exact_scores)
+                matches = self.query(query, top_k=k)["matches"]
+                found += len({self._ids[row]
+                              for row in exact} & {match["id"]
+                                                   for match in matches})
+            return found / (len(sample) * k)
+
+    def describe_index_stats(self, **kwargs):
+        with self._lock:
+            if self.quantized:
+                memory_bytes = (self._codes[:self._count].nbytes +
+                                self._scales[:self._count].nbytes)
+            else:
+                memory_bytes = self._vectors[:self._count].nbytes
+            return {
+                "dimension": self._vectors.shape[1],
+                "total_vector_count": self._count,
+                "quantization": "int8" if self.quantized else "none",
+                "vector_memory_bytes": memory_bytes,
+            }
+
+
+@lru_cache(maxsize=None)
+def get_vector_index(backend: str = VECTOR_BACKEND):
+    """
+    The vector index selected by VECTOR_BACKEND in config.yaml, one per process.
+    """
+    if backend == "local":
+        return LocalVectorIndex()
+    if backend == "pinecone":
+        # Imported here so the local backend runs without the Pinecone client
+        import pinecone
+
+        pinecone.init(api_key=config["PINECONE_API_KEY"],
+                      environment=config["PINECONE_ENVIRONMENT"])
+        return pinecone.Index(config["PINECONE_INDEX_NAME"])
+    raise ValueError(f"Unknown VECTOR_BACKEND {backend}")